@@ -0,0 +1,529 @@
+#!/usr/bin/env python
+
+"""
+Digital I/O backends for varianSync.
+__author__   =   Andrew A. Gomella
+__status__   =   Development R2.1
+
+The driver only talks to the ExpReq/ExpOk lines through these classes so that the
+sync logic can run against the NI USB DAQ (NIDAQBackend) or against an in-process
+simulated PaxScan panel (SimulatedBackend) for benchmarks and regression tests.
+Each backend hands out line objects:
+    openOutput(line)            -> object with write(value)
+    openInput(line, onChange)   -> object with read(), close() and changeDetection.
+                                   If changeDetection is True the backend calls
+                                   onChange(level, timestamp) on every edge itself,
+                                   otherwise the caller has to poll read().
+    openSampledInput(lines, onChange, rate, size)
+                                -> continuously sampled input on several lines, edges
+                                   of lines[0] go to onChange with the sample time,
+                                   samples(t0, t1, points) returns the line trace.
+"""
+
+import numpy as np
+import ctypes, ctypes.util, datetime, sys, time
+import threading
+
+try:
+    from PyDAQmx import *
+except ImportError:
+    # NI-DAQmx is only needed for the hardware backend
+    DAQError = None
+
+def systemMonotonic():
+    """
+    Monotonic clock shared by all processes of the host: QueryPerformanceCounter
+    on Windows, clock_gettime(CLOCK_MONOTONIC) on Linux, time.time otherwise.
+    Edges, phases and PV cache updates are all stamped with it.
+    """
+    if sys.platform == 'win32':
+        kernel32 = ctypes.windll.kernel32
+        frequency = ctypes.c_int64()
+        kernel32.QueryPerformanceFrequency(ctypes.byref(frequency))
+        def monotonic():
+            counter = ctypes.c_int64()
+            kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+            return counter.value / float(frequency.value)
+        return monotonic
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno = True)
+        clockGettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    def monotonic():
+        spec = timespec()
+        clockGettime(1, ctypes.byref(spec))                # CLOCK_MONOTONIC
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = systemMonotonic()
+
+class NIDAQOutput(object):
+    """
+    DO task for a single line. Must be "active drive" or the Varian will not see it.
+    """
+    def __init__(self, line):
+        self.line = line
+        self.zero = np.zeros((1,), dtype=np.uint8)
+        self.one = np.ones((1,), dtype=np.uint8)
+        self.written = int32()                          # needed for daqmx writes
+        self.handle = TaskHandle()
+        DAQmxCreateTask("", byref(self.handle))
+        DAQmxCreateDOChan(self.handle, line, "", DAQmx_Val_ChanForAllLines)
+        DAQmxSetDOOutputDriveType(self.handle, line, DAQmx_Val_ActiveDrive)
+        DAQmxStartTask(self.handle)
+
+    def write(self, value):
+        try:
+            DAQmxWriteDigitalLines(self.handle, 1, 1, 10.0, DAQmx_Val_GroupByChannel, \
+                                   self.one if value else self.zero, self.written, None)
+        except DAQError as err:
+            print "DAQmx Error: %s"%err
+
+    def close(self):
+        DAQmxStopTask(self.handle)
+        DAQmxClearTask(self.handle)
+
+def readLines(lines, sample):
+    """
+    On demand read of lines (comma separated) into sample with a throwaway task,
+    only while no task of ours holds them.
+    """
+    handle = TaskHandle()
+    DAQmxCreateTask("", byref(handle))
+    DAQmxCreateDIChan(handle, lines, "", DAQmx_Val_ChanPerLine)
+    DAQmxReadDigitalLines(handle, 1, 1, DAQmx_Val_GroupByScanNumber, sample, sample.size, None, None, None)
+    DAQmxClearTask(handle)
+
+class NIDAQChangeDetection(object):
+    """
+    The change detection task of the DAQ device. NI devices have a single change
+    detection engine, so every input line opened with onChange shares this task
+    and the events are routed to the NIDAQInput of the line that changed. Adding
+    or removing a line recreates the task with the new line list; the levels are
+    read while no task holds the lines.
+    """
+    def __init__(self):
+        self.inputs = []
+        self.active = []                                # lines of the running task, in channel order
+        self.handle = None
+        self.lock = threading.Lock()
+        # keep a reference to the ctypes callback or it will be garbage collected
+        self.changeCallback = DAQmxSignalEventCallbackPtr(self.changeDetected)
+
+    def add(self, line):
+        """
+        Adds line (a NIDAQInput). Returns False if the board has no change detection,
+        the task then keeps running for the lines it had.
+        """
+        with self.lock:
+            self.clear()
+            try:
+                self.start(self.inputs + [line])
+            except DAQError as err:
+                print str(datetime.datetime.now())[:-3], "Change detection unavailable on", line.line, err
+                self.clear()
+                if self.inputs:
+                    self.start(self.inputs)
+                return False
+            self.inputs.append(line)
+            return True
+
+    def remove(self, line):
+        with self.lock:
+            self.clear()
+            self.inputs.remove(line)
+            if self.inputs:
+                self.start(self.inputs)
+
+    def start(self, inputs):
+        lines = ','.join(line.line for line in inputs)
+        self.sample = np.zeros((len(inputs),), dtype=np.uint8)
+        readLines(lines, self.sample)
+        stamp = monotonic()
+        handle = TaskHandle()
+        DAQmxCreateTask("", byref(handle))
+        try:
+            DAQmxCreateDIChan(handle, lines, "", DAQmx_Val_ChanPerLine)
+            DAQmxCfgChangeDetectionTiming(handle, lines, lines, DAQmx_Val_ContSamps, 8)
+            DAQmxRegisterSignalEvent(handle, DAQmx_Val_ChangeDetectionEvent, 0, self.changeCallback, None)
+            DAQmxStartTask(handle)
+        except DAQError:
+            DAQmxClearTask(handle)
+            raise
+        self.active = list(inputs)
+        self.handle = handle
+        for line, level in zip(inputs, self.sample):
+            line.changed(int(level), stamp)
+
+    def clear(self):
+        if self.handle is not None:
+            DAQmxStopTask(self.handle)
+            DAQmxClearTask(self.handle)
+            self.handle = None
+
+    def changeDetected(self, taskHandle, status, callbackData):
+        """
+        DAQmx change detection event, called from the DAQmx driver thread.
+        """
+        stamp = monotonic()
+        try:
+            DAQmxReadDigitalLines(taskHandle, 1, 0, DAQmx_Val_GroupByScanNumber, self.sample, self.sample.size, \
+                                  None, None, None)
+        except DAQError as err:
+            print "DAQmx Error: %s"%err
+            return 0
+        for line, level in zip(self.active, self.sample):
+            line.changed(int(level), stamp)
+        return 0 # The function should return an integer
+
+class NIDAQInput(object):
+    """
+    DI line. If onChange is given, the line joins the change detection task of
+    the device (e.g. USB-6221); boards without change detection fall back to an
+    on demand read task of its own.
+    """
+    def __init__(self, line, onChange = None, changeTask = None):
+        self.line = line
+        self.onChange = onChange
+        self.level = None
+        self.sample = np.zeros((1,), dtype=np.uint8)    # preallocated read buffer
+        self.changeTask = changeTask
+        self.changeDetection = False
+        if onChange is not None and changeTask is not None:
+            self.changeDetection = changeTask.add(self)
+        if not self.changeDetection:
+            self.handle = TaskHandle()
+            DAQmxCreateTask("", byref(self.handle))
+            DAQmxCreateDIChan(self.handle, self.line, "", DAQmx_Val_ChanForAllLines)
+            DAQmxStartTask(self.handle)
+
+    def changed(self, level, stamp):
+        """
+        Level from the change detection task, the first one is the level the line had when the task started.
+        """
+        previous, self.level = self.level, level
+        if previous is not None and level != previous:
+            self.onChange(level, stamp)
+
+    def read(self):
+        """
+        Level of the line. With change detection running the task is hardware
+        timed, so the level of the last change event is returned.
+        """
+        if self.changeDetection:
+            return self.level
+        DAQmxReadDigitalLines(self.handle, 1, 1, 0, self.sample, 1, None, None, None)
+        return int(self.sample[0])
+
+    def close(self):
+        if self.changeDetection:
+            self.changeTask.remove(self)
+        else:
+            DAQmxStopTask(self.handle)
+            DAQmxClearTask(self.handle)
+
+class NIDAQSampledInput(object):
+    """
+    DI task continuously sampling lines (ExpOk and optionally the ExpReq
+    loopback) into a preallocated circular buffer. Boards with a DI sample
+    clock are hardware timed at rate and read in chunks, sample n is stamped
+    anchor + n / rate. The anchor is the first sample (read when the task
+    starts) and is moved every ANCHOR_INTERVAL to the smallest lag seen between
+    a read returning and its last sample, so the sample clock doesn't drift
+    away from monotonic. Others (e.g. USB-6501), or boards whose sample clocked
+    task fails to verify or start, are read on demand one sample at a time,
+    paced at rate and stamped with the middle of the read. Edges of the first
+    line are found with a numpy diff per read.
+    """
+    changeDetection = True
+    CHUNK = 256                                         # samples per hardware timed read
+    ANCHOR_INTERVAL = 1.0                               # hardware timed sample clock re-anchor period (s)
+
+    def __init__(self, lines, onChange, rate, size):
+        self.lines = lines
+        self.onChange = onChange
+        self.rate = rate
+        self.ring = np.zeros((size, len(lines)), dtype=np.uint8)
+        self.stamps = np.zeros(size)
+        self.total = 0                                  # samples stored since start
+        self.offsets = np.arange(self.CHUNK)
+        self.chunk = np.zeros((self.CHUNK, len(lines)), dtype=np.uint8)
+        self.sample = np.zeros((1, len(lines)), dtype=np.uint8)
+        self.read32 = int32()
+        self.bytesPerSample = int32()
+        self.lock = threading.Lock()
+        self.running = True
+        try:
+            self.handle = self.start(True, size)
+            self.hardwareTimed = True
+        except DAQError as err:
+            print str(datetime.datetime.now())[:-3], "No DI sample clock, software timed sampling of", lines, err
+            self.handle = self.start(False, size)
+            self.hardwareTimed = False
+        self.readSamples(self.sample, 1)
+        self.anchor = monotonic()                       # time of sample anchorIndex
+        self.anchorIndex = 0
+        self.level = int(self.sample[0, 0])
+        self.store(self.sample, [self.anchor])
+        self.tid = threading.Thread(target = self.acquire, args = ())
+        self.tid.daemon = True
+        self.tid.start()
+
+    def start(self, sampleClock, size):
+        """
+        Creates, verifies and starts the DI task, with the DI sample clock at
+        rate if sampleClock. The task is cleared again if any step fails.
+        """
+        handle = TaskHandle()
+        DAQmxCreateTask("", byref(handle))
+        try:
+            DAQmxCreateDIChan(handle, ','.join(self.lines), "", DAQmx_Val_ChanForAllLines)
+            if sampleClock:
+                DAQmxCfgSampClkTiming(handle, "", self.rate, DAQmx_Val_Rising, DAQmx_Val_ContSamps, size)
+            DAQmxTaskControl(handle, DAQmx_Val_Task_Verify)
+            DAQmxStartTask(handle)
+        except DAQError:
+            DAQmxClearTask(handle)
+            raise
+        return handle
+
+    def readSamples(self, buf, count):
+        DAQmxReadDigitalLines(self.handle, count, 10.0, DAQmx_Val_GroupByScanNumber, buf, buf.size, \
+                              byref(self.read32), byref(self.bytesPerSample), None)
+
+    def acquire(self):
+        lag = None                                      # smallest read lag since the last re-anchor
+        anchored = self.anchor
+        period = 1.0 / self.rate
+        nextRead = self.anchor + period                 # software timed read schedule
+        while self.running:
+            try:
+                if self.hardwareTimed:
+                    self.readSamples(self.chunk, self.CHUNK)
+                    now = monotonic()
+                    stamps = self.anchor + (self.total - self.anchorIndex + self.offsets) / self.rate
+                    self.store(self.chunk, stamps)
+                    lag = now - stamps[-1] if lag is None else min(lag, now - stamps[-1])
+                    if now - anchored >= self.ANCHOR_INTERVAL:
+                        # lost samples (buffer overflow) and clock drift show up as a lag change
+                        self.anchor, self.anchorIndex = stamps[-1] + lag, self.total - 1
+                        anchored, lag = now, None
+                else:
+                    before = monotonic()
+                    if before < nextRead:
+                        time.sleep(nextRead - before)
+                        before = monotonic()
+                    # a late read restarts the schedule rather than catching up in a burst
+                    nextRead = max(nextRead, before) + period
+                    self.readSamples(self.sample, 1)
+                    self.store(self.sample, [(before + monotonic()) / 2])
+            except DAQError as err:
+                print "DAQmx Error: %s"%err
+                time.sleep(period)
+
+    def store(self, samples, stamps):
+        n = len(samples)
+        with self.lock:
+            index = (self.total + self.offsets[:n]) % len(self.ring)
+            self.ring[index] = samples
+            self.stamps[index] = stamps
+            self.total += n
+        line = samples[:, 0]
+        edges = np.flatnonzero(np.diff(np.concatenate(([self.level], line))))
+        self.level = int(line[-1])
+        for edge in edges:
+            self.onChange(int(line[edge]), stamps[edge])
+
+    def read(self):
+        return self.level
+
+    def samples(self, t0, t1, points):
+        """
+        (sample times, samples) of all lines between t0 and t1, reduced to at
+        most points samples, empty if that part of the trace was overwritten.
+        """
+        with self.lock:
+            count = min(self.total, len(self.ring))
+            order = (self.total - count + np.arange(count)) % len(self.ring)
+            stamps = self.stamps[order]
+            first, last = np.searchsorted(stamps, [t0, t1])
+            pick = order[first:last]
+            if len(pick) > points:
+                pick = pick[np.linspace(0, len(pick) - 1, points).astype(int)]
+            return self.stamps[pick], self.ring[pick]
+
+    def close(self):
+        self.running = False
+        self.tid.join(1.0)
+        DAQmxStopTask(self.handle)
+        DAQmxClearTask(self.handle)
+
+class NIDAQBackend(object):
+    """
+    PyDAQmx backend for the NI USB DAQ connected to the PaxScan.
+    """
+    name = 'NIDAQ'
+
+    def __init__(self):
+        self.changeTask = None                          # shared by all change detection inputs
+
+    def openOutput(self, line):
+        return NIDAQOutput(line)
+
+    def openInput(self, line, onChange = None):
+        if onChange is not None and self.changeTask is None:
+            self.changeTask = NIDAQChangeDetection()
+        return NIDAQInput(line, onChange, self.changeTask)
+
+    def openSampledInput(self, lines, onChange, rate, size):
+        return NIDAQSampledInput(lines, onChange, rate, size)
+
+class SimulatedLine(object):
+    """
+    One digital line of the simulated backend. Edges are pushed to every
+    registered onChange callback, so inputs always report changeDetection.
+    """
+    changeDetection = True
+
+    def __init__(self, backend, line):
+        self.backend = backend
+        self.line = line
+        self.level = 0
+        self.listeners = []
+
+    def read(self):
+        return self.level
+
+    def write(self, value):
+        self.backend.setLine(self.line, int(bool(value)))
+
+    def close(self):
+        pass
+
+class SimulatedSampledInput(object):
+    """
+    Sampled input of the simulated backend. Line edges are kept with their
+    time and samples() builds the trace at evenly spaced times from them.
+    """
+    changeDetection = True
+
+    def __init__(self, backend, lines, onChange):
+        self.lines = [backend.getLine(line) for line in lines]
+        self.edges = [([0.0], [sim.level]) for sim in self.lines]
+        for n, sim in enumerate(self.lines):
+            sim.listeners.append(lambda level, stamp, n = n: self.lineChanged(n, level, stamp, onChange))
+
+    def lineChanged(self, n, level, stamp, onChange):
+        self.edges[n][0].append(stamp)
+        self.edges[n][1].append(level)
+        if n == 0:
+            onChange(level, stamp)
+
+    def read(self):
+        return self.lines[0].level
+
+    def samples(self, t0, t1, points):
+        stamps = np.linspace(t0, t1, points)
+        trace = np.zeros((points, len(self.lines)), dtype=np.uint8)
+        for n, (times, levels) in enumerate(self.edges):
+            trace[:, n] = np.array(levels, dtype=np.uint8)[np.searchsorted(times, stamps, 'right') - 1]
+        return stamps, trace
+
+    def close(self):
+        pass
+
+class SimulatedPanel(object):
+    """
+    In-process stand-in for the PaxScan handshake. expOkDelay seconds after
+    ExpReq goes high ExpOk is raised, and exposureTime seconds later it drops.
+    Every line transition is appended to events as (line, level, timestamp).
+    """
+    def __init__(self, expReq, expOk, expOkDelay = 0.05, exposureTime = 0.2):
+        self.expReq = expReq
+        self.expOk = expOk
+        self.expOkDelay = expOkDelay
+        self.exposureTime = exposureTime
+        self.events = []
+        self.backend = None
+
+    def attach(self, backend):
+        self.backend = backend
+
+    def lineChanged(self, line, level, stamp):
+        self.events.append((line, level, stamp))
+        if line == self.expReq and level == 1:
+            self.eid = threading.Thread(target = self.expose, args = ())
+            self.eid.daemon = True
+            self.eid.start()
+
+    def expose(self):
+        time.sleep(self.expOkDelay)
+        self.backend.setLine(self.expOk, 1)
+        time.sleep(self.exposureTime)
+        self.backend.setLine(self.expOk, 0)
+
+class SimulatedBackend(object):
+    """
+    DAQ backend without hardware. Lines live in memory and optional
+    SimulatedPanels (one per detector channel) react to writes on their ExpReq line.
+    """
+    name = 'SIM'
+
+    def __init__(self, panel = None):
+        self.lines = {}
+        self.lock = threading.Lock()
+        self.panels = []
+        if panel is not None:
+            self.addPanel(panel)
+
+    def addPanel(self, panel):
+        panel.attach(self)
+        self.panels.append(panel)
+
+    def getLine(self, line):
+        with self.lock:
+            if line not in self.lines:
+                self.lines[line] = SimulatedLine(self, line)
+            return self.lines[line]
+
+    def setLine(self, line, level):
+        stamp = monotonic()
+        sim = self.getLine(line)
+        if sim.level == level:
+            return
+        sim.level = level
+        for listener in list(sim.listeners):
+            listener(level, stamp)
+        for panel in self.panels:
+            panel.lineChanged(line, level, stamp)
+
+    def openOutput(self, line):
+        return self.getLine(line)
+
+    def openInput(self, line, onChange = None):
+        sim = self.getLine(line)
+        if onChange is not None:
+            sim.listeners.append(onChange)
+        return sim
+
+    def openSampledInput(self, lines, onChange, rate = None, size = None):
+        return SimulatedSampledInput(self, lines, onChange)
+
+def getBackend(name, expReq = None, expOk = None, expOkDelay = 0.05, exposureTime = 0.2):
+    """
+    Returns a backend instance by name ('NIDAQ' or 'SIM'). The simulated backend
+    gets a SimulatedPanel on the given ExpReq/ExpOk lines, or one per pair if
+    lists of lines are given (several detector channels).
+    """
+    if name == 'SIM':
+        sim = SimulatedBackend()
+        if expReq is not None:
+            if not isinstance(expReq, (list, tuple)):
+                expReq, expOk = [expReq], [expOk]
+            for req, ok in zip(expReq, expOk):
+                sim.addPanel(SimulatedPanel(req, ok, expOkDelay, exposureTime))
+        return sim
+    return NIDAQBackend()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""
+Linux real-time helpers for varianSync and the timing process.
+__author__   =   Andrew A. Gomella
+__status__   =   Development R2.1
+
+Python 2 has no os.sched_* calls, so the scheduler, affinity and memory locking
+system calls go through libc with ctypes. Scheduler and affinity apply to the
+calling thread (and the threads it starts later), so they are called from the
+timing critical threads themselves. Nothing raises: every call returns a short
+status for the iocStats records, so an IOC started without CAP_SYS_NICE or
+CAP_IPC_LOCK (or on Windows) still comes up and reports what it got.
+"""
+
+import ctypes, ctypes.util, os, sys
+
+SCHED_OTHER = 0
+SCHED_FIFO  = 1
+SCHED_RR    = 2
+POLICIES    = {'OTHER' : SCHED_OTHER, 'FIFO' : SCHED_FIFO, 'RR' : SCHED_RR}
+MCL_CURRENT = 1
+MCL_FUTURE  = 2
+
+class SchedParam(ctypes.Structure):
+    _fields_ = [('sched_priority', ctypes.c_int)]
+
+if sys.platform.startswith('linux'):
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno = True)
+else:
+    libc = None
+
+def failed():
+    return 'failed: ' + os.strerror(ctypes.get_errno())
+
+def setScheduler(policy, priority):
+    """
+    Scheduling policy ('FIFO', 'RR' or 'OTHER') and real time priority (1..99,
+    ignored for OTHER) of the calling thread. Returns e.g. 'FIFO 50'.
+    """
+    if libc is None:
+        return 'unsupported'
+    param = SchedParam(0 if policy == 'OTHER' else priority)
+    if libc.sched_setscheduler(0, POLICIES[policy], ctypes.byref(param)) != 0:
+        return failed()
+    return '%s %d' % (policy, param.sched_priority)
+
+def setAffinity(cpus):
+    """
+    Restricts the calling thread to cpus (list of cpu numbers). Returns e.g. '2,3'.
+    """
+    if libc is None:
+        return 'unsupported'
+    mask = (ctypes.c_ulong * 16)()                      # cpu_set_t, 1024 cpus
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), mask) != 0:
+        return failed()
+    return ','.join(str(cpu) for cpu in cpus)
+
+def lockMemory():
+    """
+    mlockall current and future pages of the process, so exposures don't page fault.
+    """
+    if libc is None:
+        return 'unsupported'
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+        return failed()
+    return 'locked'
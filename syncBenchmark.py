@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+"""
+End to end sync latency benchmark for varianSync.
+__author__   =   Andrew A. Gomella
+__status__   =   Development R2.1
+
+Runs the varianSync driver against the simulated DAQ backend (daqBackend.SimulatedPanel)
+and a local pcaspy stand-in for the X-ray and detector IOCs, drives PaxscanShutter
+writes through Channel Access and reports p50/p99/max of
+    ExpReq -> ExpOk             (panel handshake as seen on the DAQ lines)
+    ExpOk -> X-ray firing       (negative when the source was already firing)
+    ExpOk off -> X-ray off
+usage:
+    python syncBenchmark.py [-n 50] [--xsync 2] [--ramp 0.2] [--delay 0.05] [--exposure 0.2]
+    python syncBenchmark.py --timing       (handshake in the timing process, timingProcess.py)
+    python syncBenchmark.py --ioc          (stand-in IOC only, started automatically)
+"""
+
+import os
+# the stand-in and the driver serve the production PV names, keep Channel Access on
+# this host so neither reaches (or answers) the real IOCs. Set before pyepics/pcaspy
+# are loaded, the stand-in IOC process inherits them.
+os.environ['EPICS_CA_AUTO_ADDR_LIST'] = 'NO'
+os.environ['EPICS_CA_ADDR_LIST'] = '127.255.255.255'
+os.environ['EPICS_CAS_INTF_ADDR_LIST'] = '127.0.0.1'
+
+from pcaspy import Driver, SimpleServer
+from epics import caget, caput
+import numpy as np
+import argparse, datetime, subprocess, sys, time
+import threading
+
+from daqBackend import monotonic
+
+EXPERIMENT = 'RAD:'
+BENCH_IOC  = EXPERIMENT + 'BENCH:'
+
+# stand-in records, names are relative to EXPERIMENT
+standInDb = {
+    # detector
+    'VARIAN:cam1:Acquire'           : {'type' : 'int'},
+    'VARIAN:cam1:VarianMode'        : {'type' : 'int'},
+    'VARIAN:cam1:VarianConfig'      : {'type' : 'int'},
+    'VARIAN:cam1:ImageMode'         : {'type' : 'int'},
+    'VARIAN:cam1:DoubleMode'        : {'type' : 'int'},
+    'VARIAN:cam1:AcquireTime_RBV'   : {'prec' : 3},
+    'VARIAN:TIFF1:FullFileName_RBV' : {'type' : 'string'},
+    'VARIAN:TIFF1:FilePath_RBV'     : {'type' : 'string'},
+    'VARIAN:Proc1:NumFilter'        : {'type' : 'int'},
+    # oxford/nova
+    'OXFORD:xray:STATUS_RBV'        : {'type' : 'int', 'value' : 1},
+    'OXFORD:xray:ON'                : {'type' : 'int'},
+    'OXFORD:xray:PULSE_MODE'        : {'type' : 'int'},
+    'OXFORD:xray:FIRING_RBV'        : {'type' : 'int'},
+    'OXFORD:xray:KVP_RBV'           : {'prec' : 1},
+    'OXFORD:xray:WATT_RBV'          : {'prec' : 1},
+    # sri
+    'SRI:xray:ON'                   : {'type' : 'int'},
+    'SRI:xray:KV_RBV'               : {'prec' : 1},
+    'SRI:xray:MA_RBV'               : {'prec' : 3},
+    # cpi
+    'cpiSync:RAD_PREP'              : {'type' : 'int'},
+    'cpiSync:EXPOSE'                : {'type' : 'int'},
+    'CPI:xray:GeneratorStatus'      : {'type' : 'int', 'value' : 3},
+    'CPI:xray:RadPrep'              : {'type' : 'int'},
+    'CPI:xray:ErrorLatching'        : {'type' : 'int'},
+    'CPI:xray:AcknowledgeError'     : {'type' : 'int'},
+    'CPI:xray:KVP_RBV'              : {'prec' : 1},
+    'CPI:xray:MA_RBV'               : {'prec' : 3},
+    # scans
+    'SCAN:scan1.BUSY'               : {'type' : 'int'},
+    'SCAN:scan2.BUSY'               : {'type' : 'int'},
+    'SCAN:scan3.BUSY'               : {'type' : 'int'},
+    'SCAN:scan4.BUSY'               : {'type' : 'int'},
+    'SCAN:scan1.T1PV'               : {'type' : 'string'},
+    # benchmark timestamps (daqBackend.monotonic() of the last source on/off transition, the edge clock)
+    'BENCH:FIRE_TIME'               : {'prec' : 6},
+    'BENCH:OFF_TIME'                : {'prec' : 6},
+}
+for m in range(1, 7):
+    for field in ['RBV', 'VAL', 'TWV', 'VELO', 'TWF', 'TWR']:
+        standInDb['NEWPORT:m%d.%s' % (m, field)] = {'prec' : 4}
+    standInDb['NEWPORT:m%d.DMOV' % m] = {'type' : 'int', 'value' : 1}
+
+class standInDriver(Driver):
+    """
+    Minimal X-ray source behaviour: the source starts firing ramp seconds after it is
+    turned on (ON, PULSE_MODE 0 or EXPOSE) and stops immediately when turned off.
+    """
+    def __init__(self, ramp):
+        super(standInDriver, self).__init__()
+        self.ramp = ramp
+
+    def write(self, reason, value):
+        self.setParam(reason, value)
+        if reason in ('OXFORD:xray:ON', 'SRI:xray:ON'):
+            if value == 1:
+                self.rampUp(reason.split(':')[0])
+            else:
+                self.fire(reason.split(':')[0], 0)
+        elif reason == 'OXFORD:xray:PULSE_MODE':
+            if value == 0:
+                self.rampUp('OXFORD')
+            else:
+                self.fire('OXFORD', 0, status = 3)
+        elif reason == 'cpiSync:RAD_PREP':
+            if value == 1:
+                self.rampUp('CPI')
+            else:
+                self.setParam('CPI:xray:RadPrep', 0)
+        elif reason == 'cpiSync:EXPOSE':
+            self.fire('CPI', value)
+        self.updatePVs()
+        return True
+
+    def rampUp(self, source):
+        tid = threading.Timer(self.ramp, self.fire, args = (source, 1))
+        tid.daemon = True
+        tid.start()
+
+    def fire(self, source, on, status = 1):
+        if source == 'OXFORD':
+            self.setParam('OXFORD:xray:FIRING_RBV', on)
+            self.setParam('OXFORD:xray:STATUS_RBV', 2 if on else status)
+        elif source == 'CPI' and on and self.getParam('cpiSync:EXPOSE') == 0:
+            # prep finished, the generator only fires on EXPOSE
+            self.setParam('CPI:xray:RadPrep', 2)
+            self.updatePVs()
+            return
+        self.setParam('BENCH:FIRE_TIME' if on else 'BENCH:OFF_TIME', monotonic())
+        self.updatePVs()
+
+def processForever(server):
+    # process CA transactions
+    while True:
+        server.process(0.01)
+
+def runStandIn(ramp):
+    server = SimpleServer()
+    server.createPV(EXPERIMENT, standInDb)
+    driver = standInDriver(ramp)
+    processForever(server)
+
+def waitForChange(pv, old, timeout):
+    """
+    caget pv until it is no longer old, None on timeout.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        value = caget(pv)
+        if value != old:
+            return value
+        time.sleep(0.005)
+    return None
+
+def stats(label, values):
+    values = np.array(values)
+    if len(values) == 0:
+        print '%-28s  no samples' % label
+        return
+    print '%-28s  p50 %9.3f ms   p99 %9.3f ms   max %9.3f ms' % \
+          (label, np.percentile(values, 50) * 1e3, np.percentile(values, 99) * 1e3, values.max() * 1e3)
+
+def runBenchmark(args):
+    # stand-in IOC for the x-ray source/detector in its own process
+    ioc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--ioc', '--ramp', str(args.ramp)])
+    try:
+        import varianSync, daqBackend, timingProcess
+        expReq, expOk = varianSync.EXP_REQ, varianSync.EXP_OK
+        if args.timing:
+            # the simulated panel lives in the timing process, line events come back through the event ring
+            sim = timingProcess.TimingBackend(('SIM', expReq, expOk, args.delay, args.exposure), [expReq], [expOk], \
+                                              releases = {expReq : expOk})
+            events = []
+            for line in (expReq, expOk):
+                sim.addListener(line, lambda level, stamp, line = line: events.append((line, level, stamp)))
+        else:
+            panel = daqBackend.SimulatedPanel(expReq, expOk, args.delay, args.exposure)
+            sim = daqBackend.SimulatedBackend(panel)
+            events = panel.events
+        server = SimpleServer()
+        server.createPV(varianSync.prefix, varianSync.pvdb)
+        driver = varianSync.myDriver(daq = sim)
+        sid = threading.Thread(target = processForever, args = (server,))
+        sid.daemon = True
+        sid.start()
+        caput(varianSync.prefix + 'XSYNC', args.xsync, wait = True)
+        reqToOk, okToFire, offToOff, cycle = [], [], [], []
+        for i in range(args.n):
+            del events[:]
+            lastOff = caget(BENCH_IOC + 'OFF_TIME')
+            caput(EXPERIMENT + 'VARIAN:cam1:Acquire', 1, wait = True)
+            start = time.time()
+            caput(varianSync.prefix + 'PaxscanShutter', 1)
+            # the handshake is done once ExpReq is low again, the source goes off after the tail hold
+            while not [e for e in events if e[0] == expReq and e[1] == 0]:
+                if time.time() - start > args.timeout:
+                    print 'cycle', i, 'timed out'
+                    break
+                time.sleep(0.001)
+            caput(EXPERIMENT + 'VARIAN:cam1:Acquire', 0, wait = True)
+            edges = dict(((e[0], e[1]), e[2]) for e in events)
+            if (expOk, 0) not in edges:
+                continue
+            cycle.append(time.time() - start)
+            reqToOk.append(edges[(expOk, 1)] - edges[(expReq, 1)])
+            if args.xsync != 0:
+                okToFire.append(caget(BENCH_IOC + 'FIRE_TIME') - edges[(expOk, 1)])
+                offTime = waitForChange(BENCH_IOC + 'OFF_TIME', lastOff, args.timeout)
+                if offTime is None:
+                    print 'cycle', i, 'timed out waiting for the x-ray off'
+                else:
+                    offToOff.append(offTime - edges[(expOk, 0)])
+        print '############################################################################'
+        print '## varianSync benchmark', str(datetime.datetime.now())[:-3], \
+              'XSYNC', args.xsync, 'cycles', len(cycle), 'timing process' if args.timing else ''
+        print '############################################################################'
+        stats('ExpReq -> ExpOk', reqToOk)
+        stats('ExpOk -> X-ray firing', okToFire)
+        stats('ExpOk off -> X-ray off', offToOff)
+        stats('PaxscanShutter cycle', cycle)
+        if args.timing:
+            sim.stop()
+    finally:
+        ioc.terminate()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'varianSync sync latency benchmark')
+    parser.add_argument('--ioc', action = 'store_true', help = 'run the stand-in IOC only')
+    parser.add_argument('-n', type = int, default = 50, help = 'number of exposure cycles')
+    parser.add_argument('--xsync', type = int, default = 2, help = '0 NONE, 1 SRI, 2 OXFORD, 3 CPI')
+    parser.add_argument('--ramp', type = float, default = 0.2, help = 'stand-in source ramp time (s)')
+    parser.add_argument('--delay', type = float, default = 0.05, help = 'simulated ExpReq -> ExpOk delay (s)')
+    parser.add_argument('--exposure', type = float, default = 0.2, help = 'simulated ExpOk on time (s)')
+    parser.add_argument('--timing', action = 'store_true', help = 'run the DAQ handshake in the timing process')
+    parser.add_argument('--timeout', type = float, default = 10.0, help = 'per cycle timeout (s)')
+    args = parser.parse_args()
+    if args.ioc:
+        runStandIn(args.ramp)
+    else:
+        runBenchmark(args)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+
+"""
+Coroutine engine for the varianSync exposure sequences.
+__author__   =   Andrew A. Gomella
+__status__   =   Development R2.1
+
+Sequences are written once as generator based coroutines which yield Wait objects
+(sleep, waitLevel, waitUntil, waitSignal) or other coroutines, and can raise Return(value):
+
+    def sequence(self):
+        yield sleep(0.01)
+        stamp = yield waitLevel(self.expOk, 1, timeout = 5.0)
+        yield self.otherSequence()
+        raise Return(stamp)
+
+They run either blocking on a worker thread (runBlocking, THREADS engine) or all
+together on a single EventLoop thread which also processes the pcaspy server
+(LOOP engine). On the loop, waits are plain checks of the ExpOk watcher / PV cache
+state, so no thread is blocked and nothing needs locking. While tasks wait, the
+loop polls the server and sleeps on a doorbell which ExpOk edges, PV cache
+updates and posted calls ring (wake), so it checks the tasks right away instead
+of on its next period. Tasks can be cancelled, which raises Cancelled inside the
+coroutine so its finally blocks run.
+
+A timed Condition.wait polls with sleeps of up to 50 ms on Python 2, so blocking
+waits (runBlocking, Signal.wait and waitCondition users) wait on their condition
+without a timeout. A single deadlines thread notifies the condition when the
+timeout is up, and Task.cancel notifies the condition its task is blocked on.
+"""
+
+from multiprocessing import Semaphore
+import datetime, heapq, time, traceback, types
+import threading, Queue
+
+LOOP_PERIOD      = 0.001                  # pcaspy poll period while sequences are running (s), or a wake
+LOOP_IDLE_PERIOD = 0.01                   # ... and while idle, same as the THREADS main loop
+
+class Return(Exception):
+    """
+    Raised by a coroutine to return a value to the coroutine (or runBlocking) that yielded it.
+    """
+    def __init__(self, value = None):
+        Exception.__init__(self)
+        self.value = value
+
+class Cancelled(Exception):
+    """
+    Raised inside a coroutine when its task is cancelled.
+    """
+
+class Deadlines(object):
+    """
+    Timer thread which notifies a Condition once its deadline (time.time) is up,
+    for waits blocked in an untimed Condition.wait. It sleeps on a semaphore
+    until the earliest deadline, rung when an earlier one is added.
+    """
+    def __init__(self):
+        self.heap = []                                  # (deadline, id, [deadline, cond])
+        self.lock = threading.Lock()
+        self.doorbell = Semaphore(0)
+        self.thread = None
+
+    def add(self, deadline, cond):
+        entry = [deadline, cond]
+        with self.lock:
+            heapq.heappush(self.heap, (deadline, id(entry), entry))
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, name = 'deadlines')
+                self.thread.daemon = True
+                self.thread.start()
+            earliest = self.heap[0][2] is entry
+        if earliest:
+            self.doorbell.release()
+        return entry
+
+    def remove(self, entry):
+        # dropped from the heap when it comes up
+        entry[1] = None
+
+    def run(self):
+        while True:
+            due = []
+            with self.lock:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2][1])
+                timeout = self.heap[0][0] - now if self.heap else None
+            for cond in due:
+                if cond is not None:
+                    with cond:
+                        cond.notify_all()
+            if not due:
+                self.doorbell.acquire(True, timeout)
+
+deadlines = Deadlines()
+
+def waitCondition(cond, predicate, timeout = None):
+    """
+    Call with cond held: blocks until predicate() returns something else than
+    None, which is returned, or timeout (s) is up (None). predicate is
+    re-evaluated whenever cond is notified.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    entry = None
+    try:
+        while True:
+            result = predicate()
+            if result is not None:
+                return result
+            if deadline is not None:
+                if time.time() >= deadline:
+                    return None
+                if entry is None:
+                    entry = deadlines.add(deadline, cond)
+            cond.wait()
+    finally:
+        if entry is not None:
+            deadlines.remove(entry)
+
+class Signal(object):
+    """
+    Event set from any thread (pcaspy writes, ExpOk watcher listeners) which
+    coroutines wait for with waitSignal. Every set() is counted, so a waiter
+    passes the count it has seen and is only woken by later sets.
+    """
+    def __init__(self):
+        self.count = 0
+        self.stamp = 0.0
+        self.cond = threading.Condition()
+
+    def set(self, stamp = None):
+        with self.cond:
+            self.count += 1
+            self.stamp = time.time() if stamp is None else stamp
+            self.cond.notify_all()
+
+    def wait(self, since, timeout = None):
+        """
+        Block until set() was called more than since times. Returns the time of the last set() or None on timeout.
+        """
+        with self.cond:
+            return waitCondition(self.cond, lambda: self.stamp if self.count > since else None, timeout)
+
+class Wait(object):
+    """
+    Something a coroutine waits for. check() returns the result once the wait is
+    over or None, it changes under cond which is notified when it may have, so a
+    thread blocks on cond. waiting(count), if given, is called with cond held
+    with 1 and -1 around blocking. timeoutResult is sent back on timeout.
+    """
+    def __init__(self, check, cond, timeout = None, timeoutResult = None, waiting = None):
+        self.check = check
+        self.cond = cond
+        self.timeout = timeout
+        self.timeoutResult = timeoutResult
+        self.waiting = waiting
+        self.deadline = None
+
+    def start(self):
+        self.deadline = None if self.timeout is None else time.time() + self.timeout
+
+    def remaining(self):
+        return None if self.deadline is None else max(0.0, self.deadline - time.time())
+
+    def expired(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+def sleep(seconds):
+    return Wait(lambda: None, threading.Condition(), seconds, True)
+
+def waitLevel(watcher, level, timeout = None):
+    """
+    Wait for an ExpOkWatcher line level, the result is the edge timestamp (None on timeout).
+    """
+    return Wait(lambda: watcher.edgeTime[level] if watcher.level == level else None, \
+                watcher.cond, timeout, None, watcher.waiting)
+
+def waitUntil(cache, condition, timeout = None):
+    """
+    Wait until condition() is true, re-evaluated on PV cache updates. The result is False on timeout.
+    """
+    return Wait(lambda: True if condition() else None, cache.cond, timeout, False)
+
+def waitSignal(signal, since, timeout = None):
+    """
+    Wait for a Signal set after set number since, the result is its timestamp (None on timeout).
+    """
+    return Wait(lambda: signal.stamp if signal.count > since else None, signal.cond, timeout, None)
+
+class Task(object):
+    """
+    A coroutine and the stack of coroutines it is currently waiting on.
+    unstarted() is called if the task is cancelled before the coroutine
+    started, its finally blocks never run then (e.g. to complete a put).
+    """
+    def __init__(self, coroutine, name = '', unstarted = None):
+        self.name = name
+        self.stack = [coroutine]
+        self.unstarted = unstarted
+        self.started = False
+        self.wait = None
+        self.result = None
+        self.done = False
+        self.cancelled = False
+        self.blocked = None                             # condition runBlocking is waiting on
+        self.lane = None
+
+    def step(self, value = None, exc = None):
+        """
+        Runs the coroutine until its next Wait, which is returned (None when finished).
+        """
+        if not self.started:
+            self.started = True
+            if isinstance(exc, Cancelled) and self.unstarted is not None:
+                self.unstarted()
+        while self.stack:
+            gen = self.stack[-1]
+            try:
+                if exc is not None:
+                    item, exc = gen.throw(exc), None
+                else:
+                    item = gen.send(value)
+            except StopIteration:
+                self.stack.pop()
+                value = None
+                continue
+            except Return as ret:
+                self.stack.pop()
+                value = ret.value
+                continue
+            except Exception as err:
+                self.stack.pop()
+                if not self.stack:
+                    self.done = True
+                    raise
+                exc = err
+                continue
+            value = None
+            if isinstance(item, types.GeneratorType):
+                self.stack.append(item)
+                continue
+            item.start()
+            self.wait = item
+            return item
+        self.done = True
+        self.result = value
+        return None
+
+    def cancel(self):
+        """
+        Thread safe, Cancelled is raised at the next Wait (or before the first step).
+        """
+        self.cancelled = True
+        cond = self.blocked
+        if cond is not None:
+            with cond:
+                cond.notify_all()
+
+    def takeCancel(self):
+        """
+        Cancelled if the task was cancelled, else None. The flag is reset, so the
+        waits of finally/except blocks cleaning up after it are not cancelled again.
+        """
+        if not self.cancelled:
+            return None
+        self.cancelled = False
+        return Cancelled()
+
+def runBlocking(coroutine):
+    """
+    Runs a coroutine (or a Task, which can be cancelled from another thread) to
+    completion on the calling thread and returns its result, None if cancelled.
+    """
+    task = coroutine if isinstance(coroutine, Task) else Task(coroutine)
+    result = None
+    try:
+        while True:
+            wait = task.step(result, task.takeCancel())
+            if wait is None:
+                return task.result
+            with wait.cond:
+                # set before the cancelled check, Task.cancel reads it after setting the flag
+                task.blocked = wait.cond
+                if wait.waiting is not None:
+                    wait.waiting(1)
+                try:
+                    result = waitCondition(wait.cond, lambda: False if task.cancelled else wait.check(), \
+                                           wait.remaining())
+                finally:
+                    task.blocked = None
+                    if wait.waiting is not None:
+                        wait.waiting(-1)
+            if result is None:
+                result = wait.timeoutResult
+    except Cancelled:
+        print str(datetime.datetime.now())[:-3], 'Sequence', task.name, 'cancelled'
+
+class EventLoop(object):
+    """
+    Single thread event loop: processes the pcaspy server, runs calls posted
+    from other threads (pyepics callbacks, timers) and advances every task whose
+    Wait is over or timed out.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.tasks = []
+        self.lanes = {}                                 # lane name -> tasks waiting for their turn
+        self.calls = Queue.Queue()
+        # a real semaphore, Condition.wait with a timeout polls on Python 2
+        self.doorbell = Semaphore(0)
+
+    def spawn(self, coroutine, name = '', lane = None, unstarted = None):
+        """
+        Starts a coroutine on the loop, thread safe. Tasks spawned on the same
+        lane run one after another, like the dispatcher lanes. Returns its Task.
+        """
+        task = Task(coroutine, name, unstarted)
+        task.lane = lane
+        self.callSoon(self.enqueue, task)
+        return task
+
+    def enqueue(self, task):
+        if task.lane is None:
+            self.advance(task)
+            return
+        pending = self.lanes.setdefault(task.lane, [])
+        pending.append(task)
+        if len(pending) == 1:
+            self.advance(task)
+
+    def callSoon(self, func, *args):
+        """
+        Runs func(*args) on the loop thread, thread safe.
+        """
+        self.calls.put((func, args))
+        self.wake()
+
+    def wake(self):
+        """
+        Something a task may wait for happened (ExpOk edge, PV cache update), thread safe.
+        """
+        self.doorbell.release()
+
+    def advance(self, task, value = None, exc = None):
+        try:
+            wait = task.step(value, exc or task.takeCancel())
+        except Cancelled:
+            print str(datetime.datetime.now())[:-3], 'Sequence', task.name, 'cancelled'
+            wait = None
+        except Exception:
+            print str(datetime.datetime.now())[:-3], 'Sequence', task.name, 'failed'
+            traceback.print_exc()
+            wait = None
+        if wait is None:
+            if task in self.tasks:
+                self.tasks.remove(task)
+            if task.lane is not None:
+                # start the next task of the lane
+                pending = self.lanes[task.lane]
+                pending.remove(task)
+                if pending:
+                    self.advance(pending[0])
+        elif task not in self.tasks:
+            self.tasks.append(task)
+
+    def runOnce(self):
+        if self.tasks:
+            self.server.process(0)
+            self.doorbell.acquire(True, LOOP_PERIOD)
+        else:
+            self.server.process(LOOP_IDLE_PERIOD)
+        while self.doorbell.acquire(False):
+            pass
+        while True:
+            try:
+                func, args = self.calls.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+        now = time.time()
+        for task in list(self.tasks):
+            if task.cancelled:
+                self.advance(task)
+                continue
+            result = task.wait.check()
+            if result is None and task.wait.expired(now):
+                result = task.wait.timeoutResult
+            if result is not None:
+                self.advance(task, result)
+
+    def run(self):
+        while True:
+            self.runOnce()
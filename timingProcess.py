@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+"""
+Real-time timing process for varianSync.
+__author__   =   Andrew A. Gomella
+__status__   =   Development R2.1
+
+With TIMING_PROCESS the ExpReq/ExpOk handshake runs in a child process of its own
+instead of next to the pcaspy server, pyepics callbacks, documentation and autosave
+threads, so their GIL use does not show up as exposure sync jitter. The child owns
+the DAQ lines (any daqBackend backend, opened in the child), is pinned to a CPU at
+high priority, polls the inputs and writes the outputs. It only talks to the parent
+through shared memory:
+    command ring    parent -> child     (output, value) ExpReq writes
+    event ring      child -> parent     (line, level, timestamp) input edges and
+                                        output write acks, timestamped in the child
+                                        (daqBackend.monotonic, the same clock in both)
+    levels          last level of every line
+The rings are single producer/single consumer: the producer alone writes the head
+counter and the consumer alone the tail counter, so neither process takes a lock.
+The child posts a semaphore after each event so the parent reader doesn't poll.
+It posts the input levels it reads at start up as events too, and TimingBackend
+only returns once they have arrived, so levels are valid before a line is opened.
+The end of an exposure is handled in the child as well: an output released by
+the parent (release, ExpReq of a single rad exposure) is written low by the
+child itself on the next falling edge of its paired input (ExpOk), without a
+round trip through the parent.
+TimingBackend is the parent side and looks like any other daqBackend backend.
+Run as a script, it checks the release against a simulated panel (exit code 1 on failure).
+"""
+
+from multiprocessing import Process, RawArray, RawValue, Semaphore
+import datetime, os, sys, time
+import threading
+import psutil
+
+import daqBackend
+import realtime
+
+RING_SIZE       = 1024                    # slots of the command and event rings
+POLL_INTERVAL   = 0.00005                 # child input poll/command check period (s), 0 spins
+READ_TIMEOUT    = 0.1                     # parent reader wake up period without events (s)
+START_TIMEOUT   = 10.0                    # max wait (s) for the initial levels from the timing process
+RELEASE         = -1                      # command value: drop the output on the next falling edge of its input
+
+class SharedRing(object):
+    """
+    Fixed size ring of width float slots in shared memory for one producer
+    and one consumer (process or thread). put() returns False when full.
+    """
+    def __init__(self, size = RING_SIZE, width = 3):
+        self.size = size
+        self.width = width
+        self.slots = RawArray('d', size * width)
+        self.head = RawValue('L', 0)                    # written by the producer only
+        self.tail = RawValue('L', 0)                    # written by the consumer only
+
+    def put(self, *values):
+        head = self.head.value
+        if head - self.tail.value >= self.size:
+            return False
+        base = (head % self.size) * self.width
+        self.slots[base:base + self.width] = values
+        self.head.value = head + 1
+        return True
+
+    def get(self):
+        """
+        Oldest entry as a list of width floats, None if the ring is empty.
+        """
+        tail = self.tail.value
+        if tail == self.head.value:
+            return None
+        base = (tail % self.size) * self.width
+        values = self.slots[base:base + self.width]
+        self.tail.value = tail + 1
+        return values
+
+def setRealtime(cpu, sched = None, memoryLock = False):
+    """
+    Pin the calling process to cpu (None leaves the affinity alone) and raise its
+    priority. On Linux sched = (policy, priority) is applied and with memoryLock
+    the memory is locked.
+    """
+    p = psutil.Process(os.getpid())
+    if cpu is not None:
+        try:
+            p.cpu_affinity([cpu])
+        except AttributeError:
+            p.set_cpu_affinity([cpu])                   # psutil < 2.0
+        except Exception as err:
+            print str(datetime.datetime.now())[:-3], "Timing process: could not pin to cpu", cpu, err
+    try:
+        sys.getwindowsversion()
+    except:
+        try:
+            os.nice(-20)
+        except OSError:
+            print str(datetime.datetime.now())[:-3], "Timing process: could not set high priority"
+        if sched is not None:
+            print str(datetime.datetime.now())[:-3], "Timing process: scheduler", realtime.setScheduler(*sched)
+        if memoryLock:
+            print str(datetime.datetime.now())[:-3], "Timing process: memory", realtime.lockMemory()
+    else:
+        try:
+            p.set_nice(psutil.REALTIME_PRIORITY_CLASS)
+        except:
+            print str(datetime.datetime.now())[:-3], "Timing process: failed setting realtime priority, need to run ioc as admin"
+
+def timingMain(backendArgs, outputs, inputs, releases, commands, events, levels, doorbell, running, overruns, cpu, \
+               sched, memoryLock, pollInterval):
+    """
+    Child process: line n of outputs + inputs is line index n in the rings and levels.
+    releases maps an output index to the input index whose falling edge drops it.
+    """
+    setRealtime(cpu, sched, memoryLock)
+    daq = daqBackend.getBackend(*backendArgs)
+    outs = [daq.openOutput(line) for line in outputs]
+    ins = [daq.openInput(line) for line in inputs]
+    armed = set()                                       # released outputs waiting for their input to fall
+    def post(index, level, stamp):
+        levels[index] = level
+        if events.put(index, level, stamp):
+            doorbell.release()
+        else:
+            overruns.value += 1
+    for n, line in enumerate(ins):
+        post(len(outs) + n, line.read(), daqBackend.monotonic())
+    while running.value:
+        command = commands.get()
+        while command is not None:
+            index, value = int(command[0]), int(command[1])
+            if value == RELEASE:
+                armed.add(index)
+            else:
+                if value == 0:
+                    # written low before its input fell
+                    armed.discard(index)
+                outs[index].write(value)
+                post(index, value, daqBackend.monotonic())
+            command = commands.get()
+        for n, line in enumerate(ins):
+            level = line.read()
+            if level != levels[len(outs) + n]:
+                stamp = daqBackend.monotonic()
+                dropped = [index for index in armed if releases[index] == len(outs) + n] if level == 0 else []
+                for index in dropped:
+                    outs[index].write(0)
+                    armed.discard(index)
+                post(len(outs) + n, level, stamp)
+                for index in dropped:
+                    post(index, 0, daqBackend.monotonic())
+        if pollInterval:
+            time.sleep(pollInterval)
+    for line in outs + ins:
+        line.close()
+
+class TimingOutput(object):
+    """
+    Parent side output line, writes are queued to the timing process.
+    """
+    def __init__(self, backend, index):
+        self.backend = backend
+        self.index = index
+
+    def write(self, value):
+        self.backend.command(self.index, int(bool(value)))
+
+    def read(self):
+        return self.backend.levels[self.index]
+
+    def close(self):
+        pass
+
+class TimingInput(object):
+    """
+    Parent side input line. Edges are delivered with the timestamp taken in the timing process.
+    """
+    changeDetection = True
+
+    def __init__(self, backend, index):
+        self.backend = backend
+        self.index = index
+
+    def read(self):
+        return self.backend.levels[self.index]
+
+    def close(self):
+        pass
+
+class TimingBackend(object):
+    """
+    daqBackend style backend whose lines live in the timing process. backendArgs
+    are the daqBackend.getBackend arguments of the backend the child opens, the
+    output and input lines have to be known up front. releases pairs an output
+    line with the input line whose falling edge drops it after release(). sched
+    is the Linux (policy, priority) of the timing process and memoryLock locks
+    its memory, see realtime.py.
+    """
+    name = 'TIMING'
+
+    def __init__(self, backendArgs, outputs, inputs, cpu = None, sched = None, memoryLock = False, \
+                 pollInterval = POLL_INTERVAL, releases = None):
+        self.lines = list(outputs) + list(inputs)
+        self.releases = dict((self.lines.index(output), self.lines.index(line)) \
+                             for output, line in (releases or {}).items())
+        self.commands = SharedRing(width = 2)
+        self.events = SharedRing(width = 3)
+        self.levels = RawArray('b', len(self.lines))
+        self.doorbell = Semaphore(0)
+        self.running = RawValue('b', 1)
+        self.overruns = RawValue('L', 0)                # events lost because the parent fell behind
+        self.commandLock = threading.Lock()             # several exposure lanes write ExpReq
+        self.listeners = dict((index, []) for index in range(len(self.lines)))
+        self.pending = set(range(len(outputs), len(self.lines)))    # inputs without their initial level yet
+        self.started = threading.Event()
+        self.process = Process(target = timingMain, args = (backendArgs, list(outputs), list(inputs), \
+                               self.releases, self.commands, self.events, self.levels, self.doorbell, \
+                               self.running, self.overruns, cpu, sched, memoryLock, pollInterval))
+        self.process.daemon = True
+        self.process.start()
+        print str(datetime.datetime.now())[:-3], 'Timing process started, pid', self.process.pid
+        self.rid = threading.Thread(target = self.readEvents, args = ())
+        self.rid.daemon = True
+        self.rid.start()
+        # the input lines are opened (and their level read) right after this
+        if not self.pending:
+            self.started.set()
+        if not self.started.wait(START_TIMEOUT):
+            print str(datetime.datetime.now())[:-3], 'Timing process: no initial levels from', \
+                  [self.lines[index] for index in sorted(self.pending)]
+
+    def command(self, index, value):
+        with self.commandLock:
+            while not self.commands.put(index, value):
+                time.sleep(POLL_INTERVAL)
+
+    def readEvents(self):
+        """
+        Drains the event ring and calls the listeners of each line with (level, timestamp).
+        """
+        while self.running.value:
+            self.doorbell.acquire(True, READ_TIMEOUT)
+            event = self.events.get()
+            while event is not None:
+                index, level, stamp = int(event[0]), int(event[1]), event[2]
+                if index in self.pending:
+                    self.pending.discard(index)
+                    if not self.pending:
+                        self.started.set()
+                for listener in list(self.listeners[index]):
+                    listener(level, stamp)
+                event = self.events.get()
+
+    def release(self, line):
+        """
+        The timing process writes output line low itself on the next falling edge
+        of its paired input, unless it is written low before. Queued like a write,
+        so call it before the high write.
+        """
+        self.command(self.lines.index(line), RELEASE)
+
+    def addListener(self, line, func):
+        """
+        Register func(level, timestamp) for every edge of an input or acknowledged write of an output.
+        """
+        self.listeners[self.lines.index(line)].append(func)
+
+    def openOutput(self, line):
+        return TimingOutput(self, self.lines.index(line))
+
+    def openInput(self, line, onChange = None):
+        if onChange is not None:
+            self.addListener(line, onChange)
+        return TimingInput(self, self.lines.index(line))
+
+    def stop(self):
+        self.running.value = 0
+        self.process.join(1.0)
+
+def checkRelease(timeout = 5.0):
+    """
+    Drives one simulated exposure through a timing process with ExpReq released
+    on ExpOk falling. True if the child dropped ExpReq by itself, after ExpOk fell.
+    """
+    expReq, expOk = 'sim/expReq', 'sim/expOk'
+    backend = TimingBackend(('SIM', expReq, expOk, 0.01, 0.05), [expReq], [expOk], releases = {expReq : expOk})
+    events = []
+    done = threading.Event()
+    def listener(line, level, stamp):
+        events.append((line, level))
+        if line == expReq and level == 0:
+            done.set()
+    for line in (expReq, expOk):
+        backend.addListener(line, lambda level, stamp, line = line: listener(line, level, stamp))
+    try:
+        backend.release(expReq)
+        backend.openOutput(expReq).write(1)
+        done.wait(timeout)
+    finally:
+        backend.stop()
+    ok = events == [(expReq, 1), (expOk, 1), (expOk, 0), (expReq, 0)]
+    print str(datetime.datetime.now())[:-3], 'ExpReq release', 'ok' if ok else 'FAILED', events
+    return ok
+
+if __name__ == '__main__':
+    sys.exit(0 if checkRelease() else 1)
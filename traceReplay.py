@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+"""
+Record and replay of varianSync event traces.
+__author__   =   Andrew A. Gomella
+__status__   =   Development R2.1
+
+With TRACE_FILE set in varianSync.py the driver logs every inbound CA monitor
+update (PVCache), pcaspy write and DAQ line read (level changes)/write/edge with a monotonic
+timestamp to a compact binary trace. The replayer feeds a trace back through a
+driver running against the simulated DAQ backend and simulated PV's, at the
+recorded speed or faster, and compares the ExpReq writes the driver makes with
+the recorded ones. Waits inside the sequences (tail hold, timeouts) are wall
+clock, so accelerated replays are meant for the event ordering, not the timing.
+usage:
+    python traceReplay.py varianSync.trace [--speed 10] [--dump]
+    python traceReplay.py [check.trace] --check
+--check records a few rad exposures of a driver on the simulated panel and
+replays the fresh trace, which has to match.
+
+Trace format, little endian, after the 8 byte TRACE_MAGIC:
+    STRING record   kind (u1) = STRING, id (u4), length (u4), utf-8 bytes
+    event record    kind (u1), monotonic time (f8), name id (u4), value type (u1), value (f8)
+                    TEXT values follow the record as utf-8 bytes, value is their length
+Names are interned as STRING records the first time they appear. String values
+(file names, ...) are written inline, so the string table only grows with the
+number of PV's, lines and records.
+"""
+
+import argparse, datetime, os, struct, subprocess, sys, time
+import threading
+
+from daqBackend import monotonic
+
+TRACE_MAGIC  = 'VSTRACE2'
+STRING       = 0
+MONITOR      = 1                              # CA monitor update seen by the PV cache
+WRITE        = 2                              # pcaspy write
+DAQ_READ     = 3                              # on demand DAQ line read
+DAQ_WRITE    = 4                              # DAQ line write (ExpReq)
+DAQ_EDGE     = 5                              # DAQ change detection edge
+KIND_NAMES   = {MONITOR : 'MONITOR', WRITE : 'WRITE', DAQ_READ : 'DAQ_READ', \
+                DAQ_WRITE : 'DAQ_WRITE', DAQ_EDGE : 'DAQ_EDGE'}
+# value types
+NUMBER, TEXT, NONE = 0, 1, 2
+
+EVENT_RECORD  = struct.Struct('<BdIBd')
+STRING_HEADER = struct.Struct('<BII')
+
+class TraceRecorder(object):
+    """
+    Appends events to a binary trace file, thread safe. Called from the CA,
+    DAQ and pcaspy threads, so a record is only a struct pack and a buffered write,
+    and a failing write (e.g. disk full) is counted instead of raised to the caller.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(TRACE_MAGIC)
+        self.ids = {}
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+
+    def intern(self, text):
+        # called with the lock held
+        if text not in self.ids:
+            data = text.encode('utf-8')
+            self.file.write(STRING_HEADER.pack(STRING, len(self.ids), len(data)) + data)
+            self.ids[text] = len(self.ids)
+        return self.ids[text]
+
+    def record(self, kind, name, value):
+        stamp = monotonic()
+        with self.lock:
+            if self.file is None:
+                return
+            text = ''
+            if isinstance(value, (bool, int, long, float)):
+                vtype, number = NUMBER, float(value)
+            elif isinstance(value, basestring):
+                text = value.encode('utf-8') if isinstance(value, unicode) else value
+                vtype, number = TEXT, float(len(text))
+            else:
+                # waveforms and unconnected values are not traced
+                vtype, number = NONE, 0.0
+            try:
+                self.file.write(EVENT_RECORD.pack(kind, stamp, self.intern(name), vtype, number) + text)
+            except (IOError, struct.error) as err:
+                if not self.errors:
+                    print str(datetime.datetime.now())[:-3], 'Trace', self.path, 'write failed:', err
+                self.errors += 1
+                return
+            self.count += 1
+
+    def monitor(self, name, value, charValue = None):
+        if not isinstance(value, (bool, int, long, float, basestring)) and charValue is not None:
+            value = charValue
+        self.record(MONITOR, name, value)
+
+    def write(self, reason, value):
+        self.record(WRITE, reason, value)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        print str(datetime.datetime.now())[:-3], 'Trace', self.path, 'closed,', self.count, 'events', \
+              self.errors, 'lost'
+
+def readTrace(path):
+    """
+    Generator of (time, kind, name, value) for every event of a trace file.
+    """
+    strings = {}
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise IOError('%s is not a varianSync trace' % path)
+        while True:
+            kind = f.read(1)
+            if not kind:
+                return
+            if ord(kind) == STRING:
+                sid, length = STRING_HEADER.unpack(kind + f.read(STRING_HEADER.size - 1))[1:]
+                strings[sid] = f.read(length).decode('utf-8')
+                continue
+            kind, stamp, nameId, vtype, number = EVENT_RECORD.unpack(kind + f.read(EVENT_RECORD.size - 1))
+            if vtype == NUMBER:
+                value = number
+            elif vtype == TEXT:
+                value = f.read(int(number)).decode('utf-8', 'replace')
+            else:
+                value = None
+            yield stamp, kind, strings[nameId], value
+
+class RecordingLine(object):
+    """
+    DAQ line wrapper which traces writes and forwards to the real line. Reads
+    are only traced when the level changed, the ExpOk poll reads continuously.
+    Writes too: outputs start low, like the simulated lines of a replay, which
+    only report changes (e.g. the driver's start up ExpReq 0 is not traced).
+    """
+    def __init__(self, line, name, recorder):
+        self.lineObject = line
+        self.line = name
+        self.recorder = recorder
+        self.changeDetection = getattr(line, 'changeDetection', False)
+        self.lastRead = None
+        self.lastWrite = 0
+
+    def read(self):
+        level = self.lineObject.read()
+        if level != self.lastRead:
+            self.lastRead = level
+            self.recorder.record(DAQ_READ, self.line, level)
+        return level
+
+    def write(self, value):
+        level = int(bool(value))
+        if level != self.lastWrite:
+            self.lastWrite = level
+            self.recorder.record(DAQ_WRITE, self.line, level)
+        self.lineObject.write(value)
+
+    def samples(self, t0, t1, points):
+        return self.lineObject.samples(t0, t1, points)
+
+    def close(self):
+        self.lineObject.close()
+
+class RecordingBackend(object):
+    """
+    Wraps a DAQ backend (see daqBackend.py) so every line access goes to the trace.
+    """
+    def __init__(self, backend, recorder):
+        self.backend = backend
+        self.recorder = recorder
+        self.name = backend.name
+
+    def openOutput(self, line):
+        return RecordingLine(self.backend.openOutput(line), line, self.recorder)
+
+    def openInput(self, line, onChange = None):
+        if onChange is not None:
+            def traced(level, stamp, onChange = onChange):
+                self.recorder.record(DAQ_EDGE, line, level)
+                onChange(level, stamp)
+            return RecordingLine(self.backend.openInput(line, traced), line, self.recorder)
+        return RecordingLine(self.backend.openInput(line), line, self.recorder)
+
+    def openSampledInput(self, lines, onChange, rate, size):
+        def traced(level, stamp, onChange = onChange):
+            self.recorder.record(DAQ_EDGE, lines[0], level)
+            onChange(level, stamp)
+        return RecordingLine(self.backend.openSampledInput(lines, traced, rate, size), lines[0], self.recorder)
+
+class SimulatedPV(object):
+    """
+    Stand-in for a pyepics PV in a replay. It is always connected, its value
+    only changes when the replayer posts a traced monitor update, and puts
+    from the driver are kept in puts instead of going to channel access.
+    """
+    def __init__(self, pvname, callback = None, value = None):
+        self.pvname = pvname
+        self.callbacks = [callback] if callback is not None else []
+        self.value = value
+        self.puts = []
+
+    def wait_for_connection(self, timeout = None):
+        return True
+
+    def get(self, as_string = False, use_monitor = True, **kw):
+        return str(self.value) if as_string and self.value is not None else self.value
+
+    def put(self, value, wait = False, **kw):
+        self.puts.append((monotonic(), value))
+        return True
+
+    def add_callback(self, callback, **kw):
+        self.callbacks.append(callback)
+
+    def post(self, value):
+        self.value = value
+        for callback in self.callbacks:
+            callback(pvname = self.pvname, value = value, char_value = str(value))
+
+class SimulatedPVs(object):
+    """
+    Registry of SimulatedPV's, passed to PVCache as its PV factory.
+    """
+    def __init__(self):
+        self.pvs = {}
+
+    def create(self, pvname, callback = None, **kw):
+        pv = self.pvs.get(pvname)
+        if pv is None:
+            pv = self.pvs[pvname] = SimulatedPV(pvname)
+        if callback is not None:
+            pv.add_callback(callback)
+        return pv
+
+    def post(self, pvname, value):
+        self.create(pvname).post(value)
+
+class Replayer(object):
+    """
+    Feeds a trace back through a driver: monitor updates go to the simulated
+    PV's, pcaspy writes to driver.write and DAQ edges/reads of input lines to
+    the simulated backend. DAQ writes are not replayed, they are what the
+    driver produces and are collected for the comparison with the trace.
+    """
+    def __init__(self, driver, sim, pvs, speed = 1.0):
+        self.driver = driver
+        self.sim = sim
+        self.pvs = pvs
+        self.speed = speed
+        self.written = []                               # (replay time, line, level) of driver DAQ writes
+        self.outputs = set()
+        self.start = None
+
+    def watchOutput(self, line):
+        if line not in self.outputs:
+            self.outputs.add(line)
+            self.sim.getLine(line).listeners.append(lambda level, stamp: \
+                                                    self.written.append((monotonic(), line, level)))
+
+    def run(self, events):
+        """
+        Replays the events, returns the DAQ writes of the trace as (time since
+        the first event scaled by speed, line, level).
+        """
+        recorded = []
+        self.start, first = monotonic(), None
+        for stamp, kind, name, value in events:
+            if first is None:
+                first = stamp
+            wait = (stamp - first) / self.speed - (monotonic() - self.start)
+            if wait > 0:
+                time.sleep(wait)
+            if kind == MONITOR:
+                self.pvs.post(name, value)
+            elif kind == WRITE:
+                self.driver.write(name, value)
+            elif kind in (DAQ_EDGE, DAQ_READ) and name not in self.outputs:
+                self.sim.setLine(name, int(value))
+            elif kind == DAQ_WRITE:
+                self.watchOutput(name)
+                recorded.append(((stamp - first) / self.speed, name, int(value)))
+        return recorded
+
+    def replayed(self):
+        """
+        DAQ writes of the driver so far, as (time since the start of the replay, line, level).
+        """
+        return [(written - self.start, line, level) for written, line, level in self.written]
+
+def compare(recorded, replayed):
+    """
+    Prints the DAQ writes of the trace next to the ones of the replay.
+    Returns True if both have the same lines and levels in the same order.
+    """
+    same = [(line, level) for t, line, level in recorded] == [(line, level) for t, line, level in replayed]
+    print '%-28s  %-6s  %12s  %12s  %10s' % ('line', 'level', 'trace (s)', 'replay (s)', 'diff (ms)')
+    for n in range(max(len(recorded), len(replayed))):
+        trace = recorded[n] if n < len(recorded) else (float('nan'), '-', -1)
+        replay = replayed[n] if n < len(replayed) else (float('nan'), '-', -1)
+        print '%-28s  %-6s  %12.6f  %12.6f  %10.3f' % (trace[1] if trace[1] != '-' else replay[1], \
+              trace[2] if trace[2] >= 0 else replay[2], trace[0], replay[0], (replay[0] - trace[0]) * 1e3)
+    print 'DAQ writes', 'match the trace' if same else 'DIFFER from the trace'
+    return same
+
+def processForever(server):
+    # process CA transactions
+    while True:
+        server.process(0.01)
+
+def dumpTrace(path):
+    for stamp, kind, name, value in readTrace(path):
+        print '%14.6f  %-9s  %-40s  %s' % (stamp, KIND_NAMES.get(kind, kind), name, value)
+
+def localChannelAccess():
+    # the driver serves the production PV names and anything not in the trace must not
+    # reach the real IOCs, keep Channel Access on this host (before pyepics/pcaspy load)
+    os.environ['EPICS_CA_AUTO_ADDR_LIST'] = 'NO'
+    os.environ['EPICS_CA_ADDR_LIST'] = '127.255.255.255'
+    os.environ['EPICS_CAS_INTF_ADDR_LIST'] = '127.0.0.1'
+
+def replayTrace(path, speed):
+    """
+    Replays a trace through a fresh driver on the simulated DAQ backend. Returns
+    True if the driver made the same DAQ writes as in the trace.
+    """
+    localChannelAccess()
+    from pcaspy import SimpleServer
+    import varianSync, daqBackend
+    events = list(readTrace(path))
+    pvs = SimulatedPVs()
+    sim = daqBackend.SimulatedBackend()
+    server = SimpleServer()
+    server.createPV(varianSync.prefix, varianSync.pvdb)
+    driver = varianSync.myDriver(daq = sim, cache = varianSync.PVCache(pvFactory = pvs.create))
+    sid = threading.Thread(target = processForever, args = (server,))
+    sid.daemon = True
+    sid.start()
+    replayer = Replayer(driver, sim, pvs, speed)
+    # outputs are known from the trace up front so their edges are never replayed as inputs
+    for stamp, kind, name, value in events:
+        if kind == DAQ_WRITE:
+            replayer.watchOutput(name)
+    recorded = replayer.run(events)
+    # let the last sequence finish
+    time.sleep(1.0)
+    print '############################################################################'
+    print '## varianSync replay', path, str(datetime.datetime.now())[:-3], 'speed', speed, \
+          'events', len(events)
+    print '############################################################################'
+    return compare(recorded, replayer.replayed())
+
+def recordCheckTrace(path, exposures = 3, timeout = 5.0):
+    """
+    Records a trace of a few rad exposures (dark, XSYNC NONE) of a fresh driver
+    on a simulated panel and simulated PV's. Returns True if every exposure
+    dropped ExpReq within timeout.
+    """
+    localChannelAccess()
+    from pcaspy import SimpleServer
+    import varianSync, daqBackend
+    varianSync.TRACE_FILE = path
+    pvs = SimulatedPVs()
+    panel = daqBackend.SimulatedPanel(varianSync.EXP_REQ, varianSync.EXP_OK, 0.02, 0.05)
+    server = SimpleServer()
+    server.createPV(varianSync.prefix, varianSync.pvdb)
+    cache = varianSync.PVCache(pvFactory = pvs.create)
+    driver = varianSync.myDriver(daq = daqBackend.SimulatedBackend(panel), cache = cache)
+    cache.recorder = driver.recorder
+    sid = threading.Thread(target = processForever, args = (server,))
+    sid.daemon = True
+    sid.start()
+    det = driver.channels[0].det
+    for field, value in [('VarianConfig', 0), ('DoubleMode', 0), ('Acquire', 1)]:
+        pvs.post(det + 'cam1:' + field, value)
+    ok = True
+    for n in range(exposures):
+        driver.write('PaxscanShutter', 1)
+        deadline = time.time() + timeout
+        while len([level for line, level, stamp in panel.events if line == panel.expReq and level == 0]) <= n:
+            if time.time() > deadline:
+                print str(datetime.datetime.now())[:-3], 'Check exposure', n, 'timed out'
+                ok = False
+                break
+            time.sleep(0.01)
+        # let the sequence finish before the shutter closes
+        time.sleep(0.2)
+        driver.write('PaxscanShutter', 0)
+    driver.close()
+    return ok
+
+def checkTrace(path):
+    """
+    Records a trace (recordCheckTrace) and replays it in a fresh process, True
+    if both went through and the replay matches the trace.
+    """
+    if not recordCheckTrace(path):
+        return False
+    matched = subprocess.call([sys.executable, os.path.abspath(__file__), path]) == 0
+    print 'Fresh trace', path, 'replays as', 'MATCH' if matched else 'DIFFER'
+    return matched
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'varianSync trace replay')
+    parser.add_argument('trace', nargs = '?', default = 'check.trace', help = 'trace file recorded with TRACE_FILE')
+    parser.add_argument('--speed', type = float, default = 1.0, help = 'replay speed, 1 is as recorded')
+    parser.add_argument('--dump', action = 'store_true', help = 'print the trace instead of replaying it')
+    parser.add_argument('--check', action = 'store_true', help = 'record a trace on the simulated panel and replay it')
+    args = parser.parse_args()
+    if args.dump:
+        dumpTrace(args.trace)
+    elif args.check:
+        os._exit(0 if checkTrace(args.trace) else 1)
+    else:
+        os._exit(0 if replayTrace(args.trace, args.speed) else 1)
@@ -6,7 +6,7 @@ __author__   =   Andrew A. Gomella
 __status__   =   Development R2.1
 __to-do__    =   code clean up,
                  PV_LIST for param.txt file needs to be generalized somehow.
-                 debug flags, Fix double mode sync
+                 debug flags
 """
 """
 CHANGELOG:
@@ -40,108 +40,1383 @@ CHANGELOG:
                  new hardware alarm sound. Removed software based alarm sound.
 04/15/2016  (AP) scan detector PV is set to Varian acquire PV during varianSync startup, moved iocstats records to its
                  own seperate function.
+10/17/2026  (AP) ExpOk is now handled by a single long lived ExpOkWatcher which owns the DI task and timestamps
+                 rising/falling edges. Uses DAQmx change detection when the board supports it, otherwise one
+                 polling thread with a preallocated buffer, which only polls while ExpReq is high, ExpOk is
+                 on or a thread waits on an edge. waitForExpOkOn/Off block on the watcher.
+10/17/2026  (AP) DAQ access moved behind pluggable backends (daqBackend.py): NIDAQ for the USB DAQ and SIM for an
+                 in-process simulated PaxScan. syncBenchmark.py measures sync latency against a stand-in IOC.
+10/17/2026  (AP) X-ray source PV's are read from a monitor backed PVCache. startupXray waits on monitor updates
+                 (FIRING_RBV, RadPrep/ErrorLatching) with a timeout instead of caget polling every 10ms.
+10/17/2026  (AP) saveParams reads the documented motor readbacks and file names from the PV cache monitors
+                 (one snapshot under a lock) instead of one caget per PV.
+10/17/2026  (AP) added DOC_FORMAT record. TXT keeps one parameter .txt file per image, NPZ/HDF5 append one row per
+                 image to a per run table (<filename>_params.npz/.h5) keyed by tiff file number and full file name.
+                 The table of a run is continued after a restart and written out on a timer and on exit.
+10/17/2026  (AP) callbacks no longer start a new thread each. Exposure sequencing (PaxscanShutter) runs on a
+                 single serialized lane, live scans (SYNC_TRIGGER) on a lane of their own next to it, since they
+                 wait for the exposure they trigger. Documentation/filter resets run on a bounded I/O pool. Queue depth,
+                 queue latency and dropped task counters are published as EXP_* and IO_* records.
+10/17/2026  (AP) added KEEP_WARM, KEEP_WARM_IDLE, KEEP_WARM_RBV records. With KEEP_WARM ON and a scan busy the
+                 x-ray is left in pulse mode (oxford) or prep (cpi) between points, and is turned off when the
+                 scans finish, after the last point of scan1, or after KEEP_WARM_IDLE seconds without exposure.
+10/17/2026  (AP) added TAIL_MODE, TAIL_HOLD_SRI/OXFORD/CPI, TAIL_HOLD_RBV records replacing the fixed 1s x-ray
+                 hold after ExpOk goes off. ExpReq now goes low as soon as ExpOk goes off.
+10/17/2026  (AP) added PHASE_* records. Every rad/fluoro exposure cycle timestamps shutter request, acquire seen,
+                 x-ray ready, ExpReq high, ExpOk on/off, x-ray off and ExpReq low; latest values (ms from the
+                 shutter request) and min/mean/p99 over the last PHASE_HISTORY cycles are published. Phases,
+                 ExpOk edges and PV cache updates are stamped with the monotonic daqBackend.monotonic clock.
+10/17/2026  (AP) exposure sequences are now coroutines (syncEngine.py). ENGINE = 'THREADS' runs them on the
+                 exposure lane thread, ENGINE = 'LOOP' runs pcaspy, the sequences and posted callbacks on a
+                 single event loop, woken by ExpOk edges and PV monitors. Rad waits time out after RAD_TIMEOUT,
+                 EXP_CANCEL cancels the sequences of a channel (ExpReq is dropped, a firing source stopped).
+10/17/2026  (AP) PaxscanShutter is asyn. Fluoro x-ray start/stop runs on the exposure lane instead of inside the
+                 pcaspy write, and the put completes only when the x-ray is firing (or off).
+10/17/2026  (AP) x-ray sources are adapter classes (XraySource/SRISource/OxfordSource/CPISource) selected by XSYNC,
+                 with prepare/arm/fire/stop/status. Each adapter connects its PV's once, replacing the XRAY_IOC
+                 string concatenation and the XSYNC if-chains in startupXray/stopXrayFlux.
+10/17/2026  (AP) the x-ray source is switched (and its PV's connected) on an XSYNC write instead of polling
+                 XSYNC_RBV at 1Hz. The PV's connect in parallel on the I/O lane and the XSYNC put completes
+                 once the source is selected. XSYNC changes are refused while an exposure is running or the
+                 source is kept warm, again at the swap itself. Every sequence keeps the source it started
+                 with. XSYNC_RBV is no longer scanned and only posts the confirmed source.
+10/17/2026  (AP) live scan (SYNC_TRIGGER) takes the exposure time from cam1:AcquireTime_RBV for any Varian mode,
+                 moves every motor listed in LIVE_AXES, starts motion from the ExpOk watcher on the rising edge and
+                 publishes the motion vs exposure misalignment as LIVE_START_ERR/LIVE_END_ERR.
+10/17/2026  (AP) added HIST_* records. The last EXPOSURE_HISTORY exposures (start, ExpOk on time, XSYNC, Varian
+                 config/mode, ok) are kept in a ring buffer and published as waveforms. HIST_DUMP saves them to a
+                 text file in the image directory.
+10/17/2026  (AP) added LOAD_* records. kV and tube current (oxford: power) readbacks of the active source are
+                 integrated over every ExpOk window into on time, mAs and energy, with running totals per session
+                 (LOAD_SESSION_RESET starts a new one) and per day, kept across restarts by autosave.
+10/17/2026  (AP) one varianSync process drives several PaxScan panels (DETECTOR_CHANNELS). Each channel has its
+                 own ExpReq/ExpOk lines, detector prefix, exposure lane and PV sub prefix for PaxscanShutter, ExpOk,
+                 EXP_*, PHASE_* and HIST_*, so panels expose concurrently. The x-ray source is shared and only
+                 turned off when no other channel is exposing. Removed the VARIAN_PV/RAD/CONFIG module PV's.
+                 The ExpOk lines share the single change detection task of the NI device.
+10/17/2026  (AP) with TRACE_FILE set, CA monitor updates, pcaspy writes and DAQ line accesses are recorded to a
+                 binary trace (traceReplay.py), which can be replayed through the driver on the simulated DAQ
+                 backend and simulated PV's, comparing the ExpReq writes with the recorded ones.
+10/17/2026  (AP) added PREWARM records. The oxford ramp (standby or pulse mode to output) is started when an
+                 exposure is likely: cam1:Acquire armed, a scan started, or PREWARM_LEAD seconds before the next
+                 predicted scan point. An unused pre-warm goes back to standby after PREWARM_IDLE seconds.
+10/17/2026  (AP) added CPI_PREP_HOLD, CPI_PREP_HITS, CPI_PREP_MISSES records. With CPI_PREP_HOLD ON the CMP200
+                 stays in prep between shots (only EXPOSE toggles) and is released after KEEP_WARM_IDLE or at
+                 the end of its CPI_PREP_WINDOW. Shots served from a held prep count as hits.
+10/17/2026  (AP) double mode (cam1:DoubleMode) rad exposures keep the x-ray firing through both ExpOk windows and
+                 stop it after the PaxscanShutter 0 write from ADVarian. Driven by ExpOk edges and the shutter
+                 write (syncEngine.Signal) instead of polling the shutter state.
+10/17/2026  (AP) EXP_OK_SAMPLING: ExpOk (and the ExpReq loopback line, expReqLoop) sampled continuously into
+                 a circular buffer, hardware timed at EXP_OK_SAMPLE_RATE where the DAQ has a DI sample clock,
+                 with the ExpOk edges timestamped from the sample index (re-anchored to the monotonic clock
+                 every second), else read and timestamped one sample at a time. The line trace around every rad
+                 exposure is published to EXP_TRACE_OK/REQ, EXP_OK_WIDTH is the ExpOk on time.
+10/17/2026  (AP) TIMING_PROCESS: the DAQ lines are owned by a child process (timingProcess.py) pinned to
+                 TIMING_CPU at high priority, which polls ExpOk and writes ExpReq. The driver talks to it
+                 through shared memory command/event rings, edges keep the child's timestamps. The child
+                 drops ExpReq itself on the ExpOk falling edge of a single rad exposure.
+10/17/2026  (AP) Linux: exposure lane, ExpOk poll and timing process threads can run with SCHED_POLICY/
+                 SCHED_PRIORITY on EXPOSURE_CPUS, the process memory can be locked (MEMORY_LOCK) and the garbage
+                 collector turned off while exposing (GC_MODE). All opt-in, the defaults leave the scheduler,
+                 memory and collector alone. What was applied is shown in the RT_* records.
+10/17/2026  (AP) added BURST_* records. BURST_START runs BURST_COUNT rad exposures as one sequence on the exposure
+                 lane (no scan record), every BURST_PERIOD s, optionally stepping BURST_MOTOR by BURST_STEPS.
+                 The source stays ready between frames with the AUTO tail, the achieved frame periods (ExpOk
+                 rising edges) and their statistics are published when the burst is done. Trigger records
+                 (TRIGGER_PVS) read back 0 once taken and are left out of autosave.
                  
 """
 
 from pcaspy import Driver, SimpleServer, cas
 from epics import *
-from PyDAQmx import *
 import numpy as np
-import datetime, os, time, psutil
-import threading
+import datetime, gc, os, re, sys, time, psutil, traceback
+import threading, Queue
+try:
+    import h5py
+except ImportError:
+    # HDF5 documentation is optional, NPZ only needs numpy
+    h5py = None
 
 sys.path.append(os.path.realpath('../utils'))
 import epicsApps
+import daqBackend
+from daqBackend import monotonic
+import traceReplay
+import timingProcess
+import realtime
+from syncEngine import Cancelled, EventLoop, Return, Signal, Task, runBlocking, sleep, waitCondition, waitLevel, \
+                       waitSignal, waitUntil
 
 EXPERIMENT = 'RAD:'
 VARIAN_DAQ                  = 'paxscanSync'               # NIUSB DAQ name (default is Dev0, Dev1 etc)
+DAQ_BACKEND                 = 'NIDAQ'                     # 'NIDAQ' for the USB DAQ, 'SIM' for a simulated PaxScan
+ENGINE                      = 'THREADS'                   # 'THREADS' (worker lanes) or 'LOOP' (single event loop)
 EXP_OK                      = VARIAN_DAQ + "/port0/line1" # NIDAQ input line which checks for expose ok signal from the Varian 
 EXP_REQ                     = VARIAN_DAQ + "/port0/line0" # NIDAQ output line which sends an expose request to the Varian.
+EXP_OK_CHANGE_DETECTION     = True                        # use DAQmx change detection for ExpOk edges if the board has it
+EXP_OK_POLL_INTERVAL        = 0.0001                      # software poll period (s) when change detection is unavailable
+EXP_OK_SAMPLING             = False                       # sample ExpOk (and the ExpReq loopback) continuously, see EXP_TRACE_*
+                                                          # (not with TIMING_PROCESS)
+EXP_OK_SAMPLE_RATE          = 100000.0                    # DI sample clock (Hz) of the sampled ExpOk input
+EXP_OK_BUFFER               = 2**20                       # samples kept in the circular buffer (~10 s at 100 kHz)
+EXP_TRACE_POINTS            = 2000                        # points of the EXP_TRACE_* waveforms
+EXP_TRACE_MARGIN            = 0.05                        # trace before ExpReq high and after ExpReq low (s)
 # Main IOC records
-XRAY_IOC                    = EXPERIMENT + 'OXFORD:xray:'
 SCAN_IOC                    = EXPERIMENT + 'SCAN:'
 MOTOR_IOC                   = EXPERIMENT + 'NEWPORT:'
 DET_IOC                     = EXPERIMENT + 'VARIAN:'
-# Varian PaxScan 3024M callback PV's
-VARIAN_PV                   = PV(DET_IOC + 'cam1:Acquire', callback = True)
-VARIAN_FULL_FILENAME_RBV    = PV(DET_IOC + 'TIFF1:FullFileName_RBV', callback = True)
-VARIAN_RAD                  = PV(DET_IOC + 'cam1:VarianMode', callback = True)
-VARIAN_CONFIG               = PV(DET_IOC + 'cam1:VarianConfig', callback = True)
-VARIAN_IMAGEMODE            = PV(DET_IOC + 'cam1:ImageMode', callback = True)
-VARIAN_NUMFILTER            = PV(DET_IOC + 'Proc1:NumFilter', callback = False)
+CPI_IOC                     = EXPERIMENT + 'CPI:xray:'     # CPI-CMP200 generator status records
+XRAY_READY_TIMEOUT          = 30.0                        # max wait (s) for the x-ray source to reach set points
+CPI_PREP_WINDOW             = 10.0                        # longest time (s) the CMP200 may be held in prep
+CPI_PREP_RELEASE_DELAY      = 0.01                        # EXPOSE low -> RAD_PREP low (s)
+TAIL_AUTO_FRACTION          = 0.05                        # AUTO tail hold as a fraction of the measured ExpOk on time
+TAIL_AUTO_MIN               = 0.01                        # shortest AUTO tail hold (s)
+# Exposure time (s) per VarianMode, only used when the detector doesn't report cam1:AcquireTime_RBV
+VARIAN_MODE_EXPOSURE        = {1 : 2.0, 3 : 6.0}
+LIVE_TIMEOUT                = 60.0                        # max wait (s) for ExpOk/motion in a live (continuous) scan
+DOUBLE_MODE_TIMEOUT         = 30.0                        # max wait (s) for the next ExpOk edge/shutter close in double mode
+RAD_TIMEOUT                 = 30.0                        # max wait (s) for cam1:Acquire and each ExpOk edge of a rad exposure
+BURST_TIMEOUT               = 30.0                        # max wait (s) for readout, PaxscanShutter and motion in a burst
+BURST_MOVE_START            = 0.5                         # max wait (s) for a burst step move to start (DMOV 0)
+BURST_MAX_FRAMES            = 1000                        # length of the BURST_STEPS/BURST_PERIODS waveforms
+TRACE_FILE                  = None                        # e.g. 'varianSync.trace' records a replayable event trace
+TIMING_PROCESS              = False                       # run the ExpReq/ExpOk handshake in its own process (timingProcess.py)
+TIMING_CPU                  = None                        # cpu the timing process is pinned to, e.g. 3
+# Detector channels, one per PaxScan panel: PV sub prefix of its records ('' for the first panel,
+# e.g. 'B:' gives B:PaxscanShutter), detector IOC prefix and ExpReq/ExpOk DAQ lines. The optional
+# expReqLoop DI line (ExpReq wired back) is sampled next to ExpOk with EXP_OK_SAMPLING
+DETECTOR_CHANNELS = [
+                    {'name' : '',   'det' : DET_IOC, 'expReq' : EXP_REQ, 'expOk' : EXP_OK}, \
+#                   {'name' : 'B:', 'det' : EXPERIMENT + 'VARIAN2:', \
+#                    'expReq' : VARIAN_DAQ + "/port0/line2", 'expOk' : VARIAN_DAQ + "/port0/line3", \
+#                    'expReqLoop' : VARIAN_DAQ + "/port1/line0"}, \
+                    ]
+# Varian PaxScan 3024M callback PV's (documentation and filters, first panel), monitored
+# through the PV cache so they are traced and simulated in a replay like all the others
+VARIAN_FULL_FILENAME_RBV    = DET_IOC + 'TIFF1:FullFileName_RBV'
+VARIAN_IMAGEMODE            = DET_IOC + 'cam1:ImageMode'
+VARIAN_NUMFILTER            = DET_IOC + 'Proc1:NumFilter'
 
 # Scan busy PV's
-SCAN_BUSY_1                 = PV(SCAN_IOC + 'scan1.BUSY', callback = True)
-SCAN_BUSY_2                 = PV(SCAN_IOC + 'scan2.BUSY', callback = True)
-SCAN_BUSY_3                 = PV(SCAN_IOC + 'scan3.BUSY', callback = True)
-SCAN_BUSY_4                 = PV(SCAN_IOC + 'scan4.BUSY', callback = True)
-SCAN_DETECTOR_1             = PV(SCAN_IOC + 'scan1.T1PV', callback = False)
+SCAN_BUSY_1                 = SCAN_IOC + 'scan1.BUSY'
+SCAN_BUSY_2                 = SCAN_IOC + 'scan2.BUSY'
+SCAN_BUSY_3                 = SCAN_IOC + 'scan3.BUSY'
+SCAN_BUSY_4                 = SCAN_IOC + 'scan4.BUSY'
+SCAN_DETECTOR_1             = SCAN_IOC + 'scan1.T1PV'
+SCAN_BUSY_LIST              = [SCAN_BUSY_1, SCAN_BUSY_2, SCAN_BUSY_3, SCAN_BUSY_4]
+# scan1 progress, used to release the x-ray right after the last point of a scan
+SCAN_PROGRESS_LIST          = [SCAN_IOC + 'scan1.CPT', SCAN_IOC + 'scan1.NPTS']
 # If DOC is ON (1) save motor pv's.
 MOTOR_IOC_LIST = [
                     MOTOR_IOC + 'm1',  MOTOR_IOC + 'm2',  MOTOR_IOC + 'm3', \
                     MOTOR_IOC + 'm4',  MOTOR_IOC + 'm5',  MOTOR_IOC + 'm6', \
                  ]
+# PV's read for every documented image, kept connected and monitored by the PV cache
+DOC_PV_LIST = [pvs + '.RBV' for pvs in MOTOR_IOC_LIST]
+DOC_FILE_PV_LIST = [DET_IOC + 'TIFF1:FilePath_RBV', DET_IOC + 'TIFF1:FullFileName_RBV']
+DOC_FLUSH_ROWS              = 100                         # run table (NPZ/HDF5) is flushed every N images
+DOC_FLUSH_INTERVAL          = 30.0                        # ... or when the last flush is older than this (s)
+PHASE_HISTORY               = 1000                        # exposure cycles kept for the phase statistics
+EXPOSURE_HISTORY            = 1000                        # exposures kept in the HIST_* ring buffer
+LOAD_MAX_SAMPLES            = 4096                        # kV/current monitor samples integrated per ExpOk window
+# Exposure cycle phases, PHASE_* records and the PHASE_MIN/MEAN/P99 waveforms are in this order
+PHASE_LIST                  = ['SHUTTER', 'ACQUIRE', 'XRAY_READY', 'EXPREQ_HIGH', 'EXPOK_ON', 'EXPOK_OFF', \
+                               'XRAY_OFF', 'EXPREQ_LOW']
+# Dispatcher lanes: (number of worker threads, max queued tasks)
+EXPOSURE_LANE               = (1, 8)                      # exposure sequencing, strictly serialized
+IO_LANE                     = (4, 64)                     # documentation and other I/O work
+LIVE_LANE                   = 'LIVE:EXP'                  # live scans, next to the exposure sequence they trigger
+# Linux real-time settings (realtime.py), not used on Windows
+SCHED_POLICY                = 'OTHER'                     # policy of the exposure/ExpOk threads: 'FIFO', 'RR' or 'OTHER'
+SCHED_PRIORITY              = 50                          # SCHED_FIFO/RR priority (1..99)
+EXPOSURE_CPUS               = None                        # cpus of the exposure/ExpOk threads, e.g. [2, 3] (None: all)
+MEMORY_LOCK                 = False                       # mlockall, no page faults during exposures
+GC_MODE                     = 'ON'                        # garbage collector 'ON', 'OFF' or 'EXPOSURE' (off while exposing)
 # Additional PVs for x-ray sync and save motor/ps/xray PVs
 prefix = EXPERIMENT + 'VarianSync:'
 pvdb = {
-    'PaxscanShutter'        : {'asyn'  : False,},  # switches to 1 only when finished
+    'PaxscanShutter'        : {'asyn'  : True,},   # fluoro puts complete only when the x-ray is firing/off
     'ExpOk'                 : {'type'  : 'enum',
                                'enums' : ['OFF', 'ON'],
                                'value' : 0},
-    'XSYNC'                 : {'type'  : 'enum',
-                               'enums' : ['NONE', 'SRI', 'OXFORD', 'CPI']},
-    'XSYNC_RBV'             : {'type'  : 'enum',
+    'XSYNC'                 : {'type'  : 'enum',                # completes once the source is connected
                                'enums' : ['NONE', 'SRI', 'OXFORD', 'CPI'],
-                               'scan'  : 1},
+                               'asyn'  : True},
+    'XSYNC_RBV'             : {'type'  : 'enum',                # source confirmed by the XSYNC write
+                               'enums' : ['NONE', 'SRI', 'OXFORD', 'CPI']},
     'DOC'                   : {'type'  : 'enum',
                                'enums' : ['OFF', 'ON'] },
+    'DOC_FORMAT'            : {'type'  : 'enum',            # TXT: one .txt per image, NPZ/HDF5: one table per run
+                               'enums' : ['TXT', 'NPZ', 'HDF5']},
     'SYNC_TRIGGER'          : {'asyn'  : True},
+    # live (continuous) scan: axes moved by TWV during the exposure, e.g. 'm2' or 'm2,m3'
+    'LIVE_AXES'             : {'type'  : 'string', 'value' : 'm2'},
+    'LIVE_EXPOSURE_RBV'     : {'prec'  : 3, 'unit' : 's'},
+    'LIVE_START_ERR'        : {'prec'  : 3, 'unit' : 'ms'},   # motion start - ExpOk rising (worst axis)
+    'LIVE_END_ERR'          : {'prec'  : 3, 'unit' : 'ms'},   # motion end - ExpOk falling (worst axis)
+    # burst: BURST_COUNT rad exposures started every BURST_PERIOD s (0: back to back), BURST_MOTOR
+    # (e.g. 'm2', empty for none) moves by BURST_STEPS[n] (0: stays) before frame n. The put completes after the burst
+    'BURST_START'           : {'asyn'  : True},
+    'BURST_ABORT'           : {'type'  : 'int'},        # stop after the current frame
+    'BURST_COUNT'           : {'type'  : 'int', 'value' : 10},
+    'BURST_PERIOD'          : {'prec'  : 3, 'unit' : 's'},
+    'BURST_MOTOR'           : {'type'  : 'string'},
+    'BURST_STEPS'           : {'type'  : 'float', 'count' : BURST_MAX_FRAMES, 'prec' : 4},
+    'BURST_BUSY'            : {'type'  : 'enum',
+                               'enums' : ['IDLE', 'BUSY']},
+    'BURST_FRAME'           : {'type'  : 'int'},        # frames exposed in the current/last burst
+    'BURST_LATE'            : {'type'  : 'int'},        # frames started after their BURST_PERIOD slot
+    'BURST_TIME'            : {'prec'  : 3, 'unit' : 's'},
+    'BURST_PERIODS'         : {'type'  : 'float', 'count' : BURST_MAX_FRAMES, 'prec' : 3, 'unit' : 'ms'},
+    'BURST_PERIOD_MEAN'     : {'prec'  : 3, 'unit' : 'ms'},
+    'BURST_PERIOD_MIN'      : {'prec'  : 3, 'unit' : 'ms'},
+    'BURST_PERIOD_MAX'      : {'prec'  : 3, 'unit' : 'ms'},
+    'BURST_PERIOD_JITTER'   : {'prec'  : 3, 'unit' : 'ms'},      # standard deviation
+    # x-ray hold time after ExpOk goes off. FIXED uses TAIL_HOLD_<source>, AUTO derives it
+    # from the measured ExpOk on time (and FIRING_RBV for oxford), never longer than FIXED
+    'TAIL_MODE'             : {'type'  : 'enum',
+                               'enums' : ['FIXED', 'AUTO']},
+    'TAIL_HOLD_SRI'         : {'prec'  : 3, 'unit' : 's', 'value' : 1.0},
+    'TAIL_HOLD_OXFORD'      : {'prec'  : 3, 'unit' : 's', 'value' : 1.0},
+    'TAIL_HOLD_CPI'         : {'prec'  : 3, 'unit' : 's', 'value' : 1.0},
+    'TAIL_HOLD_RBV'         : {'prec'  : 3, 'unit' : 's'},
+    # keep the x-ray source in pulse mode (oxford) / prep (cpi) between points of a scan
+    'KEEP_WARM'             : {'type'  : 'enum',
+                               'enums' : ['OFF', 'ON']},
+    'KEEP_WARM_IDLE'        : {'prec'  : 1, 'unit' : 's', 'value' : 30.0},
+    'KEEP_WARM_RBV'         : {'type'  : 'enum',
+                               'enums' : ['COLD', 'WARM']},
+    # start the source ramp (oxford) when an exposure is likely: acquire armed, a scan started or
+    # PREWARM_LEAD seconds before the next point of a running scan. Back to standby after PREWARM_IDLE
+    'PREWARM'               : {'type'  : 'enum',
+                               'enums' : ['OFF', 'ON']},
+    'PREWARM_LEAD'          : {'prec'  : 2, 'unit' : 's', 'value' : 1.0},
+    'PREWARM_IDLE'          : {'prec'  : 1, 'unit' : 's', 'value' : 10.0},
+    'PREWARM_RBV'           : {'type'  : 'enum',
+                               'enums' : ['IDLE', 'WARM']},
+    'PREWARM_HITS'          : {'type'  : 'int'},        # pre-warms used by an exposure
+    'PREWARM_MISSES'        : {'type'  : 'int'},        # pre-warms released by the idle guard
+    # cpi: hold the generator in prep between shots of a burst or scan, only EXPOSE toggles per shot.
+    # Released after KEEP_WARM_IDLE or at the end of the CPI_PREP_WINDOW, whichever comes first
+    'CPI_PREP_HOLD'         : {'type'  : 'enum',
+                               'enums' : ['OFF', 'ON']},
+    'CPI_PREP_HITS'         : {'type'  : 'int'},        # shots which found the generator still in prep
+    'CPI_PREP_MISSES'       : {'type'  : 'int'},        # shots which had to prep the generator
+    # dispatcher lane counters, latency is the time a task waited in the queue (ms)
+    'EXP_QUEUE_DEPTH'       : {'type'  : 'int', 'scan' : 1},
+    'EXP_LATENCY'           : {'prec'  : 3, 'unit' : 'ms', 'scan' : 1},
+    'EXP_LATENCY_MAX'       : {'prec'  : 3, 'unit' : 'ms', 'scan' : 1},
+    'EXP_DROPPED'           : {'type'  : 'int', 'scan' : 1},
+    'EXP_CANCEL'            : {'type'  : 'int'},        # cancel the running and queued sequences of the lane
+    'IO_QUEUE_DEPTH'        : {'type'  : 'int', 'scan' : 1},
+    'IO_LATENCY'            : {'prec'  : 3, 'unit' : 'ms', 'scan' : 1},
+    'IO_LATENCY_MAX'        : {'prec'  : 3, 'unit' : 'ms', 'scan' : 1},
+    'IO_DROPPED'            : {'type'  : 'int', 'scan' : 1},
+    # sampled ExpOk/ExpReq line trace of the last rad exposure (EXP_OK_SAMPLING)
+    'EXP_TRACE_OK'          : {'type'  : 'int', 'count' : EXP_TRACE_POINTS},
+    'EXP_TRACE_REQ'         : {'type'  : 'int', 'count' : EXP_TRACE_POINTS},
+    'EXP_TRACE_PERIOD'      : {'prec'  : 4, 'unit' : 'ms'},      # time between trace points
+    'EXP_OK_WIDTH'          : {'prec'  : 3, 'unit' : 'ms'},      # ExpOk on time of the last exposure
+    # applied process/thread scheduling, see setProcessPriority
+    'RT_PRIORITY'           : {'type'  : 'string'},     # process priority class / nice
+    'RT_POLICY'             : {'type'  : 'string'},     # scheduler of the exposure threads, e.g. FIFO 50
+    'RT_AFFINITY'           : {'type'  : 'string'},     # cpus of the exposure threads
+    'RT_MLOCK'              : {'type'  : 'string'},
+    'RT_GC'                 : {'type'  : 'string'},
 }
+# per exposure phase timing, ms since the shutter request of the last cycle
+for phase in PHASE_LIST:
+    pvdb['PHASE_' + phase] = {'prec' : 3, 'unit' : 'ms'}
+pvdb.update({
+    'PHASE_MIN'             : {'type'  : 'float', 'count' : len(PHASE_LIST), 'prec' : 3, 'unit' : 'ms'},
+    'PHASE_MEAN'            : {'type'  : 'float', 'count' : len(PHASE_LIST), 'prec' : 3, 'unit' : 'ms'},
+    'PHASE_P99'             : {'type'  : 'float', 'count' : len(PHASE_LIST), 'prec' : 3, 'unit' : 'ms'},
+    'PHASE_COUNT'           : {'type'  : 'int'},
+    # last EXPOSURE_HISTORY exposures, oldest first. HIST_DUMP writes them to
+    # <TIFF1:FilePath_RBV>exposureHistory_<time>.txt
+    'HIST_START'            : {'type'  : 'float', 'count' : EXPOSURE_HISTORY, 'prec' : 3, 'unit' : 's'},
+    'HIST_DURATION'         : {'type'  : 'float', 'count' : EXPOSURE_HISTORY, 'prec' : 3, 'unit' : 'ms'},
+    'HIST_XSYNC'            : {'type'  : 'int', 'count' : EXPOSURE_HISTORY},
+    'HIST_CONFIG'           : {'type'  : 'int', 'count' : EXPOSURE_HISTORY},
+    'HIST_MODE'             : {'type'  : 'int', 'count' : EXPOSURE_HISTORY},
+    'HIST_OK'               : {'type'  : 'int', 'count' : EXPOSURE_HISTORY},
+    'HIST_COUNT'            : {'type'  : 'int'},
+    'HIST_FAILED'           : {'type'  : 'int'},
+    'HIST_RATE'             : {'prec'  : 2, 'unit' : '1/min'},  # exposures in the last minute
+    'HIST_DUMP'             : {'type'  : 'int'},
+    'HIST_DUMP_FILE'        : {'type'  : 'string'},
+    # tube load integrated over the ExpOk windows of the last exposure, the session
+    # (until LOAD_SESSION_RESET) and the day. Totals are kept by autosave.
+    'LOAD_LAST_TIME'        : {'prec'  : 3, 'unit' : 's'},
+    'LOAD_LAST_KV'          : {'prec'  : 1, 'unit' : 'kV'},      # time weighted mean
+    'LOAD_LAST_MAS'         : {'prec'  : 3, 'unit' : 'mAs'},
+    'LOAD_LAST_ENERGY'      : {'prec'  : 1, 'unit' : 'J'},
+    'LOAD_SESSION_TIME'     : {'prec'  : 3, 'unit' : 's'},
+    'LOAD_SESSION_MAS'      : {'prec'  : 3, 'unit' : 'mAs'},
+    'LOAD_SESSION_ENERGY'   : {'prec'  : 1, 'unit' : 'J'},
+    'LOAD_SESSION_COUNT'    : {'type'  : 'int'},
+    'LOAD_SESSION_START'    : {'type'  : 'string'},
+    'LOAD_SESSION_RESET'    : {'type'  : 'int'},
+    'LOAD_DAY_TIME'         : {'prec'  : 3, 'unit' : 's'},
+    'LOAD_DAY_MAS'          : {'prec'  : 3, 'unit' : 'mAs'},
+    'LOAD_DAY_ENERGY'       : {'prec'  : 1, 'unit' : 'J'},
+    'LOAD_DAY_COUNT'        : {'type'  : 'int'},
+    'LOAD_DAY_DATE'         : {'type'  : 'string'},
+    'LOAD_CALC_TIME'        : {'prec'  : 3, 'unit' : 'ms'},      # integration + update time of the last window
+})
+# records every additional detector channel has under its own sub prefix
+CHANNEL_PVS = ['PaxscanShutter', 'ExpOk'] + sorted(reason for reason in pvdb \
+                                                   if reason.split('_')[0] in ('EXP', 'PHASE', 'HIST', 'BURST'))
+for channel in DETECTOR_CHANNELS[1:]:
+    for reason in CHANNEL_PVS:
+        pvdb[channel['name'] + reason] = dict(pvdb[reason])
 pvdb.update(epicsApps.pvdb)
+# one shot command records, back to 0 once taken and never restored by autosave
+TRIGGER_PVS = ['SYNC_TRIGGER', 'BURST_START', 'BURST_ABORT', 'EXP_CANCEL', 'HIST_DUMP', 'LOAD_SESSION_RESET']
+
+class PVCache(object):
+    """
+    Monitor backed cache of PV values. Every PV is connected once and kept
+    subscribed, so reads come from the last monitor update instead of a
+    Channel Access round trip, and waitFor/waitUntil wake up on the monitor
+    update instead of polling with caget. pvFactory creates the PV objects
+    (pyepics PV, or traceReplay.SimulatedPVs in a replay) and every monitor
+    update goes to the trace if a recorder is set.
+    """
+    def __init__(self, pvFactory = PV, recorder = None):
+        self.pvFactory = pvFactory
+        self.recorder = recorder
+        self.pvs = {}
+        self.values = {}
+        self.strings = {}
+        self.updates = {}                               # number of monitor updates per PV
+        self.stamps = {}                                # local arrival time (monotonic) of the last update
+        self.monitors = {}                              # PV name -> functions called on every update
+        self.listeners = []                             # functions called on every update of any PV
+        self.cond = threading.Condition()
+
+    def subscribe(self, names, timeout = 1.0):
+        """
+        Connect and monitor a list of PV names (already cached ones are skipped).
+        The PV's connect in parallel, timeout is for all of them together.
+        """
+        new = []
+        with self.cond:
+            for name in names:
+                if name not in self.pvs:
+                    self.pvs[name] = self.pvFactory(name, callback = self.update, auto_monitor = True)
+                    new.append(self.pvs[name])
+        deadline = time.time() + timeout
+        for pv in new:
+            if pv.wait_for_connection(max(0.0, deadline - time.time())):
+                value = pv.get(use_monitor = True)
+                self.update(pvname = pv.pvname, value = value, char_value = pv.get(as_string = True))
+            else:
+                print str(datetime.datetime.now())[:-3], 'PV cache could not connect to', pv.pvname
+
+    def update(self, pvname = None, value = None, char_value = None, **kw):
+        """
+        pyepics monitor callback
+        """
+        with self.cond:
+            self.values[pvname] = value
+            self.strings[pvname] = char_value
+            self.updates[pvname] = self.updates.get(pvname, 0) + 1
+            self.stamps[pvname] = stamp = monotonic()
+            self.cond.notify_all()
+        # traced after the cache is up to date, the recorder never raises
+        if self.recorder is not None:
+            self.recorder.monitor(pvname, value, char_value)
+        for func in self.monitors.get(pvname, ()):
+            func(pvname, value, stamp)
+        for func in self.listeners:
+            func()
+
+    def addMonitor(self, name, func):
+        """
+        Calls func(name, value, timestamp) on every monitor update of name.
+        """
+        funcs = self.monitors.setdefault(name, [])
+        if func not in funcs:
+            funcs.append(func)
+        self.handle(name)
+
+    def addListener(self, func):
+        """
+        Calls func() after every update of any cached PV, e.g. to wake the event loop.
+        """
+        self.listeners.append(func)
+
+    def get(self, name, as_string = False):
+        """
+        Last monitored value of name, subscribing to it on first use.
+        """
+        if name not in self.pvs:
+            self.subscribe([name])
+        return self.strings.get(name) if as_string else self.values.get(name)
+
+    def getMany(self, names):
+        """
+        Snapshot of the last monitored values of a list of already subscribed PV's,
+        taken under one lock so the cost does not depend on channel access.
+        """
+        with self.cond:
+            return [self.values.get(name) for name in names]
+
+    def put(self, name, value, wait = False):
+        return self.handle(name).put(value, wait = wait)
+
+    def handle(self, name):
+        """
+        Connected and monitored PV object for name, subscribing to it on first use.
+        """
+        if name not in self.pvs:
+            self.subscribe([name])
+        return self.pvs[name]
+
+    def waitUntil(self, condition, timeout = None):
+        """
+        Block until condition() is true, re-evaluating it on every monitor
+        update. Returns False on timeout.
+        """
+        with self.cond:
+            return bool(waitCondition(self.cond, lambda: True if condition() else None, timeout))
+
+    def waitFor(self, name, value, timeout = None):
+        """
+        Block until the monitored value of name equals value. Returns False on timeout.
+        """
+        if name not in self.pvs:
+            self.subscribe([name])
+        return self.waitUntil(lambda: self.values.get(name) == value, timeout)
+
+    def updateCount(self, name):
+        with self.cond:
+            return self.updates.get(name, 0)
+
+    def waitForUpdate(self, name, since, timeout = None):
+        """
+        Block until name gets a monitor update after update number since. Returns False on timeout.
+        """
+        return self.waitUntil(lambda: self.updates.get(name, 0) > since, timeout)
+
+class XraySource(object):
+    """
+    X-ray source adapter, base class and XSYNC = NONE (dark images). Every
+    adapter connects all of its PV's once when it is created, the sequences
+    then only use the pre-resolved handles/names:
+        prepare()               coroutine, brings the source to set points, returns True when ready
+        fire()                  called on ExpOk rising
+        arm()                   stops output but leaves the source ready for the next shot,
+                                returns False if the source has no such state
+        stop()                  coroutine, stops x-ray output
+        status()                source status readback
+        confirmFiring(timeout)  coroutine, waits for a fresh firing readback, returns True if firing
+    """
+    name = 'NONE'
+
+    def __init__(self, cache, prefix = ''):
+        self.cache = cache
+        self.prefix = prefix
+        self.names = self.records()
+        self.handles = {}
+        cache.subscribe(self.names.values())
+        for role, name in self.names.items():
+            self.handles[role] = cache.handle(name)
+        self.values = cache.values
+
+    def records(self):
+        """
+        role -> PV name of every record the adapter uses
+        """
+        return {}
+
+    def tubeLoad(self):
+        """
+        (kV readback, tube current readback, current unit 'mA' or 'W') integrated
+        over the ExpOk windows, None if the source has no such readbacks.
+        """
+        return None
+
+    def preWarm(self):
+        """
+        Starts bringing the source to set points ahead of an exposure, returns
+        False if the source has no ramp worth hiding or can't start now.
+        """
+        return False
+
+    def holdRemaining(self):
+        """
+        Seconds the source may still be held ready after arm(), None if unlimited.
+        """
+        return None
+
+    def read(self, role):
+        return self.values.get(self.names[role])
+
+    def put(self, role, value):
+        self.handles[role].put(value)
+
+    def prepare(self):
+        print str(datetime.datetime.now())[:-3], 'Acquiring dark image'
+        raise Return(True)
+        yield
+
+    def fire(self):
+        pass
+
+    def arm(self):
+        return False
+
+    def stop(self):
+        return
+        yield
+
+    def status(self):
+        return None
+
+    def confirmFiring(self, timeout):
+        raise Return(True)
+        yield
+
+class SRISource(XraySource):
+    """
+    SRI source, output is switched with ON.
+    """
+    name = 'SRI'
+
+    def records(self):
+        return {'ON' : self.prefix + 'ON'}
+
+    def tubeLoad(self):
+        return self.prefix + 'KV_RBV', self.prefix + 'MA_RBV', 'mA'
+
+    def prepare(self):
+        self.put('ON', 1)
+        print str(datetime.datetime.now())[:-3], 'X-ray is outputting at set points'
+        raise Return(True)
+        yield
+
+    def stop(self):
+        self.put('ON', 0)
+        return
+        yield
+
+    def status(self):
+        return self.read('ON')
+
+class OxfordSource(XraySource):
+    """
+    Oxford/Nova source. STATUS_RBV: 0 warming, 1 standby, 2 output, 3 pulse, 5 fault.
+    FIRING_RBV is sampled at 10Hz in the db.
+    """
+    name = 'OXFORD'
+    FIRING_PERIOD = 0.1                                 # FIRING_RBV scan period (s)
+    fired = 0.0                                         # monotonic time of the last fire()
+
+    def records(self):
+        return dict((role, self.prefix + role) for role in ['STATUS_RBV', 'FIRING_RBV', 'ON', 'PULSE_MODE'])
+
+    def tubeLoad(self):
+        # the oxford reports power, not tube current
+        return self.prefix + 'KVP_RBV', self.prefix + 'WATT_RBV', 'W'
+
+    def prepare(self):
+        status = self.read('STATUS_RBV')
+        if status == 5: # make sure x-ray is not in fault mode.
+            print str(datetime.datetime.now())[:-3], 'X-ray is in fault mode!'
+            raise Return(False)
+        if status == 0: # xray is warming
+            print str(datetime.datetime.now())[:-3], 'Waiting for warm up to finish!'
+            raise Return(False)
+        if status == 1: # if xray in standby mode 
+            # turn on x-ray 
+            self.put('ON', 1)
+        elif status == 3 or status == 2: # in pulse/output mode now.
+            self.put('PULSE_MODE', 0)   
+        # wait for x-ray to reach set points
+        firing = self.names['FIRING_RBV']
+        ready = yield waitUntil(self.cache, lambda: self.values.get(firing) == 1, XRAY_READY_TIMEOUT)
+        if not ready:
+            print str(datetime.datetime.now())[:-3], 'Timed out waiting for x-ray to fire!'
+            raise Return(False)
+        print str(datetime.datetime.now())[:-3], 'X-ray is outputting at set points'
+        raise Return(True)
+
+    def arm(self):
+        # pulse mode, output stops but the source stays at set points
+        self.put('PULSE_MODE', 1)
+        return True
+
+    def preWarm(self):
+        status = self.read('STATUS_RBV')
+        if status == 1:
+            # standby
+            self.put('ON', 1)
+        elif status == 3:
+            # pulse mode
+            self.put('PULSE_MODE', 0)
+        else:
+            # warming, fault, or already in output
+            return False
+        return True
+
+    def stop(self):
+        self.put('ON', 0)
+        return
+        yield
+
+    def status(self):
+        return self.read('STATUS_RBV')
+
+    def fire(self):
+        # already outputting since prepare, only noted for confirmFiring
+        self.fired = monotonic()
+
+    def confirmFiring(self, timeout):
+        """
+        Coroutine: True if FIRING_RBV says the source fired through the exposure.
+        A 1 posted after fire(), or held for a whole scan period since (a record
+        that stays at 1 posts no update), confirms right away. Otherwise waits
+        up to timeout for the next update.
+        """
+        firing = self.names['FIRING_RBV']
+        since = self.cache.updateCount(firing)
+        if self.values.get(firing) == 1 and (self.cache.stamps.get(firing, 0.0) >= self.fired or \
+                                             monotonic() - self.fired >= self.FIRING_PERIOD):
+            raise Return(True)
+        yield waitUntil(self.cache, lambda: self.cache.updates.get(firing, 0) > since, timeout)
+        raise Return(self.values.get(firing) == 1)
+
+class CPISource(XraySource):
+    """
+    CPI-CMP200 generator. RAD_PREP/EXPOSE go through the cpiSync IOC, generator
+    status and errors are read from the CPI IOC (CPI_IOC).
+    """
+    name = 'CPI'
+
+    def __init__(self, cache, prefix = ''):
+        XraySource.__init__(self, cache, prefix)
+        self.prepStart = None                           # monotonic time RAD_PREP went high, None when released
+        self.hits = 0
+        self.misses = 0
+
+    def records(self):
+        names = dict((role, self.prefix + role) for role in ['RAD_PREP', 'EXPOSE'])
+        names.update((role, CPI_IOC + role) for role in ['GeneratorStatus', 'RadPrep', 'ErrorLatching', \
+                                                         'AcknowledgeError'])
+        return names
+
+    def tubeLoad(self):
+        return CPI_IOC + 'KVP_RBV', CPI_IOC + 'MA_RBV', 'mA'
+
+    def prepHeld(self):
+        """
+        True if the generator is still in prep from an earlier shot, inside its prep window.
+        """
+        return self.prepStart is not None and monotonic() - self.prepStart < CPI_PREP_WINDOW and \
+               self.read('RadPrep') == 2 and self.read('ErrorLatching') != 22
+
+    def holdRemaining(self):
+        if self.prepStart is None:
+            return 0.0
+        return max(0.0, CPI_PREP_WINDOW - (monotonic() - self.prepStart))
+
+    def prepare(self):
+        if self.prepHeld():
+            self.hits += 1
+            raise Return(True)
+        self.misses += 1
+        # check that the x-ray is not disconnected or in init phase or the emergency stop is on
+        if self.read('GeneratorStatus') in (0, 1, 9):
+            raise Return(False)
+        # here we just get the generator ready to expose
+        self.put('RAD_PREP', 1)
+        self.prepStart = monotonic()
+        prep, error = self.names['RadPrep'], self.names['ErrorLatching']
+        ready = yield waitUntil(self.cache, lambda: self.values.get(prep) == 2 or self.values.get(error) == 22,
+                                XRAY_READY_TIMEOUT)
+        if not ready:
+            print str(datetime.datetime.now())[:-3], 'Timed out waiting for generator prep!'
+        if self.read('ErrorLatching') == 22:
+            self.put('AcknowledgeError', 1)
+            raise Return(False)
+        raise Return(ready)
+
+    def fire(self):
+        self.put('EXPOSE', 1)
+
+    def arm(self):
+        # drop EXPOSE only, the generator stays in prep
+        self.put('EXPOSE', 0)
+        return True
+
+    def stop(self):
+        self.put('EXPOSE', 0)
+        yield sleep(CPI_PREP_RELEASE_DELAY)
+        self.put('RAD_PREP', 0)
+        self.prepStart = None
+
+    def status(self):
+        return self.read('GeneratorStatus')
+
+# XSYNC value -> (source adapter, x-ray IOC prefix)
+XRAY_SOURCES = {
+    0 : (XraySource, ''),
+    1 : (SRISource, EXPERIMENT + 'SRI:xray:'),
+    2 : (OxfordSource, EXPERIMENT + 'OXFORD:xray:'),
+    3 : (CPISource, EXPERIMENT + 'cpiSync:'),
+}
+
+class PhaseTimer(object):
+    """
+    Timestamps (monotonic clock) of the phases of one exposure cycle (see
+    PHASE_LIST) and a fixed size ring buffer of the last PHASE_HISTORY cycles,
+    stored as ms offsets from the shutter request. Phases a cycle does not go through
+    (e.g. ExpReq in fluoro mode) are NaN and ignored by the statistics.
+    """
+    def __init__(self, size = PHASE_HISTORY):
+        self.index = dict((phase, n) for n, phase in enumerate(PHASE_LIST))
+        self.current = np.empty(len(PHASE_LIST))
+        self.current.fill(np.nan)
+        self.ring = np.empty((size, len(PHASE_LIST)))
+        self.ring.fill(np.nan)
+        self.count = 0
+
+    def start(self, stamp = None):
+        self.current.fill(np.nan)
+        self.mark('SHUTTER', stamp)
+
+    def mark(self, phase, stamp = None):
+        self.current[self.index[phase]] = monotonic() if stamp is None else stamp
+
+    def finish(self):
+        """
+        Stores the current cycle in the ring buffer and returns its offsets (ms).
+        """
+        offsets = (self.current - self.current[0]) * 1e3
+        self.ring[self.count % len(self.ring)] = offsets
+        self.count += 1
+        return offsets
+
+    def stats(self):
+        """
+        min, mean and 99th percentile (ms) of every phase over the ring buffer
+        """
+        filled = self.ring[:min(self.count, len(self.ring))]
+        return np.nanmin(filled, 0), np.nanmean(filled, 0), np.nanpercentile(filled, 99, 0)
+
+class ExposureHistory(object):
+    """
+    Fixed size ring buffer of the last EXPOSURE_HISTORY exposures, one record
+    of a NumPy structured array per exposure: start (shutter request, epoch s),
+    ExpOk on time (ms, NaN if ExpOk never came), XSYNC source, Varian config
+    and mode and whether the cycle finished.
+    """
+    dtype = np.dtype([('start', 'f8'), ('duration', 'f8'), ('xsync', 'i2'), \
+                      ('config', 'i2'), ('mode', 'i2'), ('ok', 'i2')])
+
+    def __init__(self, size = EXPOSURE_HISTORY):
+        self.ring = np.zeros(size, dtype = self.dtype)
+        self.count = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def add(self, start, duration, xsync, config, mode, ok):
+        with self.lock:
+            self.ring[self.count % len(self.ring)] = (start, duration, xsync, config, mode, ok)
+            self.count += 1
+            if not ok:
+                self.failed += 1
+
+    def snapshot(self):
+        """
+        Copy of the stored records, oldest first.
+        """
+        with self.lock:
+            if self.count <= len(self.ring):
+                return self.ring[:self.count].copy()
+            return np.roll(self.ring, -(self.count % len(self.ring)))
+
+    def rate(self, window = 60.0):
+        """
+        Exposures started in the last window seconds, per minute.
+        """
+        with self.lock:
+            recent = np.count_nonzero(self.ring['start'][:min(self.count, len(self.ring))] > time.time() - window)
+        return recent * 60.0 / window
+
+    def dump(self, fileName):
+        records = self.snapshot()
+        np.savetxt(fileName, records, fmt = ['%.6f', '%.3f', '%d', '%d', '%d', '%d'], delimiter = '\t', \
+                   header = '\t'.join(self.dtype.names))
+        return len(records)
+
+def readbackValue(value):
+    """
+    Numeric value of a source readback, some IOC's report strings like 'KVP=50'.
+    """
+    if isinstance(value, basestring):
+        value = value.split('=')[-1]
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+class TubeLoadIntegrator(object):
+    """
+    Integrates the kV and tube current (or power) readbacks of the active x-ray
+    source over an ExpOk window. Monitor updates are appended to preallocated
+    arrays while the window is open, each row holding both readbacks, and are
+    integrated sample and hold in one vectorized pass when it closes.
+    """
+    def __init__(self, cache, size = LOAD_MAX_SAMPLES):
+        self.cache = cache
+        self.stamp = np.empty(size)
+        self.kv = np.empty(size)
+        self.current = np.empty(size)
+        self.count = 0
+        self.open = False
+        self.names = None                               # tubeLoad() of the active source
+        self.lock = threading.Lock()
+
+    def setSource(self, source):
+        with self.lock:
+            self.names = source.tubeLoad()
+            self.open = False
+        if self.names is not None:
+            self.cache.addMonitor(self.names[0], self.sample)
+            self.cache.addMonitor(self.names[1], self.sample)
+
+    def append(self, stamp, kv, current):
+        if self.count < len(self.stamp):
+            self.stamp[self.count] = stamp
+            self.kv[self.count] = kv
+            self.current[self.count] = current
+            self.count += 1
+
+    def sample(self, name, value, stamp):
+        """
+        PV cache monitor of the kV/current readbacks.
+        """
+        with self.lock:
+            if not self.open or self.names is None or self.count == 0:
+                return
+            last = self.count - 1
+            if name == self.names[0]:
+                self.append(stamp, readbackValue(value), self.current[last])
+            elif name == self.names[1]:
+                self.append(stamp, self.kv[last], readbackValue(value))
+
+    def start(self, stamp):
+        """
+        Opens a window on ExpOk rising, starting from the readbacks held at that time.
+        """
+        with self.lock:
+            if self.names is None:
+                return
+            self.count = 0
+            kv, current = self.cache.getMany(self.names[:2])
+            self.append(stamp, readbackValue(kv), readbackValue(current))
+            self.open = True
+
+    def finish(self, stamp):
+        """
+        Closes the window on ExpOk falling. Returns (on time s, mean kV, mAs, energy J)
+        or None if no window was open.
+        """
+        with self.lock:
+            if not self.open:
+                return None
+            self.open = False
+            self.append(stamp, self.kv[self.count - 1], self.current[self.count - 1])
+            n = self.count
+            unit = self.names[2]
+        dt = np.diff(self.stamp[:n])
+        kv = self.kv[:n - 1]
+        if unit == 'W':
+            power = self.current[:n - 1]
+            current = np.where(kv > 0, power / np.where(kv > 0, kv, 1.0), 0.0)
+        else:
+            current = self.current[:n - 1]
+            power = kv * current                        # kV * mA = W
+        duration = self.stamp[n - 1] - self.stamp[0]
+        meanKv = np.dot(kv, dt) / duration if duration > 0 else kv[0]
+        return duration, meanKv, np.dot(current, dt), np.dot(power, dt)
+
+class WorkLane(object):
+    """
+    Fixed set of worker threads fed by a bounded queue. A lane with one worker
+    runs its tasks strictly one after another. When the queue is full new
+    tasks are dropped (and counted) instead of blocking the caller, which is
+    usually a pcaspy write or a pyepics callback. setup is called first on
+    every worker thread (e.g. real-time scheduling).
+    """
+    def __init__(self, name, workers, maxDepth, setup = None):
+        self.name = name
+        self.setup = setup
+        self.queue = Queue.Queue(maxDepth)
+        self.dropped = 0
+        self.latency = 0.0                              # queue wait of the last task (s)
+        self.maxLatency = 0.0
+        self.runTime = 0.0                              # run time of the last task (s)
+        self.threads = []
+        for i in range(workers):
+            tid = threading.Thread(target = self.work, args = (), name = '%s-%d' % (name, i))
+            tid.daemon = True
+            tid.start()
+            self.threads.append(tid)
+
+    def submit(self, func, *args):
+        try:
+            self.queue.put_nowait((time.time(), func, args))
+        except Queue.Full:
+            self.dropped += 1
+            print str(datetime.datetime.now())[:-3], self.name, 'queue full, dropped', func.__name__
+            return False
+        return True
+
+    def work(self):
+        if self.setup is not None:
+            self.setup()
+        while True:
+            queued, func, args = self.queue.get()
+            start = time.time()
+            self.latency = start - queued
+            self.maxLatency = max(self.maxLatency, self.latency)
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+            self.runTime = time.time() - start
+            self.queue.task_done()
+
+    def depth(self):
+        return self.queue.qsize()
+
+class Dispatcher(object):
+    """
+    Event dispatcher with a serialized lane for exposure sequencing per detector
+    channel (EXP, B:EXP, ...) and a bounded pool for I/O work, replacing one new
+    thread per callback. exposureSetup runs on every exposure lane thread.
+    """
+    def __init__(self, exposureLanes = ('EXP',), exposureSetup = None):
+        self.lanes = dict((lane, WorkLane(lane[:-3] + 'exposure', *EXPOSURE_LANE, setup = exposureSetup)) \
+                          for lane in exposureLanes)
+        self.lanes['IO'] = WorkLane('io', *IO_LANE)
+        self.pvNames = [lane + '_' + field for lane in self.lanes \
+                        for field in ['QUEUE_DEPTH', 'LATENCY', 'LATENCY_MAX', 'DROPPED']]
+
+    def exposure(self, func, *args):
+        return self.lanes['EXP'].submit(func, *args)
+
+    def submit(self, lane, func, *args):
+        return self.lanes[lane].submit(func, *args)
+
+    def io(self, func, *args):
+        return self.lanes['IO'].submit(func, *args)
+
+    def counter(self, reason):
+        """
+        Value of a lane counter PV, e.g. EXP_QUEUE_DEPTH, B:EXP_DROPPED or IO_LATENCY_MAX.
+        """
+        name, field = reason.split('_', 1)
+        lane = self.lanes[name]
+        if field == 'QUEUE_DEPTH':
+            return lane.depth()
+        elif field == 'LATENCY':
+            return lane.latency * 1e3
+        elif field == 'LATENCY_MAX':
+            return lane.maxLatency * 1e3
+        elif field == 'DROPPED':
+            return lane.dropped
+
+class RunMetadataStore(object):
+    """
+    Per run table of documented PV values, one row per image keyed by the
+    tiff file number and FullFileName_RBV, one column per documented PV.
+    Rows are buffered in preallocated arrays and written every DOC_FLUSH_ROWS
+    images or DOC_FLUSH_INTERVAL seconds (see myDriver.flushMetaStore), and on
+    close. An existing table of the run is continued: NPZ files are rewritten
+    on flush with the rows already stored in front, into a temporary file
+    renamed over the table so a crash mid flush leaves the last complete one,
+    HDF5 files (needs h5py) are appended to. A table with other columns is
+    moved aside first.
+    """
+    CHUNK = 256
+
+    def __init__(self, path, columns, fmt):
+        self.path = path
+        self.columns = list(columns)
+        self.fmt = fmt
+        self.rows = 0
+        self.flushed = 0
+        self.lastFlush = time.time()
+        self.fileNumber = np.zeros(self.CHUNK, dtype=np.int32)
+        self.stamp = np.zeros(self.CHUNK, dtype=np.float64)
+        self.values = np.zeros((self.CHUNK, len(self.columns)), dtype=np.float64)
+        self.fileNames = []
+        self.stored = 0                                 # rows of earlier sessions in the file
+        self.previous = None                            # their NPZ arrays
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        if self.fmt == 'HDF5':
+            f = h5py.File(self.path, 'r')
+            columns = list(f['values'].attrs['columns']) if 'values' in f else self.columns
+            stored = len(f['values']) if 'values' in f else 0
+            f.close()
+        else:
+            previous = np.load(self.path)
+            self.previous = dict((name, previous[name]) for name in previous.files)
+            previous.close()
+            columns = list(self.previous['columns'])
+            stored = len(self.previous['stamp'])
+        if columns != self.columns:
+            aside = self.path + '.' + datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+            print str(datetime.datetime.now())[:-3], 'Run table', self.path, 'has other columns, moved to', aside
+            os.rename(self.path, aside)
+            self.previous = None
+            return
+        self.stored = stored
+
+    def append(self, fileNumber, fullFileName, values):
+        if self.rows == len(self.stamp):
+            size = self.rows + self.CHUNK
+            self.fileNumber = np.resize(self.fileNumber, size)
+            self.stamp = np.resize(self.stamp, size)
+            self.values = np.resize(self.values, (size, len(self.columns)))
+        self.fileNumber[self.rows] = fileNumber
+        self.stamp[self.rows] = time.time()
+        self.values[self.rows] = [np.nan if v is None else v for v in values]
+        self.fileNames.append(fullFileName)
+        self.rows += 1
+        if self.rows - self.flushed >= DOC_FLUSH_ROWS or time.time() - self.lastFlush > DOC_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.rows == self.flushed:
+            return
+        if self.fmt == 'HDF5':
+            f = h5py.File(self.path, 'a')
+            if 'values' not in f:
+                f.create_dataset('fileNumber', (0,), maxshape=(None,), dtype='i4')
+                f.create_dataset('stamp', (0,), maxshape=(None,), dtype='f8')
+                f.create_dataset('fullFileName', (0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=str))
+                f.create_dataset('values', (0, len(self.columns)), maxshape=(None, len(self.columns)), dtype='f8')
+                f['values'].attrs['columns'] = self.columns
+            for name, data in [('fileNumber', self.fileNumber), ('stamp', self.stamp),
+                               ('fullFileName', self.fileNames), ('values', self.values)]:
+                f[name].resize(self.stored + self.rows, axis=0)
+                f[name][self.stored + self.flushed:self.stored + self.rows] = data[self.flushed:self.rows]
+            f.close()
+        else:
+            table = {'fileNumber' : self.fileNumber[:self.rows], 'stamp' : self.stamp[:self.rows],
+                     'fullFileName' : np.array(self.fileNames), 'values' : self.values[:self.rows]}
+            if self.previous is not None:
+                for name in table:
+                    table[name] = np.concatenate((self.previous[name], table[name]))
+            temporary = self.path + '.tmp'
+            with open(temporary, 'wb') as f:
+                np.savez(f, columns=np.array(self.columns), **table)
+            if sys.platform == 'win32' and os.path.exists(self.path):
+                # no atomic replace on Windows (Python 2)
+                os.remove(self.path)
+            os.rename(temporary, self.path)
+        self.flushed = self.rows
+        self.lastFlush = time.time()
+
+def realtimeThread():
+    """
+    Applies SCHED_POLICY/SCHED_PRIORITY and EXPOSURE_CPUS to the calling thread
+    on Linux. Returns the (policy, affinity) status, None elsewhere.
+    """
+    if realtime.libc is None:
+        return None
+    policy = realtime.setScheduler(SCHED_POLICY, SCHED_PRIORITY)
+    affinity = realtime.setAffinity(EXPOSURE_CPUS) if EXPOSURE_CPUS else 'all'
+    if policy.startswith('failed') or affinity.startswith('failed'):
+        print str(datetime.datetime.now())[:-3], threading.current_thread().name, 'real-time scheduling', policy, \
+              'affinity', affinity
+    return policy, affinity
+
+class ExpOkWatcher(object):
+    """
+    Long lived watcher which owns the DI line for the ExpOk output of the Varian.
+    Rising and falling edges are timestamped as they happen and any thread can
+    block on the next edge (or a level) with a timeout. If the DAQ backend supports
+    change detection (e.g. USB-6221) the edges are delivered by the backend,
+    otherwise a single thread polls the line, only while ExpReq is high, ExpOk
+    is on or a thread waits on the line (it blocks otherwise). With sampling the line (and the
+    ExpReq loopback line) is sampled continuously and edges carry the sample time.
+    """
+    RISING  = 1
+    FALLING = 0
+
+    def __init__(self, daq, line, changeDetection = EXP_OK_CHANGE_DETECTION, pollInterval = EXP_OK_POLL_INTERVAL, \
+                 sampling = EXP_OK_SAMPLING, loopback = None):
+        self.line = line
+        self.pollInterval = pollInterval
+        self.edgeCount = {self.RISING: 0, self.FALLING: 0}  # number of edges seen since startup
+        self.edgeTime = {self.RISING: 0.0, self.FALLING: 0.0}
+        self.listeners = []
+        self.cond = threading.Condition()
+        self.running = True
+        self.armed = False                              # ExpReq is high, an ExpOk edge is coming
+        self.waiters = 0                                # threads blocked in waitForEdge/waitForLevel
+        self.sampled = sampling and daq.name != timingProcess.TimingBackend.name
+        # the backends read the level before they start delivering edges, edges that
+        # come in before it is stored here wait in update()
+        with self.cond:
+            if self.sampled:
+                self.ExpOkIn = daq.openSampledInput([line] + ([loopback] if loopback else []), self.update, \
+                                                    EXP_OK_SAMPLE_RATE, EXP_OK_BUFFER)
+            else:
+                self.ExpOkIn = daq.openInput(line, self.update if changeDetection else None)
+            self.level = self.ExpOkIn.read()            # last known state of the ExpOk line
+        self.changeDetection = self.ExpOkIn.changeDetection
+        if not self.changeDetection:
+            self.pid = threading.Thread(target = self.poll, args = ())
+            self.pid.daemon = True
+            self.pid.start()
+
+    def poll(self):
+        """
+        Software fallback: read the line continuously.
+        """
+        realtimeThread()
+        while self.running:
+            with self.cond:
+                while self.running and not (self.armed or self.waiters or self.level == self.RISING):
+                    self.cond.wait()
+            level = self.ExpOkIn.read()
+            if level != self.level:
+                self.update(level, monotonic())
+            time.sleep(self.pollInterval)
+
+    def update(self, level, stamp):
+        """
+        Record a new line level and wake up every thread waiting on an edge.
+        """
+        with self.cond:
+            if level == self.level:
+                return
+            self.level = level
+            self.edgeCount[level] += 1
+            self.edgeTime[level] = stamp
+            self.cond.notify_all()
+        # listeners may remove themselves (startMotion) while this loops
+        for listener in list(self.listeners):
+            listener(level, stamp)
+
+    def arm(self, armed):
+        """
+        Called with True before ExpReq goes high and False after it is low again,
+        the poll thread only reads the line in between (or while someone waits).
+        """
+        with self.cond:
+            self.armed = armed
+            self.cond.notify_all()
+
+    def addListener(self, func):
+        """
+        Register func(level, timestamp) to be called on every edge.
+        """
+        self.listeners.append(func)
+
+    def removeListener(self, func):
+        if func in self.listeners:
+            self.listeners.remove(func)
+
+    def edgeCounter(self, edge):
+        """
+        Number of edges of the given polarity seen so far, to be passed as since to waitForEdge.
+        """
+        with self.cond:
+            return self.edgeCount[edge]
+
+    def waitForEdge(self, edge, since = None, timeout = None):
+        """
+        Block until an edge of the given polarity happens after edge number since
+        (defaults to now). Returns the edge timestamp or None on timeout.
+        """
+        with self.cond:
+            if since is None:
+                since = self.edgeCount[edge]
+            self.waiting(1)
+            try:
+                return waitCondition(self.cond, lambda: self.edgeTime[edge] if self.edgeCount[edge] > since else None, \
+                                     timeout)
+            finally:
+                self.waiting(-1)
+
+    def waitForLevel(self, level, timeout = None):
+        """
+        Block until the line is at level. Returns the timestamp of the edge which
+        brought it there or None on timeout.
+        """
+        with self.cond:
+            self.waiting(1)
+            try:
+                return waitCondition(self.cond, lambda: self.edgeTime[level] if self.level == level else None, timeout)
+            finally:
+                self.waiting(-1)
+
+    def waiting(self, count):
+        """
+        count (1 or -1) threads start or stop blocking on the line, called with cond held.
+        """
+        self.waiters += count
+        if count > 0:
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.ExpOkIn.close()
+
+class DetectorChannel(object):
+    """
+    One PaxScan panel: its ExpOk watcher and ExpReq line, exposure lane, phase
+    timer and exposure history. name is the PV sub prefix of its records, so
+    channel.pv('PaxscanShutter') is e.g. 'B:PaxscanShutter'.
+    """
+    def __init__(self, daq, name, det, expReq, expOk, expReqLoop = None):
+        self.name = name
+        self.det = det
+        self.lane = name + 'EXP'
+        self.phases = PhaseTimer()
+        self.history = ExposureHistory()
+        self.shutter = 0                                # signal that the ADShutter Open
+        self.shutterClosed = Signal()                   # set on every rad mode PaxscanShutter 0
+        self.shutterOpened = Signal()                   # set on rad mode PaxscanShutter 1 during a burst
+        self.burst = False                              # a burst sequence owns the exposures of this channel
+        self.burstAbort = False
+        self.events = Signal()                          # set on ExpOk edges and shutter close (double mode)
+        self.timeOn = 0.0
+        # Set up the ExpOk watcher which owns the DI task for the ExposeOK output from the Varian
+        self.expOk = ExpOkWatcher(daq, expOk, loopback = expReqLoop)
+        self.expOk.addListener(lambda level, stamp: self.events.set())
+        # Set up the DO line to send the ExposeRequest signal to the Varian.
+        self.expReq = expReq
+        self.ExpReqOut = daq.openOutput(expReq)
+
+    def pv(self, reason):
+        return self.name + reason
+
+    def config(self, cache):
+        """
+        VarianConfig of the panel, 0 radiography, 1 fluoroscopy.
+        """
+        return cache.get(self.det + 'cam1:VarianConfig')
 
 class myDriver(Driver):
-    def  __init__(self):
+    def  __init__(self, daq = None, loop = None, cache = None):
         super(myDriver, self).__init__()
+        # LOOP engine event loop (None with the THREADS engine)
+        self.loop = loop
+        # event trace for traceReplay.py
+        self.recorder = traceReplay.TraceRecorder(TRACE_FILE) if TRACE_FILE else None
+        # DAQ backend for the ExpReq/ExpOk lines (NI USB DAQ unless a simulated one is passed in),
+        # optionally owned by the timing process
+        expReqs = [channel['expReq'] for channel in DETECTOR_CHANNELS]
+        expOks = [channel['expOk'] for channel in DETECTOR_CHANNELS]
+        self.timing = None
+        if daq is not None:
+            self.daq = daq
+            if daq.name == timingProcess.TimingBackend.name:
+                self.timing = daq
+        elif TIMING_PROCESS:
+            # the timing process drops ExpReq itself on the ExpOk falling edge of its channel
+            self.timing = timingProcess.TimingBackend((DAQ_BACKEND, expReqs, expOks), expReqs, expOks, TIMING_CPU, \
+                                                      (SCHED_POLICY, SCHED_PRIORITY), MEMORY_LOCK, \
+                                                      releases = dict(zip(expReqs, expOks)))
+            self.daq = self.timing
+        else:
+            self.daq = daqBackend.getBackend(DAQ_BACKEND, expReqs, expOks)
+        if self.recorder is not None:
+            self.daq = traceReplay.RecordingBackend(self.daq, self.recorder)
+        # worker lanes for exposure sequencing (one per detector channel) and I/O
+        self.dispatcher = Dispatcher([channel['name'] + 'EXP' for channel in DETECTOR_CHANNELS] + [LIVE_LANE], \
+                                     self.exposureThread)
+        self.sequences = {}                             # lane -> tasks started by runSequence, for EXP_CANCEL
         # set high priority for this process
         self.setProcessPriority()
         # load iocStats records
         self.iocStats()
-        VARIAN_FULL_FILENAME_RBV.add_callback(self.checkDoc)  
-        VARIAN_IMAGEMODE.add_callback(self.reset_num_filters)
-        # keep track of whether we are in rad or fluoro mode
-        VARIAN_CONFIG.add_callback(self.configChange)  
-        self.shutter = 0                                # signal that the ADShutter Open
-        self.zero = numpy.zeros((1,), dtype=numpy.uint8)
-        self.one = numpy.ones((1,), dtype=numpy.uint8)
-        self.written = int32()                          # needed for daqmx writes
-        self.configValue = 0                            # initialize configValue
-        VARIAN_CONFIG.get()
+        # monitored values of all x-ray source PV's, so the start/stop sequences don't caget
+        self.pvCache = cache if cache is not None else PVCache(recorder = self.recorder)
+        if self.loop is not None:
+            self.pvCache.addListener(self.loop.wake)
+        # x-ray source adapters, created (and connected) when XSYNC first selects them
+        self.sources = {}
+        self.sourceLock = threading.Lock()              # XSYNC writes switch sources on the I/O lane
+        self.exposing = set()                           # channels with a rad exposure or fluoro x-ray on in progress
+        self.gcLock = threading.Lock()                  # exposing and the GC_MODE EXPOSURE collector state
+        self.bursting = set()                           # channels with burst frames still to come
+        self.loadWindow = set()                         # channels with ExpOk on, see tubeLoadEdge
+        self.tubeLoad = TubeLoadIntegrator(self.pvCache)
+        self.source = None
+        self.selectSource(self.getParam('XSYNC'))
+        # documented motor readbacks and file name PV's
+        self.pvCache.subscribe(DOC_PV_LIST + DOC_FILE_PV_LIST)
+        # detector acquire/exposure time/rad or fluoro config and live scan motor fields, used by the sequences
+        self.pvCache.subscribe([channel['det'] + 'cam1:' + field for channel in DETECTOR_CHANNELS \
+                                for field in ['Acquire', 'AcquireTime_RBV', 'VarianMode', 'VarianConfig', 'DoubleMode']])
+        self.pvCache.subscribe([motor + field for motor in MOTOR_IOC_LIST for field in ['.TWV', '.VELO', '.TWF', '.DMOV']])
+        self.metaStore = None                           # run table when DOC_FORMAT is NPZ/HDF5
+        self.docLock = threading.Lock()
+        self.flushMetaStore()
+        # image saved (documentation) and image mode (filter reset) callbacks
+        self.pvCache.subscribe([VARIAN_FULL_FILENAME_RBV, VARIAN_IMAGEMODE, VARIAN_NUMFILTER])
+        self.pvCache.addMonitor(VARIAN_FULL_FILENAME_RBV, self.checkDoc)
+        self.pvCache.addMonitor(VARIAN_IMAGEMODE, self.reset_num_filters)
+        # scan aware keep warm of the x-ray source
+        self.pvCache.subscribe(SCAN_PROGRESS_LIST + SCAN_BUSY_LIST + [SCAN_DETECTOR_1])
+        self.warmTimer = None
+        # predictive pre-warm
+        self.preWarmed = False
+        self.preWarmTimer = None                        # next scheduled scan point
+        self.preWarmGuard = None                        # returns an unused pre-warmed source to standby
+        self.lastExposureStart = 0.0
         #self.write('PaxscanShutter', 1)
         self.val = []
-        self.x_twv = 0
-        self.shutter_time = 0
-        self.prior = 0
-        # Set up the DI task to check the ExposeOK output from the Varian
-        self.ExpOkInHandle = TaskHandle()
-        DAQmxCreateTask("",byref(self.ExpOkInHandle))
-        DAQmxCreateDIChan(self.ExpOkInHandle, EXP_OK, "", DAQmx_Val_ChanForAllLines)
-        DAQmxStartTask(self.ExpOkInHandle)
-        # Set up the DO task to send the ExposeRequest signal to the Varian. 
-        # Must be "active drive" or it will not work.
-        self.ExpReqOutTask = TaskHandle()
-        DAQmxCreateTask("",byref(self.ExpReqOutTask))
-        DAQmxCreateDOChan(self.ExpReqOutTask, EXP_REQ, "", DAQmx_Val_ChanForAllLines)
-        DAQmxSetDOOutputDriveType(self.ExpReqOutTask, EXP_REQ, DAQmx_Val_ActiveDrive);
-        DAQmxStartTask(self.ExpReqOutTask)
-        # make sure expreq is low
-        self.setExpReqOutputLow()   
-        SCAN_DETECTOR_1.put(EXPERIMENT + 'VARIAN:cam1:Acquire')
-        epicsApps.buildRequestFiles(prefix, pvdb.keys(), os.getcwd())
+        # detector channels, each with its own ExpReq/ExpOk line pair
+        self.channels = []
+        for config in DETECTOR_CHANNELS:
+            channel = DetectorChannel(self.daq, config['name'], config['det'], config['expReq'], config['expOk'], \
+                                      config.get('expReqLoop'))
+            channel.expOk.addListener(lambda level, stamp, channel = channel: self.tubeLoadEdge(channel, level, stamp))
+            self.pvCache.addMonitor(channel.det + 'cam1:Acquire', self.acquireChange)
+            if self.loop is not None:
+                channel.expOk.addListener(lambda level, stamp: self.loop.wake())
+            self.channels.append(channel)
+            # make sure expreq is low
+            self.setExpReqOutputLow(channel)
+        for busy in SCAN_BUSY_LIST:
+            self.pvCache.addMonitor(busy, self.scanBusyChange)
+        self.pvCache.put(SCAN_DETECTOR_1, EXPERIMENT + 'VARIAN:cam1:Acquire')
+        # RT_* show what this process got and triggers would fire again, not settings to restore
+        epicsApps.buildRequestFiles(prefix, [reason for reason in pvdb.keys() if not reason.startswith('RT_') \
+                                             and self.channelOf(reason)[1] not in TRIGGER_PVS], os.getcwd())
         epicsApps.makeAutosaveFiles()
         print '############################################################################'
         print '## ADVARIAN PCAS IOC Online $Date:' + str(datetime.datetime.now())[:-3]
         print '############################################################################'
     
+    def close(self):
+        """
+        Writes out the run table, flushes the event trace and stops the timing process on exit.
+        """
+        self.closeMetaStore()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.timing is not None:
+            self.timing.stop()
+
     def setProcessPriority(self):
         try:
             sys.getwindowsversion()
@@ -153,13 +1428,57 @@ class myDriver(Driver):
         if isWindows:
             try:
                 p.set_nice(psutil.HIGH_PRIORITY_CLASS)
+                self.setParam('RT_PRIORITY', 'HIGH_PRIORITY_CLASS')
             except:
                 print str(datetime.datetime.now())[:-3], "Failed setting high priority for this process. Need to run ioc as admin"
+                self.setParam('RT_PRIORITY', 'failed')
         else:
             try:
-                os.nice(-10)
-            except IOError:
-                print str(datetime.datetime.now())[:-3], "Could not set high priority"
+                self.setParam('RT_PRIORITY', 'nice %d' % os.nice(-10))
+            except OSError as err:
+                print str(datetime.datetime.now())[:-3], "Could not set high priority", err
+                self.setParam('RT_PRIORITY', 'failed: ' + err.strerror)
+            if MEMORY_LOCK:
+                status = realtime.lockMemory()
+                if status != 'locked':
+                    print str(datetime.datetime.now())[:-3], "Could not lock process memory", status
+                self.setParam('RT_MLOCK', status)
+        if GC_MODE == 'OFF':
+            gc.disable()
+        self.setParam('RT_GC', GC_MODE)
+        self.updatePVs()
+
+    def exposureThread(self):
+        """
+        Exposure lane thread setup: real-time scheduling, reported in RT_POLICY/RT_AFFINITY.
+        """
+        status = realtimeThread()
+        if status is not None:
+            self.setParam('RT_POLICY', status[0])
+            self.setParam('RT_AFFINITY', status[1])
+            self.updatePVs()
+
+    def startExposing(self, channel):
+        """
+        Marks channel as exposing, with GC_MODE EXPOSURE the garbage collector is off until no channel is.
+        Returns the x-ray source to expose with, XSYNC can't swap it until stopExposing.
+        """
+        with self.sourceLock:
+            with self.gcLock:
+                self.exposing.add(channel.name)
+                if GC_MODE == 'EXPOSURE':
+                    gc.disable()
+            return self.source
+
+    def stopExposing(self, channel):
+        with self.gcLock:
+            self.exposing.discard(channel.name)
+            if GC_MODE != 'EXPOSURE' or self.exposing:
+                return
+            gc.enable()
+        # catch up on the young generations skipped during the exposure, off the exposure lane,
+        # a full collection of a long running IOC takes longer than the gap between scan points
+        self.dispatcher.io(gc.collect, 1)
     
     def iocStats(self):
         """
@@ -180,7 +1499,6 @@ class myDriver(Driver):
         and current date time
         """
         format_time = ""
-        global XRAY_IOC
         if reason == 'UPTIME':
             format_time = datetime.datetime.now() - self.start_time
             value  = str(format_time).split(".")[0] 
@@ -189,16 +1507,8 @@ class myDriver(Driver):
         elif reason == 'HEARTBEAT':
             value = self.getParam('HEARTBEAT') + 1
             self.setParam('HEARTBEAT', value)
-        elif reason == 'XSYNC_RBV':
-            value = self.getParam('XSYNC')
-            if value == 3:
-              XRAY_IOC = EXPERIMENT + 'cpiSync:'  
-            elif value == 2:
-                XRAY_IOC = EXPERIMENT + 'OXFORD:xray:'
-            elif value == 1:
-                XRAY_IOC = EXPERIMENT + 'SRI:xray:'
-            elif value == 0:
-                XRAY_IOC = ''
+        elif reason in self.dispatcher.pvNames:
+            value = self.dispatcher.counter(reason)
         else: 
             value = self.getParam(reason)
         return value
@@ -207,272 +1517,967 @@ class myDriver(Driver):
         """
         pcaspy native write method
         """
-        if reason == 'PaxscanShutter': 
-            self.shutter = value
+        if self.recorder is not None:
+            self.recorder.write(reason, value)
+        channel, base = self.channelOf(reason)
+        if base == 'PaxscanShutter': 
+            channel.shutter = value
+            config = channel.config(self.pvCache)
             # only call function if in rad mode
-            if self.configValue == 0 : 
-                if value == 1:
+            if config == 0 : 
+                if value == 1 and channel.burst:
+                    # frame of a running burst, exposed by the burst sequence
+                    channel.shutterOpened.set(monotonic())
+                elif value == 1:
                     # start rad mode sequence
-                    print str(datetime.datetime.now())[:-3], "Current Acquisiton Mode: Radiography"
-                    self.tid = threading.Thread(target = self.paxscanShutterOpen, args = ())
-                    self.tid.daemon = True
-                    self.tid.start()
-            elif self.configValue == 1:
-                if value == 1:
-                    # xray on
-                    print str(datetime.datetime.now())[:-3], "Current Acquisition Mode: Fluoroscopy"
-                    self.startupXray()
-                    self.setParam(reason, value)
-                elif value == 0:
-                    # xray off
-                    self.stopXrayFlux()
-                    self.setParam(reason, value)
+                    print str(datetime.datetime.now())[:-3], channel.name + "Current Acquisiton Mode: Radiography"
+                    self.runSequence(self.paxscanShutterOpenSeq(channel, monotonic(), channel.shutterClosed.count), \
+                                     'paxscanShutterOpen', channel)
+                else:
+                    # ends a double mode exposure
+                    channel.shutterClosed.set()
+                    channel.events.set()
+                # rad mode puts complete right away, the sequence runs in the background
+                self.setParam(reason, value)
+                self.callbackPV(reason)
+            elif config == 1:
+                # xray on/off off the server thread, the put completes when the x-ray is firing/off
+                if not self.runSequence(self.fluoroShutterSeq(channel, value), 'fluoroShutter', channel, \
+                                        reason = reason):
+                    self.callbackPV(reason)
+                return True
+            else:
+                self.callbackPV(reason)
         elif reason == "XSYNC":
-           self.setParam(reason, value)
-        elif reason == 'SYNC_TRIGGER' and value == 1:
-           self.hid = threading.Thread(target = self.liveXSync)
-           self.hid.daemon = True
-           self.hid.start()
-        elif reason == "DOC":
+            # switch sources right away, but never under a running exposure or a warm source
+            if value != self.getParam('XSYNC') and (self.exposing or self.preWarmed or \
+                                                    self.getParam('KEEP_WARM_RBV') == 1):
+                print str(datetime.datetime.now())[:-3], 'XSYNC change refused, x-ray exposure in progress'
+                return False
             self.setParam(reason, value)
+            self.updatePVs()
+            # the adapter PV's connect on the I/O lane, not on the server thread
+            if not self.dispatcher.io(self.switchSource, value):
+                self.callbackPV(reason)
+            return True
+        elif reason == 'SYNC_TRIGGER':
+            # the put completes when the live scan is done
+            if value != 1 or not self.runSequence(self.liveXSyncSeq(), 'liveXSync', lane = LIVE_LANE, reason = reason):
+                self.callbackPV(reason)
+            value = 0
+        elif base == 'BURST_START':
+            if value == 1 and channel.burst:
+                print str(datetime.datetime.now())[:-3], channel.name + 'Burst refused, a burst is running'
+                return False
+            # the put completes when the burst is done
+            if value != 1 or not self.runSequence(self.burstSeq(channel), 'burst', channel, reason = reason):
+                self.callbackPV(reason)
+            value = 0
+        elif base == 'BURST_ABORT':
+            if value == 1 and channel.burst:
+                print str(datetime.datetime.now())[:-3], channel.name + 'Burst abort requested'
+                channel.burstAbort = True
+            value = 0
+        elif base == 'EXP_CANCEL':
+            if value == 1:
+                print str(datetime.datetime.now())[:-3], channel.name + 'Sequence cancel requested'
+                # the first channel also owns the live scans it triggers
+                self.cancelSequences([channel.lane] + ([LIVE_LANE] if channel is self.channels[0] else []))
+            value = 0
+        elif reason == 'LOAD_SESSION_RESET':
+            if value == 1:
+                # new user session
+                self.resetLoad('LOAD_SESSION_')
+                self.setParam('LOAD_SESSION_START', str(datetime.datetime.now())[:-7])
+            value = 0
+        elif base == 'HIST_DUMP':
+            if value == 1:
+                self.dispatcher.io(self.dumpHistory, channel)
+            value = 0
+        elif reason == "DOC" or reason == "DOC_FORMAT":
+            self.setParam(reason, value)
+            # documentation stopped or switched format, write out the run table
+            self.closeMetaStore()
         self.setParam(reason, value)
         self.updatePVs()
+        # asyn puts handed to a lane complete later with callbackPV, pcaspy only waits for them on True
+        return True
             
-    def waitForExpOkOn(self):
+    def channelOf(self, reason):
         """
-        This function constantly polls the ExpOk signal from the Varian i.e. 
-        the input line on the DAQ corresponding to EXP_OK. Returns true when the
-        ExpOk Output from Varian is 1.
+        Detector channel a record belongs to and the record name without the channel sub prefix.
         """
-        while True:
-            newVal = np.array([0], dtype=np.uint8)
-            DAQmxReadDigitalLines(self.ExpOkInHandle, 1, 1, 0,  newVal, 1, None, None, None)
-            if newVal == self.one:
-                break
-            time.sleep(.001)
-        self.timeOn = time.time()
-        self.setParam('ExpOk', 1)
-        self.updatePVs()
+        for channel in self.channels[1:]:
+            if reason.startswith(channel.name):
+                return channel, reason[len(channel.name):]
+        return self.channels[0], reason
 
-    def waitForExpOkOff(self):
+    def expOkSeq(self, level, timeout = None, channel = None):
         """
-        This function constantly polls the ExpOk signal from the Varian i.e. 
-        the input line on the DAQ corresponding to EXP_OK. Returns true when the
-        ExpOk Output from Varian is 0.
+        Coroutine: waits on the ExpOk watcher until the ExpOk output from the Varian
+        is at level and updates the ExpOk record. Returns the edge timestamp (None on timeout).
         """
-        while True:
-            newVal = np.array([0], dtype=np.uint8)
-            DAQmxReadDigitalLines(self.ExpOkInHandle, 1, 1, 0,  newVal, 1, None, None, None)
-            if newVal == self.zero:
-                break
-            time.sleep(.001)
-        self.setParam('ExpOk', 0)
+        channel = channel or self.channels[0]
+        stamp = yield waitLevel(channel.expOk, level, timeout)
+        if stamp is None:
+            raise Return(None)
+        self.setParam(channel.pv('ExpOk'), level)
         self.updatePVs()
-        print str(datetime.datetime.now())[:-3], 'Expose Ok was on for', time.time() - self.timeOn, 's'
+        if level == ExpOkWatcher.RISING:
+            channel.timeOn = stamp
+        else:
+            print str(datetime.datetime.now())[:-3], channel.name + 'Expose Ok was on for', stamp - channel.timeOn, 's'
+            self.setParam(channel.pv('EXP_OK_WIDTH'), (stamp - channel.timeOn) * 1e3)
+            self.updatePVs()
+        raise Return(stamp)
+
+    def waitForExpOkOn(self, timeout = None, channel = None):
+        """
+        Blocks until the ExpOk output from the Varian is 1.
+        Returns the timestamp of the rising edge (None on timeout).
+        """
+        return runBlocking(self.expOkSeq(ExpOkWatcher.RISING, timeout, channel))
+
+    def waitForExpOkOff(self, timeout = None, channel = None):
+        """
+        Blocks until the ExpOk output from the Varian is 0.
+        Returns the timestamp of the falling edge (None on timeout).
+        """
+        return runBlocking(self.expOkSeq(ExpOkWatcher.FALLING, timeout, channel))
 
-    def waitForShutterOff(self):
+    def waitForShutterOff(self, channel = None, timeout = None):
         """
         Wait here while the PaxScan shutter is open (Rad mode acquiring)
         """
-        print self.shutter
-        while self.shutter == 1:
-            time.sleep(.001)
+        channel = channel or self.channels[0]
+        since = channel.shutterClosed.count
+        if channel.shutter == 1:
+            channel.shutterClosed.wait(since, timeout)
 
     # Set ExpReq high, this basically tells the panel we are ready to X-ray on demand
-    def setExpReqOutputHigh(self):
+    def setExpReqOutputHigh(self, channel = None, release = False):
         """
         This function sets the NIDAQ output line corresponding to EXP_REQ to 1, 
-        to let the panel know that we are ready to expose.
+        to let the panel know that we are ready to expose. With release and the
+        timing process, the timing process sets it to 0 on the ExpOk falling edge.
         """
-        try:
-            DAQmxWriteDigitalLines(self.ExpReqOutTask,1,1,10.0, \
-            DAQmx_Val_GroupByChannel,self.one,self.written, None)
-        except DAQError as err:
-            print "DAQmx Error: %s"%err
+        channel = channel or self.channels[0]
+        channel.expOk.arm(True)
+        if release and self.timing is not None:
+            self.timing.release(channel.expReq)
+        channel.ExpReqOut.write(1)
 
     # Set ExpReq low, timing of this is not important 
-    def setExpReqOutputLow(self):
+    def setExpReqOutputLow(self, channel = None):
         """
         This function sets the NIDAQ output line corresponding to EXP_REQ to 0, 
         to let the panel know that we are done exposing.
         """
-        try:
-            DAQmxWriteDigitalLines(self.ExpReqOutTask,1,1,10.0, \
-            DAQmx_Val_GroupByChannel,self.zero,self.written, None)
-        except DAQError as err:
-            print "DAQmx Error: %s"%err
+        channel = channel or self.channels[0]
+        channel.ExpReqOut.write(0)
+        channel.expOk.arm(False)
    
+    def runSequence(self, coroutine, name = '', channel = None, lane = None, reason = None):
+        """
+        Queues an exposure sequence coroutine on the exposure lane of a detector
+        channel (the first one by default) or on lane, which is the event loop with
+        the LOOP engine or a dispatcher worker thread otherwise. Lanes of different
+        channels run concurrently. reason is the asyn record whose put the sequence
+        completes, the put is completed here if it is cancelled before it started.
+        """
+        lane = lane or (channel or self.channels[0]).lane
+        name = channel.name + name if channel else name
+        unstarted = None if reason is None else lambda: self.completePut(reason)
+        if self.loop is not None:
+            task = self.loop.spawn(coroutine, name, lane = lane, unstarted = unstarted)
+        else:
+            task = Task(coroutine, name, unstarted)
+            if not self.dispatcher.submit(lane, runBlocking, task):
+                return False
+        self.sequences[lane] = [other for other in self.sequences.get(lane, []) if not other.done] + [task]
+        return task
+
+    def completePut(self, reason):
+        self.callbackPV(reason)
+        self.updatePVs()
+
+    def cancelSequences(self, lanes):
+        """
+        Cancels the running and queued sequences of lanes. Their finally blocks
+        still run, so ExpReq goes low and a source left firing is stopped.
+        """
+        for lane in lanes:
+            for task in self.sequences.get(lane, []):
+                if not task.done:
+                    task.cancel()
+        if self.loop is not None:
+            self.loop.wake()
+
+    def sourceShared(self, channel):
+        """
+        True if another detector channel is still exposing with the x-ray source.
+        """
+        return bool(self.exposing - set([channel.name]))
+
     def startupXray(self):
         """
         Returns when the xray is on and outputting x-rays at set values
         """
-        if self.getParam('XSYNC') == 3: # x-ray sync is set to cpi-cmp200
-            self.myFlag = 0
-            # check that the x-ray is not disconnected or in init phase or the emergency stop is on
-            if caget(EXPERIMENT + 'CPI:xray:GeneratorStatus') == 0 or \
-               caget(EXPERIMENT + 'CPI:xray:GeneratorStatus') == 1 or \
-               caget(EXPERIMENT + 'CPI:xray:GeneratorStatus') == 9:
-                   self.myFlag = 1
-                   return
-            else:
-                # here we just get the generator ready to expose
-                caput(XRAY_IOC + 'RAD_PREP' , 1)
-                while (caget(EXPERIMENT + 'CPI:xray:' + 'RadPrep') != 2 and 
-                       caget(EXPERIMENT + 'CPI:xray:ErrorLatching') != 22):
-                    time.sleep(0.01)
-                if caget(EXPERIMENT + 'CPI:xray:ErrorLatching') == 22:
-                    self.myFlag = 1
-                    caput(EXPERIMENT + 'CPI:xray:AcknowledgeError', 1)
-                    
-        elif self.getParam('XSYNC') == 2: # x-ray sync is set to oxford/nova
-            if caget(XRAY_IOC + 'STATUS_RBV') == 5: # make sure x-ray is not in fault mode.
-                print str(datetime.datetime.now())[:-3], 'X-ray is in fault mode!'
-                return
-            else:
-                if caget(XRAY_IOC + 'STATUS_RBV') == 0: # xray is warming
-                    print str(datetime.datetime.now())[:-3], 'Waiting for warm up to finish!'
-                    return
-                if caget(XRAY_IOC + 'STATUS_RBV') == 1: # if xray in standby mode 
-                    # turn on x-ray 
-                    caput(XRAY_IOC + 'ON', 1)
-                    # wait for x-ray to reach set points
-                    while (caget(XRAY_IOC + 'FIRING_RBV') != 1): # this record is sampled at 10Hz in the db
-                        time.sleep(0.01)
-                elif caget(XRAY_IOC + 'STATUS_RBV') == 3 or caget(XRAY_IOC + 'STATUS_RBV') == 2: # in pulse/output mode now.
-                    caput(XRAY_IOC + 'PULSE_MODE', 0)   
-                    while (caget(XRAY_IOC + 'FIRING_RBV') != 1):
-                        time.sleep(0.01)
-                print str(datetime.datetime.now())[:-3], 'X-ray is outputting at set points'
-        elif self.getParam('XSYNC') == 1: # x-ray sync is set to sri
-            caput(XRAY_IOC + 'ON', 1) 
-            print str(datetime.datetime.now())[:-3], 'X-ray is outputting at set points'
-        elif self.getParam('XSYNC') == 0:
-            print str(datetime.datetime.now())[:-3], 'Acquiring dark image'
+        runBlocking(self.startupXraySeq(self.source))
+
+    def selectSource(self, xsync):
+        """
+        Makes the adapter for XSYNC value xsync the active x-ray source. Adapters
+        are created and connected on first selection and reused after that. The
+        swap is refused (False) while a channel is exposing or the source is warm,
+        checked under the source lock startExposing takes, so no sequence is left
+        holding the old source.
+        """
+        if xsync not in self.sources:
+            adapter, ioc = XRAY_SOURCES[xsync]
+            self.sources.setdefault(xsync, adapter(self.pvCache, ioc))
+        with self.sourceLock:
+            source = self.sources[xsync]
+            if self.source is not None and source is not self.source and \
+               (self.exposing or self.preWarmed or self.getParam('KEEP_WARM_RBV') == 1):
+                return False
+            self.source = source
+            self.tubeLoad.setSource(source)
+            self.setParam('XSYNC_RBV', xsync)
+        return True
+
+    def switchSource(self, xsync):
+        """
+        I/O lane part of an XSYNC write: selects the source and completes the put.
+        """
+        try:
+            if not self.selectSource(xsync):
+                print str(datetime.datetime.now())[:-3], 'XSYNC change refused, x-ray exposure in progress'
+                self.setParam('XSYNC', self.getParam('XSYNC_RBV'))
+        finally:
+            self.callbackPV('XSYNC')
+            self.updatePVs()
+
+    def startupXraySeq(self, source):
+        """
+        Coroutine: returns when the xray is on and outputting x-rays at set values
+        """
+        # a warm source is about to fire again, stop the idle timer
+        if self.warmTimer is not None:
+            self.warmTimer.cancel()
+            self.warmTimer = None
+        self.setParam('KEEP_WARM_RBV', 0)
+        self.lastExposureStart = time.time()
+        if self.preWarmed:
+            self.preWarmed = False
+            self.cancelPreWarmGuard()
+            self.setParam('PREWARM_RBV', 0)
+            self.setParam('PREWARM_HITS', self.getParam('PREWARM_HITS') + 1)
+        ready = yield source.prepare()
+        self.myFlag = 0 if ready else 1
+        if source.name == 'CPI':
+            self.setParam('CPI_PREP_HITS', source.hits)
+            self.setParam('CPI_PREP_MISSES', source.misses)
+            self.updatePVs()
                 
     def stopXrayFlux(self):
         """
         Stop x-ray flux
         """
-        if self.getParam('XSYNC') == 0:
+        runBlocking(self.stopXrayFluxSeq())
+
+    def stopXrayFluxSeq(self, source = None):
+        """
+        Coroutine: stop x-ray flux of source, the active one by default
+        """
+        source = source or self.source
+        if source.name == 'NONE':
             return
-        elif self.getParam('XSYNC') == 1: # x-ray sync is set to sri
-            caput(XRAY_IOC + 'ON', 0)
-        elif self.getParam('XSYNC') == 2: # x-ray sync is set to oxford
-            caput(XRAY_IOC + 'ON', 0)
-        elif self.getParam('XSYNC') == 3: # x-ray sync is set to cpi-cmp200
-            caput(XRAY_IOC + 'EXPOSE', 0)
-            time.sleep(.01)
-            caput(XRAY_IOC + 'RAD_PREP', 0)
+        yield source.stop()
         print str(datetime.datetime.now())[:-3], 'X-ray is off'
 
     # Signal sent from ADShutter when it requests x-ray output (ASAP)
-    def paxscanShutterOpen(self):
-        while VARIAN_PV.get() != 1:
-            time.sleep(0.01)
-        self.startupXray()  
-        self.setExpReqOutputHigh() 
-        print str(datetime.datetime.now())[:-3], 'Expose Request sent to PaxScan'
-        self.waitForExpOkOn()
-        if self.getParam('XSYNC') == 3: # x-ray sync is set to cpi-cmp200
-            caput(XRAY_IOC + 'EXPOSE', 1) 
-        
-        print str(datetime.datetime.now())[:-3], 'Waiting for Expose Ok from Paxscan to go to 0'
-        self.waitForExpOkOff()
-        if self.getParam('XSYNC') != 0:
-            time.sleep(1)
-            self.stopXrayFlux()        # turns off x-ray output 
+    def paxscanShutterOpenSeq(self, channel, requested = None, shutterSince = 0):
+        """
+        Coroutine: rad mode exposure, runs on the exposure lane of the channel.
+        XSYNC can't be changed while it is in flight. shutterSince is the count
+        of shutter closes when the exposure was requested (double mode).
+        """
+        source = self.startExposing(channel)
+        ok = False
+        try:
+            ok = yield self.radExposureSeq(channel, source, requested, shutterSince)
+        except Cancelled as err:
+            # the source may be firing with nothing left to stop it
+            if not self.sourceShared(channel):
+                yield self.stopXrayFluxSeq(source)
+            raise err
+        finally:
+            self.stopExposing(channel)
+            self.recordExposure(channel, 'EXPOK_ON', 'EXPOK_OFF', ok)
+            start = channel.phases.current[channel.phases.index['EXPREQ_HIGH']]
+            if channel.expOk.sampled and not np.isnan(start):
+                end = channel.phases.current[channel.phases.index['EXPREQ_LOW']]
+                self.dispatcher.io(self.publishLineTrace, channel, start - EXP_TRACE_MARGIN, end + EXP_TRACE_MARGIN)
+
+    def radExposureSeq(self, channel, source, requested = None, shutterSince = 0):
+        """
+        Coroutine: rad mode exposure sequence with source. Returns True if ExpOk came on and
+        went off, False if cam1:Acquire or an ExpOk edge timed out (RAD_TIMEOUT).
+        """
+        phases = channel.phases
+        phases.start(requested)
+        acquire = channel.det + 'cam1:Acquire'
+        acquired = yield waitUntil(self.pvCache, lambda: self.pvCache.values.get(acquire) == 1, RAD_TIMEOUT)
+        if not acquired:
+            print str(datetime.datetime.now())[:-3], channel.name + 'Timed out waiting for', acquire
+            raise Return(False)
+        phases.mark('ACQUIRE')
+        yield self.startupXraySeq(source)
+        phases.mark('XRAY_READY')
+        timeOff = None
+        doubleMode = self.pvCache.get(channel.det + 'cam1:DoubleMode') == 1
+        try:
+            # a single exposure ends on the ExpOk falling edge, in the timing process if there is one
+            self.setExpReqOutputHigh(channel, release = not doubleMode)
+            phases.mark('EXPREQ_HIGH')
+            print str(datetime.datetime.now())[:-3], channel.name + 'Expose Request sent to PaxScan'
+            timeOn = yield self.expOkSeq(ExpOkWatcher.RISING, RAD_TIMEOUT, channel = channel)
+            if timeOn is None:
+                print str(datetime.datetime.now())[:-3], channel.name + 'Timed out waiting for Expose Ok from Paxscan'
+            else:
+                phases.mark('EXPOK_ON', timeOn)
+                source.fire()
+                
+                if doubleMode:
+                    print str(datetime.datetime.now())[:-3], channel.name + \
+                          'DoubleMode: x-ray stays on for both frames, waiting for PaxscanShutter 0'
+                    timeOff = yield self.doubleExposureSeq(channel, shutterSince)
+                else:
+                    print str(datetime.datetime.now())[:-3], channel.name + 'Waiting for Expose Ok from Paxscan to go to 0'
+                    timeOff = yield self.expOkSeq(ExpOkWatcher.FALLING, RAD_TIMEOUT, channel = channel)
+                    if timeOff is None:
+                        print str(datetime.datetime.now())[:-3], channel.name + 'Timed out waiting for Expose Ok to go to 0'
+            if timeOff is not None:
+                phases.mark('EXPOK_OFF', timeOff)
+        finally:
+            # the panel is done integrating (or the sequence was cancelled), 
+            # drop the request before the x-ray tail
+            self.setExpReqOutputLow(channel)  
+            phases.mark('EXPREQ_LOW')
+            print str(datetime.datetime.now())[:-3], channel.name + 'Expose Request now low'
+        if source.name != 'NONE':
+            if timeOff is not None:
+                yield self.tailHoldSeq(source, timeOff - timeOn, auto = channel.name in self.bursting)
+            if self.sourceShared(channel):
+                print str(datetime.datetime.now())[:-3], 'X-ray left on for the other detector channel(s)'
+            elif timeOff is not None and self.keepWarm(source):
+                yield self.holdXrayWarmSeq(source)    # more scan points follow, leave the source ready
+            else:
+                yield self.stopXrayFluxSeq(source)    # turns off x-ray output 
         else:
             print str(datetime.datetime.now())[:-3], 'Dark Acquisition Finished'
-        self.setExpReqOutputLow()  
-        print str(datetime.datetime.now())[:-3], 'Expose Request now low'
-        self.tid = None
+        phases.mark('XRAY_OFF')
+        self.publishPhases(channel)
+        self.schedulePreWarm(channel)
+        raise Return(timeOff is not None)
 
-    def configChange(self, **kw):
+    def doubleExposureSeq(self, channel, shutterSince):
         """
-        This function will be called back when user switches Varian Config to either
-        0- Radiography mode, or 1- Fluoroscopy Mode. Syncing is very different 
-        for these modes so we need to keep track of this
+        Coroutine: double mode, called with the first ExpOk window on. The source
+        keeps firing through both ExpOk windows of the panel until ADVarian closes
+        the shutter (PaxscanShutter 0) and ExpOk is off. Wakes up only on ExpOk
+        edges and the shutter write. Returns the last ExpOk falling edge timestamp.
         """
-        self.configValue = VARIAN_CONFIG.get()
-    
-    def checkDoc(self, **kw):
+        watcher = channel.expOk
+        rising = watcher.edgeCounter(ExpOkWatcher.RISING)
+        falling = watcher.edgeCounter(ExpOkWatcher.FALLING)
+        level = ExpOkWatcher.RISING
+        while True:
+            seen = channel.events.count
+            if watcher.level != level:
+                level = watcher.level
+                self.setParam(channel.pv('ExpOk'), level)
+                self.updatePVs()
+                print str(datetime.datetime.now())[:-3], channel.name + 'DoubleMode: Expose Ok', level, 'frame', \
+                      watcher.edgeCounter(ExpOkWatcher.RISING) - rising + 1
+            if channel.shutterClosed.count > shutterSince and level == ExpOkWatcher.FALLING:
+                break
+            stamp = yield waitSignal(channel.events, seen, DOUBLE_MODE_TIMEOUT)
+            if stamp is None:
+                print str(datetime.datetime.now())[:-3], channel.name + 'DoubleMode: timed out waiting for the shutter'
+                break
+        if watcher.edgeCounter(ExpOkWatcher.FALLING) > falling:
+            raise Return(watcher.edgeTime[ExpOkWatcher.FALLING])
+        raise Return(monotonic())
+
+    def fluoroShutterSeq(self, channel, value):
+        """
+        Coroutine: fluoro mode x-ray on (value 1) or off (value 0). Completes the
+        asynchronous PaxscanShutter put once the source is firing or off.
+        """
+        try:
+            if value == 1:
+                # xray on
+                print str(datetime.datetime.now())[:-3], channel.name + "Current Acquisition Mode: Fluoroscopy"
+                source = self.startExposing(channel)
+                channel.phases.start()
+                yield self.startupXraySeq(source)
+                channel.phases.mark('XRAY_READY')
+            elif value == 0:
+                # xray off, unless another channel still uses it
+                if not self.sourceShared(channel):
+                    yield self.stopXrayFluxSeq()
+                self.stopExposing(channel)
+                channel.phases.mark('XRAY_OFF')
+                self.publishPhases(channel)
+                self.recordExposure(channel, 'XRAY_READY', 'XRAY_OFF', True)
+        finally:
+            self.setParam(channel.pv('PaxscanShutter'), value)
+            self.callbackPV(channel.pv('PaxscanShutter'))
+            self.updatePVs()
+
+    def publishPhases(self, channel):
+        """
+        Ends the current exposure cycle of the phase timer and updates the PHASE_* records.
+        """
+        phases = channel.phases
+        offsets = phases.finish()
+        for phase, offset in zip(PHASE_LIST, offsets):
+            self.setParam(channel.pv('PHASE_' + phase), offset)
+        low, mean, p99 = phases.stats()
+        self.setParam(channel.pv('PHASE_MIN'), low)
+        self.setParam(channel.pv('PHASE_MEAN'), mean)
+        self.setParam(channel.pv('PHASE_P99'), p99)
+        self.setParam(channel.pv('PHASE_COUNT'), phases.count)
+        self.updatePVs()
+
+    def recordExposure(self, channel, onPhase, offPhase, ok):
+        """
+        Adds the current phase timer cycle to the exposure history (on time is
+        offPhase - onPhase) and updates the HIST_* records. A rad cycle counts
+        as ok only if it finished and ExpOk came on and went off.
+        """
+        index = channel.phases.index
+        current = channel.phases.current
+        history = channel.history
+        duration = (current[index[offPhase]] - current[index[onPhase]]) * 1e3
+        # phases are on the monotonic clock, the history keeps the epoch time
+        start = current[index['SHUTTER']] + time.time() - monotonic()
+        history.add(start, duration, self.getParam('XSYNC_RBV'), \
+                    self.pvCache.get(channel.det + 'cam1:VarianConfig') or 0, \
+                    self.pvCache.get(channel.det + 'cam1:VarianMode') or 0, ok and not np.isnan(duration))
+        records = history.snapshot()
+        for field in ExposureHistory.dtype.names:
+            self.setParam(channel.pv('HIST_' + field.upper()), records[field])
+        self.setParam(channel.pv('HIST_COUNT'), history.count)
+        self.setParam(channel.pv('HIST_FAILED'), history.failed)
+        self.setParam(channel.pv('HIST_RATE'), history.rate())
+        self.updatePVs()
+
+    def publishLineTrace(self, channel, start, end):
         """
-        Callback function for Varian FullFileName_RBV PV. When image is saved,
-        this function will start a thread to save parameter file if DOC is ON.
+        Publishes the sampled ExpOk/ExpReq lines between start and end to the
+        EXP_TRACE_* records, once the margin after ExpReq low is sampled.
+        """
+        remaining = end - monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        stamps, trace = channel.expOk.ExpOkIn.samples(start, end, EXP_TRACE_POINTS)
+        if len(stamps) < 2:
+            print str(datetime.datetime.now())[:-3], channel.name + 'ExpOk trace no longer in the sample buffer'
+            return
+        self.setParam(channel.pv('EXP_TRACE_OK'), trace[:, 0])
+        if trace.shape[1] > 1:
+            self.setParam(channel.pv('EXP_TRACE_REQ'), trace[:, 1])
+        self.setParam(channel.pv('EXP_TRACE_PERIOD'), (stamps[-1] - stamps[0]) / (len(stamps) - 1) * 1e3)
+        self.updatePVs()
+
+    def dumpHistory(self, channel):
+        """
+        Writes the exposure history to a tab separated file next to the images.
+        """
+        filePath = self.pvCache.get(channel.det + 'TIFF1:FilePath_RBV', as_string=True) or ''
+        fileName = filePath + time.strftime('exposureHistory_%Y%m%d_%H%M%S.txt')
+        try:
+            count = channel.history.dump(fileName)
+        except IOError as err:
+            print str(datetime.datetime.now())[:-3], 'Exposure history dump failed', err
+            return
+        print str(datetime.datetime.now())[:-3], 'Exposure history,', count, 'exposures, saved to', fileName
+        self.setParam(channel.pv('HIST_DUMP_FILE'), fileName)
+        self.updatePVs()
+
+    def tubeLoadEdge(self, channel, level, stamp):
+        """
+        ExpOk watcher listener: integrates the tube load over the ExpOk window
+        and adds it to the LOAD_SESSION_* and LOAD_DAY_* totals. With several
+        detector channels the window is open while any channel has ExpOk on.
+        """
+        if level == ExpOkWatcher.RISING:
+            if not self.loadWindow:
+                self.tubeLoad.start(stamp)
+            self.loadWindow.add(channel.name)
+            return
+        self.loadWindow.discard(channel.name)
+        if self.loadWindow:
+            return
+        start = time.time()
+        load = self.tubeLoad.finish(stamp)
+        if load is None:
+            return
+        today = datetime.date.today().isoformat()
+        if self.getParam('LOAD_DAY_DATE') != today:
+            # first exposure of the day
+            self.resetLoad('LOAD_DAY_')
+            self.setParam('LOAD_DAY_DATE', today)
+        for field, value in zip(['TIME', 'KV', 'MAS', 'ENERGY'], load):
+            self.setParam('LOAD_LAST_' + field, value)
+        for total in ['LOAD_SESSION_', 'LOAD_DAY_']:
+            for field, value in zip(['TIME', 'MAS', 'ENERGY', 'COUNT'], [load[0], load[2], load[3], 1]):
+                self.setParam(total + field, self.getParam(total + field) + value)
+        self.setParam('LOAD_CALC_TIME', (time.time() - start) * 1e3)
+        self.updatePVs()
+
+    def resetLoad(self, total):
+        for field in ['TIME', 'MAS', 'ENERGY', 'COUNT']:
+            self.setParam(total + field, 0)
+
+    def tailHoldSeq(self, source, expOkOnTime, auto = False):
+        """
+        Coroutine: holds the x-ray on after ExpOk went off. FIXED mode waits TAIL_HOLD_<source>.
+        AUTO mode (or auto, e.g. between burst frames) waits a fraction of the measured
+        ExpOk on time, and for oxford until FIRING_RBV (sampled at 10Hz) confirms the
+        source was firing at the end of the exposure, but never longer than the FIXED
+        value. A FIRING_RBV that is already 1 and current confirms right away.
+        """
+        hold = self.getParam('TAIL_HOLD_' + source.name)
+        start = time.time()
+        if auto or self.getParam('TAIL_MODE') == 1:
+            firing = yield source.confirmFiring(hold)
+            if not firing:
+                print str(datetime.datetime.now())[:-3], 'X-ray was not firing at the end of the exposure!'
+            auto = min(hold, max(TAIL_AUTO_MIN, TAIL_AUTO_FRACTION * expOkOnTime))
+            remaining = auto - (time.time() - start)
+            if remaining > 0:
+                yield sleep(remaining)
+        else:
+            yield sleep(hold)
+        self.setParam('TAIL_HOLD_RBV', time.time() - start)
+        self.updatePVs()
+
+    def scanBusy(self):
+        """
+        Numbers of the scan records (1-4) which are busy
+        """
+        return [n + 1 for n, busy in enumerate(SCAN_BUSY_LIST) if self.pvCache.get(busy) == 1]
+
+    def keepWarm(self, source):
+        """
+        True if a burst has more frames, KEEP_WARM is ON and the running scan has more
+        points after this one, or CPI_PREP_HOLD is ON and the cpi generator is inside
+        its prep window.
+        """
+        if self.bursting:
+            return True
+        if source.name == 'CPI' and self.getParam('CPI_PREP_HOLD') == 1:
+            return source.holdRemaining() > 0
+        if self.getParam('KEEP_WARM') != 1:
+            return False
+        busy = self.scanBusy()
+        if not busy:
+            return False
+        if busy == [1]:
+            # only the inner scan is running, the source can go once its last point is done
+            cpt, npts = self.pvCache.getMany(SCAN_PROGRESS_LIST)
+            if cpt is not None and npts is not None and cpt + 1 >= npts:
+                return False
+        return True
+
+    def holdXrayWarmSeq(self, source):
+        """
+        Coroutine: stops x-ray output but keeps the source ready for the next scan point:
+        oxford goes to pulse mode, cpi stays in prep. Other sources are stopped.
+        An idle timer releases the source if no exposure follows.
+        """
+        if not source.arm():
+            yield self.stopXrayFluxSeq(source)
+            return
+        print str(datetime.datetime.now())[:-3], 'X-ray kept warm for next shot'
+        self.setParam('KEEP_WARM_RBV', 1)
+        self.updatePVs()
+        self.armWarmTimer(source)
+
+    def armWarmTimer(self, source):
+        if self.warmTimer is not None:
+            self.warmTimer.cancel()
+        idle = self.getParam('KEEP_WARM_IDLE')
+        if source.holdRemaining() is not None:
+            # e.g. the cpi prep window ends first
+            idle = min(idle, source.holdRemaining())
+        self.warmTimer = threading.Timer(idle, self.runSequence, \
+                                         args = (self.releaseWarmSeq(), 'releaseWarm'))
+        self.warmTimer.daemon = True
+        self.warmTimer.start()
+
+    def releaseWarmSeq(self):
+        """
+        Coroutine on the exposure lane: turns the source off if it is being kept warm.
+        """
+        if self.warmTimer is not None:
+            self.warmTimer.cancel()
+            self.warmTimer = None
+        if self.getParam('KEEP_WARM_RBV') == 1:
+            # XSYNC can't swap a warm source
+            yield self.stopXrayFluxSeq(self.source)
+            self.setParam('KEEP_WARM_RBV', 0)
+            self.updatePVs()
+
+    def scanBusyChange(self, name, value, stamp):
+        """
+        PV cache monitor of the scan BUSY PV's, releases a warm source when all scans
+        are done and pre-warms the source when a scan starts.
+        """
+        if not self.scanBusy():
+            if self.getParam('KEEP_WARM_RBV') == 1:
+                self.runSequence(self.releaseWarmSeq(), 'releaseWarm')
+        elif value == 1:
+            self.requestPreWarm('scan started')
+
+    def acquireChange(self, name, value, stamp):
+        """
+        PV cache monitor of cam1:Acquire of every detector channel.
+        """
+        if value == 1:
+            self.requestPreWarm('acquire armed')
+
+    def requestPreWarm(self, reason):
+        if self.getParam('PREWARM') == 1:
+            self.runSequence(self.preWarmSeq(time.time(), reason), 'preWarm')
+
+    def schedulePreWarm(self, channel):
+        """
+        During a scan, pre-warms the source PREWARM_LEAD seconds before the next
+        point, predicted from the time between the last two exposures of the channel.
+        """
+        if self.preWarmTimer is not None:
+            self.preWarmTimer.cancel()
+            self.preWarmTimer = None
+        if self.getParam('PREWARM') != 1 or not self.scanBusy() or channel.history.count < 2:
+            return
+        last, previous = channel.history.snapshot()['start'][-1:-3:-1]
+        delay = 2 * last - previous - self.getParam('PREWARM_LEAD') - time.time()
+        self.preWarmTimer = threading.Timer(max(0.0, delay), self.requestPreWarm, args = ('next scan point',))
+        self.preWarmTimer.daemon = True
+        self.preWarmTimer.start()
+
+    def preWarmSeq(self, requested, reason):
+        """
+        Coroutine on the exposure lane: starts the source ramp unless an exposure
+        ran since the request, the source is already warm, or it has no ramp.
+        """
+        if self.exposing or self.preWarmed or self.lastExposureStart >= requested or \
+           self.getParam('KEEP_WARM_RBV') == 1:
+            return
+        with self.sourceLock:
+            # the source can't be swapped from under the pre-warm
+            if not self.source.preWarm():
+                return
+            self.preWarmed = True
+        print str(datetime.datetime.now())[:-3], 'X-ray pre-warm,', reason
+        self.setParam('PREWARM_RBV', 1)
+        self.updatePVs()
+        self.cancelPreWarmGuard()
+        self.preWarmGuard = threading.Timer(self.getParam('PREWARM_IDLE'), self.runSequence, \
+                                            args = (self.releasePreWarmSeq(), 'releasePreWarm'))
+        self.preWarmGuard.daemon = True
+        self.preWarmGuard.start()
+        return
+        yield
+
+    def cancelPreWarmGuard(self):
+        if self.preWarmGuard is not None:
+            self.preWarmGuard.cancel()
+            self.preWarmGuard = None
+
+    def releasePreWarmSeq(self):
+        """
+        Coroutine on the exposure lane: the predicted exposure didn't come, back to standby.
+        """
+        self.preWarmGuard = None
+        if not self.preWarmed:
+            return
+        source = self.source                            # XSYNC can't swap a pre-warmed source
+        self.preWarmed = False
+        yield self.stopXrayFluxSeq(source)
+        print str(datetime.datetime.now())[:-3], 'X-ray pre-warm not used, source back to standby'
+        self.setParam('PREWARM_RBV', 0)
+        self.setParam('PREWARM_MISSES', self.getParam('PREWARM_MISSES') + 1)
+        self.updatePVs()
+
+    def checkDoc(self, name, value, stamp):
+        """
+        PV cache monitor of Varian FullFileName_RBV. When image is saved,
+        this function will queue the parameter file save on the I/O lane if DOC is ON.
         """
         if self.getParam('DOC') == 1:
-            self.usid = threading.Thread(target = self.saveParams, args=())
-            self.usid.daemon = True
-            self.usid.start()
+            self.dispatcher.io(self.saveParams, self.pvCache.get(name, as_string = True))
         else:
             return
     
-    def reset_num_filters(self, **kw):
-        self.rid = threading.Thread(target = self.rnf, args=())
-        self.rid.daemon = True
-        self.rid.start()
+    def reset_num_filters(self, name, value, stamp):
+        self.dispatcher.io(self.rnf)
 
     def rnf(self):
-        if VARIAN_IMAGEMODE.get() == 0:
-            VARIAN_NUMFILTER.put(1)
-        self.rid = None
+        if self.pvCache.get(VARIAN_IMAGEMODE) == 0:
+            self.pvCache.put(VARIAN_NUMFILTER, 1)
 
-    def saveParams(self):
+    def saveParams(self, fullFileName = None):
         """
-        Daemon thread that saves a text file with the same name as 
-        the image name. The file contains motor position readback values.
+        Daemon thread that documents the motor position readback values of an
+        image, taken from the PV cache monitors in one snapshot. In TXT mode
+        a text file with the same name as the image is saved, otherwise a row
+        is appended to the run table (see RunMetadataStore).
         """
-        filePath = caget(DET_IOC + 'TIFF1:FilePath_RBV', as_string=True)
-        fullFileName = caget(DET_IOC + 'TIFF1:FullFileName_RBV', as_string=True)
-        if fullFileName == '':
+        filePath = self.pvCache.get(DET_IOC + 'TIFF1:FilePath_RBV', as_string=True)
+        if fullFileName is None:
+            fullFileName = self.pvCache.get(DET_IOC + 'TIFF1:FullFileName_RBV', as_string=True)
+        if not fullFileName:
             return 
         else:
-            self.val = []
-            for pvs in MOTOR_IOC_LIST:
-                try:
-                    self.val.append(caget(pvs + '.RBV'))
-                except:
-                    pass
+            self.val = self.pvCache.getMany(DOC_PV_LIST)
             fileName = (fullFileName.split('\\')[-1]).split('.')[0]        
-            f = open(filePath + fileName + '.txt', 'w')
-            # Save relevant PVs
-            for i, j in zip(MOTOR_IOC_LIST, self.val):
-                f.write(i + " - " + str(j) + '\n')
-            f.close()
+            fmt = pvdb['DOC_FORMAT']['enums'][self.getParam('DOC_FORMAT')]
+            if fmt == 'HDF5' and h5py is None:
+                print str(datetime.datetime.now())[:-3], 'h5py not installed, documenting to NPZ'
+                fmt = 'NPZ'
+            if fmt == 'TXT':
+                f = open(filePath + fileName + '.txt', 'w')
+                # Save relevant PVs
+                for i, j in zip(MOTOR_IOC_LIST, self.val):
+                    f.write(i + " - " + str(j) + '\n')
+                f.close()
+            else:
+                # run is the file name without the trailing file number, e.g. test for test_005
+                match = re.match(r'(.*?)_?(\d*)$', fileName)
+                runPath = filePath + match.group(1) + ('_params.h5' if fmt == 'HDF5' else '_params.npz')
+                with self.docLock:
+                    if self.metaStore is None or self.metaStore.path != runPath:
+                        if self.metaStore is not None:
+                            self.metaStore.flush()
+                        self.metaStore = RunMetadataStore(runPath, DOC_PV_LIST, fmt)
+                    self.metaStore.append(int(match.group(2) or -1), fullFileName, self.val)
             print str(datetime.datetime.now())[:-3], 'Document successful'
-            self.usid = None
+
+    def flushMetaStore(self):
+        """
+        Writes out the rows of the run table every DOC_FLUSH_INTERVAL seconds,
+        also when no more images come in.
+        """
+        with self.docLock:
+            if self.metaStore is not None:
+                self.metaStore.flush()
+        self.flushTimer = threading.Timer(DOC_FLUSH_INTERVAL, self.flushMetaStore)
+        self.flushTimer.daemon = True
+        self.flushTimer.start()
+
+    def closeMetaStore(self):
+        """
+        Writes out and releases the current run table.
+        """
+        with self.docLock:
+            if self.metaStore is not None:
+                self.metaStore.flush()
+                self.metaStore = None
             
-    def liveXSync(self):
-        """
-        Synchronizes the x-ray source exposure with the detector shutter
-        """
-        # initialize...
-        print str(datetime.datetime.now())[:-3], 'Prepping for live scan'
-        print VARIAN_RAD.get()
-        if VARIAN_RAD.get() == 1:
-            self.shutter_time = 2.0
-        elif VARIAN_RAD.get() == 3:
-            self.shutter_time = 6.0
-        self.x_twv = caget(MOTOR_IOC + 'm2.TWV')
-        caput(MOTOR_IOC + 'm2.VELO', np.abs(self.x_twv/self.shutter_time))
-        VARIAN_PV.put(1)
-        while(self.getParam('ExpOk') != 1):
-            time.sleep(0.001)
-        caput(MOTOR_IOC + 'm2.TWF', 1)
-        while(caget(MOTOR_IOC + 'm2.DMOV', 0)):
-            time.sleep(0.001)
+    def burstSeq(self, channel):
+        """
+        Coroutine: BURST_COUNT rad exposures of the channel as one sequence on its
+        exposure lane. Each frame waits for the BURST_MOTOR step and its
+        BURST_PERIOD slot, arms cam1:Acquire and exposes on the PaxscanShutter 1
+        write from ADVarian. The source is kept ready until the last frame.
+        """
+        cache = self.pvCache
+        acquire = channel.det + 'cam1:Acquire'
+        if channel.config(cache) != 0:
+            print str(datetime.datetime.now())[:-3], channel.name + 'Burst needs rad mode (VarianConfig 0)'
+            self.callbackPV(channel.pv('BURST_START'))
+            return
+        count = max(0, self.getParam(channel.pv('BURST_COUNT')))
+        period = self.getParam(channel.pv('BURST_PERIOD'))
+        name = self.getParam(channel.pv('BURST_MOTOR')).strip()
+        motor = MOTOR_IOC + name if name else None
+        if motor is not None and motor not in MOTOR_IOC_LIST:
+            print str(datetime.datetime.now())[:-3], channel.name + 'Burst motor', name, 'not one of', \
+                  [m[len(MOTOR_IOC):] for m in MOTOR_IOC_LIST]
+            self.callbackPV(channel.pv('BURST_START'))
+            return
+        steps = self.getParam(channel.pv('BURST_STEPS')) if motor else []
+        if motor is not None:
+            cache.handle(motor + '.VAL')
+            position = cache.get(motor + '.VAL')
+            if position is None:
+                print str(datetime.datetime.now())[:-3], channel.name + 'Burst motor', name, 'not connected'
+                self.callbackPV(channel.pv('BURST_START'))
+                return
+        starts = np.empty(count)                        # ExpOk rising edge of every frame
+        starts.fill(np.nan)
+        late = 0
+        channel.burst = True
+        channel.burstAbort = False
+        self.bursting.add(channel.name)
+        self.setParam(channel.pv('BURST_BUSY'), 1)
+        self.setParam(channel.pv('BURST_FRAME'), 0)
         self.updatePVs()
+        print str(datetime.datetime.now())[:-3], channel.name + 'Burst of', count, 'frames, period', period, 's'
+        begin = time.time()
+        try:
+            for frame in range(count):
+                if channel.burstAbort:
+                    print str(datetime.datetime.now())[:-3], channel.name + 'Burst aborted after', frame, 'frames'
+                    break
+                if frame == count - 1:
+                    # the last frame turns the source off as usual
+                    self.bursting.discard(channel.name)
+                if frame < len(steps) and steps[frame] != 0:
+                    dmov = motor + '.DMOV'
+                    position += steps[frame]
+                    cache.put(motor + '.VAL', position)
+                    yield waitUntil(cache, lambda: cache.values.get(dmov) == 0, BURST_MOVE_START)
+                    moved = yield waitUntil(cache, lambda: cache.values.get(dmov) == 1, BURST_TIMEOUT)
+                    if not moved:
+                        print str(datetime.datetime.now())[:-3], channel.name + 'Burst timed out moving', name
+                        break
+                remaining = begin + frame * period - time.time()
+                if remaining > 0:
+                    yield sleep(remaining)
+                elif frame and period:
+                    late += 1
+                # previous frame read out
+                ready = yield waitUntil(cache, lambda: cache.values.get(acquire) != 1, BURST_TIMEOUT)
+                if not ready:
+                    print str(datetime.datetime.now())[:-3], channel.name + 'Burst timed out waiting for readout'
+                    break
+                since = channel.shutterOpened.count
+                shutterSince = channel.shutterClosed.count
+                cache.put(acquire, 1)
+                requested = yield waitSignal(channel.shutterOpened, since, BURST_TIMEOUT)
+                if requested is None:
+                    print str(datetime.datetime.now())[:-3], channel.name + 'Burst timed out waiting for PaxscanShutter'
+                    break
+                yield self.paxscanShutterOpenSeq(channel, requested, shutterSince)
+                starts[frame] = channel.phases.current[channel.phases.index['EXPOK_ON']]
+                self.setParam(channel.pv('BURST_FRAME'), frame + 1)
+                self.updatePVs()
+        finally:
+            self.bursting.discard(channel.name)
+            channel.burst = False
+            self.publishBurst(channel, starts, late, time.time() - begin)
+            self.callbackPV(channel.pv('BURST_START'))
+
+    def publishBurst(self, channel, starts, late, duration):
+        """
+        Updates the BURST_PERIOD* records from the ExpOk rising edges of the frames of a burst.
+        """
+        periods = np.diff(starts[~np.isnan(starts)]) * 1e3
+        self.setParam(channel.pv('BURST_PERIODS'), periods[:BURST_MAX_FRAMES])
+        if len(periods):
+            self.setParam(channel.pv('BURST_PERIOD_MEAN'), periods.mean())
+            self.setParam(channel.pv('BURST_PERIOD_MIN'), periods.min())
+            self.setParam(channel.pv('BURST_PERIOD_MAX'), periods.max())
+            self.setParam(channel.pv('BURST_PERIOD_JITTER'), periods.std())
+            print str(datetime.datetime.now())[:-3], channel.name + 'Burst period mean/min/max/jitter', \
+                  '%.1f/%.1f/%.1f/%.1f ms' % (periods.mean(), periods.min(), periods.max(), periods.std())
+        self.setParam(channel.pv('BURST_LATE'), late)
+        self.setParam(channel.pv('BURST_TIME'), duration)
+        self.setParam(channel.pv('BURST_BUSY'), 0)
+        self.updatePVs()
+
+    def exposureTime(self):
+        """
+        Exposure time (s) of the current Varian mode, from the detector readback or VARIAN_MODE_EXPOSURE.
+        """
+        det = self.channels[0].det
+        exposure = self.pvCache.get(det + 'cam1:AcquireTime_RBV')
+        if not exposure:
+            exposure = VARIAN_MODE_EXPOSURE.get(self.pvCache.get(det + 'cam1:VarianMode'))
+        return exposure
+
+    def liveXSyncSeq(self):
+        """
+        Coroutine: continuous scan synchronized with one exposure. Every LIVE_AXES
+        motor moves its TWV during the exposure time of the current Varian mode.
+        Motion is started from the ExpOk watcher on the rising edge, and the
+        motion start/end vs ExpOk on/off misalignment is published per run.
+        Runs on LIVE_LANE, the exposure it triggers runs on the exposure lane.
+        """
+        cache = self.pvCache
+        channel = self.channels[0]
+        try:
+            # initialize...
+            print str(datetime.datetime.now())[:-3], 'Prepping for live scan'
+            names = [name.strip() for name in self.getParam('LIVE_AXES').split(',') if name.strip()]
+            axes = [motor for motor in MOTOR_IOC_LIST if motor[len(MOTOR_IOC):] in names]
+            exposure = self.exposureTime()
+            if not axes or not exposure:
+                print str(datetime.datetime.now())[:-3], 'Live scan needs LIVE_AXES from', \
+                      [motor[len(MOTOR_IOC):] for motor in MOTOR_IOC_LIST], 'and a known exposure time'
+                return
+            self.setParam('LIVE_EXPOSURE_RBV', exposure)
+            for motor in axes:
+                cache.put(motor + '.VELO', np.abs(cache.get(motor + '.TWV') / exposure))
+            tweaks = [cache.handle(motor + '.TWF') for motor in axes]
+            def startMotion(level, stamp):
+                # called from the ExpOk watcher, start all axes on the rising edge
+                if level == ExpOkWatcher.RISING:
+                    for twf in tweaks:
+                        twf.put(1)
+                    channel.expOk.removeListener(startMotion)
+            channel.expOk.addListener(startMotion)
+            try:
+                cache.put(channel.det + 'cam1:Acquire', 1)
+                timeOn = yield waitLevel(channel.expOk, ExpOkWatcher.RISING, LIVE_TIMEOUT)
+            finally:
+                channel.expOk.removeListener(startMotion)
+            if timeOn is None:
+                print str(datetime.datetime.now())[:-3], 'Live scan timed out waiting for Expose Ok'
+                return
+            moving = [motor + '.DMOV' for motor in axes]
+            yield waitUntil(cache, lambda: all(cache.values.get(dmov) == 0 for dmov in moving), LIVE_TIMEOUT)
+            started = max(cache.stamps.get(dmov, timeOn) for dmov in moving)
+            timeOff = yield waitLevel(channel.expOk, ExpOkWatcher.FALLING, LIVE_TIMEOUT)
+            yield waitUntil(cache, lambda: all(cache.values.get(dmov) == 1 for dmov in moving), LIVE_TIMEOUT)
+            finished = max(cache.stamps.get(dmov, timeOff) for dmov in moving)
+            if timeOff is not None:
+                self.setParam('LIVE_START_ERR', (started - timeOn) * 1e3)
+                self.setParam('LIVE_END_ERR', (finished - timeOff) * 1e3)
+                print str(datetime.datetime.now())[:-3], 'Live scan motion start/end vs Expose Ok on/off', \
+                      '%.1f/%.1f ms' % ((started - timeOn) * 1e3, (finished - timeOff) * 1e3)
+        finally:
+            self.callbackPV('SYNC_TRIGGER')
+            self.updatePVs()
         
 if __name__ == '__main__':
     server = SimpleServer()
     server.createPV(prefix, pvdb)
-    driver = myDriver()
-    # process CA transactions
-    while True:
+    if ENGINE == 'LOOP':
+        # pcaspy, exposure sequences and callbacks all on this thread
+        loop = EventLoop(server)
+        driver = myDriver(loop = loop)
         try:
-            server.process(0.01)
+            loop.run()
         except KeyboardInterrupt:
+            driver.close()
+            os._exit(0)
+    else:
+        driver = myDriver()
+        # process CA transactions
+        while True:
             try:
-                sys.exit(0)
-            except SystemExit:
-                os._exit(0)
\ No newline at end of file
+                server.process(0.01)
+            except KeyboardInterrupt:
+                driver.close()
+                try:
+                    sys.exit(0)
+                except SystemExit:
+                    os._exit(0)